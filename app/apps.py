@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class InventoryConfig(AppConfig):
+    name = "app"
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,112 @@
+"""
+JWT authentication without a database lookup per request.
+
+Access tokens issued by `MyAccessTokenSerializer` carry the `role` and
+`status` of the user, which is all the permission classes need. Requests
+are authenticated from those verified claims once they are checked
+against the cached `User`: the cache is evicted when a user is saved or
+deleted, so deactivated, deleted and demoted users are rejected on their
+next request instead of when their token expires.
+"""
+
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import cached_property
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+from .metrics import count_cache
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+
+# Never stored in the cache; loaded from the database when read
+SECRET_FIELDS = ("password", "totp_secret")
+
+
+def user_cache_key(user_id):
+    return f"auth:user:{user_id}"
+
+
+def cached_user(user_id):
+    """
+    Return the `User` with `user_id`, or None. Users are cached for
+    `AUTH_USER_CACHE_TIMEOUT` seconds (0 disables the cache) and evicted
+    when saved or deleted. `SECRET_FIELDS` are deferred.
+    """
+    timeout = settings.AUTH_USER_CACHE_TIMEOUT
+    key = user_cache_key(user_id)
+    user = None
+    if timeout:
+        try:
+            user = cache.get(key)
+        except Exception as exc:
+            logger.warning("User cache unavailable: %s", exc)
+        count_cache("auth_user", user is not None)
+    if user is None:
+        user = User.objects.defer(*SECRET_FIELDS).filter(pk=user_id).first()
+        if user is not None and timeout:
+            try:
+                cache.set(key, user, timeout)
+            except Exception as exc:
+                logger.warning("User cache unavailable: %s", exc)
+    return user
+
+
+def invalidate_user(user_id):
+    try:
+        cache.delete(user_cache_key(user_id))
+    except Exception as exc:
+        logger.warning("User cache unavailable: %s", exc)
+
+
+class ClaimsUser(TokenUser):
+    """Authenticated user backed by the claims of a verified access token."""
+
+    @cached_property
+    def role(self):
+        return self.token.get("role")
+
+    @cached_property
+    def status(self):
+        return self.token.get("status")
+
+    def get_model_user(self):
+        user = cached_user(self.id)
+        if user is None:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+        return user
+
+
+def get_model_user(request):
+    """The `User` instance of `request`, loading it if it was built from claims."""
+    user = request.user
+    return user.get_model_user() if isinstance(user, ClaimsUser) else user
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """
+    `JWTAuthentication` that returns a `ClaimsUser` instead of the user
+    loaded from the database. Tokens whose `role` no longer matches the
+    cached `User` are rejected; tokens without it get the `User` itself.
+    """
+
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken("Token contained no recognizable user identification")
+
+        user = cached_user(validated_token[api_settings.USER_ID_CLAIM])
+        if user is None:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+        if not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        if "role" not in validated_token:
+            return user
+        if validated_token["role"] != user.role:
+            raise AuthenticationFailed("Token claims are out of date", code="token_outdated")
+        return ClaimsUser(validated_token)
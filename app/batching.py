@@ -0,0 +1,163 @@
+"""
+Coalescing of deployment jobs.
+
+Jobs are queued `DEPLOYMENT_BATCH_WINDOW` seconds after they are submitted.
+The task that runs first claims its job together with the other pending
+jobs for the same target (datacenter, cluster, network, datastore and
+template), up to `DEPLOYMENT_BATCH_SIZE` jobs; the tasks of those jobs then
+find them claimed and return. Claiming is a single pending -> running
+transition, so a job is never claimed by two tasks.
+
+Tasks are acknowledged late, so the task of a worker that died mid-run is
+delivered again while its batch is still running. Once the run is older
+than `DEPLOYMENT_SLOT_TTL`, the lease of its deployment slots, it is
+considered dead: `reclaim_expired` puts the batch back to pending and the
+redelivered task claims it again. The broker may redeliver earlier, so a
+task that finds its job running retries when the run expires
+(`run_expires_in`) instead of being acknowledged.
+
+A batch is rendered with the batch variant of its template, one `for_each`
+entry per VM, so it costs one `terraform plan` and one provider session
+instead of one per job. `split_plan` hands each job the part of the plan
+about its own VMs.
+"""
+
+import re
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import DeploymentJob, JobStatus
+from .template_registry import get_registry
+
+TARGET_FIELDS = ("datacenter_id", "cluster_id", "network_id", "datastore", "template")
+
+# Top-level resource headers of `terraform plan` output, and the VM keys
+# `batch_vms` gives each job
+RESOURCE_HEADER = re.compile(r"^  # (\S+)")
+JOB_ADDRESS = re.compile(r'\["job_(\d+)_\d+"\]')
+PLAN_SUMMARY = ("Plan:", "No changes.")
+
+
+def claim_batch(job):
+    """
+    Claim `job` and the pending jobs with the same target, marking them
+    running under a new `batch_id` from `started_at` on. Returns the
+    claimed jobs, which is empty when another task got to `job` first.
+    """
+    if job.status != JobStatus.PENDING:
+        return []
+    ids = [job.id]
+    if get_registry().batch_template(job.template):
+        target = {field: getattr(job, field) for field in TARGET_FIELDS}
+        ids += (
+            DeploymentJob.objects.filter(status=JobStatus.PENDING, **target)
+            .exclude(id=job.id)
+            .order_by("created_at", "id")
+            .values_list("id", flat=True)[: settings.DEPLOYMENT_BATCH_SIZE - 1]
+        )
+
+    batch_id = uuid.uuid4().hex
+    DeploymentJob.objects.filter(id__in=ids).transition(
+        JobStatus.PENDING, JobStatus.RUNNING, batch_id=batch_id, started_at=timezone.now()
+    )
+    return list(
+        DeploymentJob.objects.filter(batch_id=batch_id)
+        .select_related("datacenter", "cluster", "network")
+        .order_by("id")
+    )
+
+
+def run_expires_in(job):
+    """Seconds until the run of the running `job` expires, see `reclaim_expired`."""
+    if job.started_at is None:
+        return 0
+    expires_at = job.started_at + timedelta(seconds=settings.DEPLOYMENT_SLOT_TTL)
+    return max(0, (expires_at - timezone.now()).total_seconds())
+
+
+def reclaim_expired(job):
+    """
+    Put the batch of the running `job` back to pending if its run started
+    more than `DEPLOYMENT_SLOT_TTL` seconds ago. Returns True if it did.
+    """
+    if job.status != JobStatus.RUNNING or run_expires_in(job) > 0:
+        return False
+    batch = (
+        DeploymentJob.objects.filter(batch_id=job.batch_id)
+        if job.batch_id
+        else DeploymentJob.objects.filter(id=job.id)
+    )
+    cutoff = timezone.now() - timedelta(seconds=settings.DEPLOYMENT_SLOT_TTL)
+    return bool(
+        batch.filter(Q(started_at__lt=cutoff) | Q(started_at=None)).transition(
+            JobStatus.RUNNING, JobStatus.PENDING, batch_id=None, started_at=None
+        )
+    )
+
+
+def batch_vms(jobs):
+    return [
+        {
+            "key": f"job_{job.id}_{index}",
+            "name": f"{job.vm_name}-{index}",
+            "cpu": job.cpu,
+            "memory": job.memory,
+        }
+        for job in jobs
+        for index in range(1, job.vm_count + 1)
+    ]
+
+
+def render_batch(jobs):
+    """Terraform configuration of a batch; a single job uses its own template."""
+    registry = get_registry()
+    job = jobs[0]
+    context = dict(
+        vsphere_user=settings.VSPHERE_USER,
+        vsphere_password=settings.VSPHERE_PASSWORD,
+        vsphere_server=settings.VSPHERE_SERVER,
+        datacenter=job.datacenter.name,
+        cluster=job.cluster.name,
+        datastore=job.datastore,
+        network=job.network.name,
+    )
+    if len(jobs) == 1:
+        return registry.render(
+            job.template,
+            vm_name=job.vm_name,
+            cpu=job.cpu,
+            memory=job.memory,
+            vm_count=job.vm_count,
+            **context,
+        )
+    return registry.render(registry.batch_template(job.template), vms=batch_vms(jobs), **context)
+
+
+def split_plan(output, job_ids):
+    """
+    Split the plan output of a batch by job: `{job_id: text}` with the
+    resource blocks of the job's VMs followed by the plan summary. A job
+    without blocks of its own (and a batch of one) gets the whole output.
+    """
+    if len(job_ids) == 1:
+        return {job_ids[0]: output}
+    sections = {job_id: [] for job_id in job_ids}
+    summary, current = [], None
+    for line in output.splitlines(keepends=True):
+        header = RESOURCE_HEADER.match(line)
+        if header:
+            address = JOB_ADDRESS.search(header.group(1))
+            current = sections.get(int(address.group(1))) if address else None
+        elif line.startswith(PLAN_SUMMARY):
+            current = None
+            summary.append(line)
+        if current is not None:
+            current.append(line)
+    return {
+        job_id: "".join(lines + summary) if lines else output
+        for job_id, lines in sections.items()
+    }
@@ -0,0 +1,128 @@
+"""
+Set-level validation helpers for the bulk endpoints.
+
+Each helper receives the items that passed per-item validation as
+`(index, attrs, instance)` tuples and returns `{index: {field: [errors]}}`.
+They run a fixed number of queries whatever the size of the batch.
+"""
+
+import ipaddress
+from collections import defaultdict
+
+from django.core.exceptions import ValidationError
+from django.db.models.functions import Lower
+
+from .models import Network, Server
+from .serializers import PreloadedPrimaryKeyRelatedField
+
+
+def merge_errors(errors, extra):
+    """Merge `{index: {field: [errors]}}` into a list or dict of per-item errors."""
+    for index, fields in extra.items():
+        target = errors[index] if isinstance(errors, list) else errors.setdefault(index, {})
+        for field, messages in fields.items():
+            target.setdefault(field, []).extend(messages)
+
+
+def preload_related(serializer, items):
+    """
+    Fetch every object referenced by `items` through a preloadable relation.
+
+    Returns `{model: {pk: instance}}`, using one query per related model.
+    """
+    preloaded = {}
+    for field in serializer.fields.values():
+        if not isinstance(field, PreloadedPrimaryKeyRelatedField) or field.read_only:
+            continue
+        model = field.get_queryset().model
+        pks = set()
+        for item in items:
+            value = item.get(field.field_name) if isinstance(item, dict) else None
+            try:
+                if value is not None and not isinstance(value, bool):
+                    pks.add(model._meta.pk.to_python(value))
+            except (TypeError, ValueError, ValidationError):
+                continue
+        preloaded.setdefault(model, {}).update(field.get_queryset().in_bulk(pks))
+    return preloaded
+
+
+def _value(attrs, instance, field):
+    if field in attrs:
+        return attrs[field]
+    return getattr(instance, field, None)
+
+
+def serial_number_collisions(model, rows, label):
+    """
+    Find case-insensitive serial number clashes within the batch and with
+    existing rows of `model`.
+    """
+    errors = {}
+    by_serial = defaultdict(list)
+    for index, attrs, instance in rows:
+        serial = _value(attrs, instance, "serial_number")
+        if serial:
+            by_serial[serial.lower()].append((index, instance))
+
+    existing = defaultdict(set)
+    for pk, serial in (
+        model.objects.annotate(serial_lower=Lower("serial_number"))
+        .filter(serial_lower__in=list(by_serial))
+        .values_list("pk", "serial_lower")
+    ):
+        existing[serial].add(pk)
+
+    for serial, entries in by_serial.items():
+        for index, instance in entries:
+            others = existing[serial] - {getattr(instance, "pk", None)}
+            if others or len(entries) > 1:
+                errors[index] = {
+                    "serial_number": [f"A {label} with this serial number already exists."]
+                }
+    return errors
+
+
+def ip_address_conflicts(rows):
+    """
+    Find servers in the batch that reuse an IP address, either among
+    themselves or with existing servers, or whose address is outside the
+    subnet of their network.
+    """
+    errors = {}
+    by_ip = defaultdict(list)
+    for index, attrs, instance in rows:
+        ip_address = _value(attrs, instance, "ip_address")
+        if ip_address:
+            by_ip[ip_address].append((index, instance))
+
+    existing = defaultdict(set)
+    for pk, ip_address in Server.objects.filter(ip_address__in=list(by_ip)).values_list(
+        "pk", "ip_address"
+    ):
+        existing[ip_address].add(pk)
+
+    for ip_address, entries in by_ip.items():
+        for index, instance in entries:
+            others = existing[ip_address] - {getattr(instance, "pk", None)}
+            if others or len(entries) > 1:
+                errors[index] = {"ip_address": [f"{ip_address} is already assigned."]}
+
+    # Networks of updated rows that did not send one are fetched in one query
+    missing = {
+        instance.network_id
+        for _, attrs, instance in rows
+        if instance is not None and "network" not in attrs and instance.network_id
+    }
+    networks = Network.objects.in_bulk(missing)
+    for index, attrs, instance in rows:
+        ip_address = _value(attrs, instance, "ip_address")
+        network = attrs["network"] if "network" in attrs else networks.get(
+            getattr(instance, "network_id", None)
+        )
+        if ip_address and network and index not in errors:
+            if ipaddress.ip_address(ip_address) not in network.get_subnet():
+                errors[index] = {
+                    "ip_address": [f"{ip_address} is not within subnet {network.cidr}"]
+                }
+    return errors
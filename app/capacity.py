@@ -0,0 +1,188 @@
+"""
+Incremental maintenance of `CapacitySummary`.
+
+Every Server and DiskArray contributes its CPU, RAM and storage to one
+bucket, keyed by (datacenter, cluster, resource type, status). Saves and
+deletes compare the previous and new bucket of an instance and apply the
+difference with `F()` updates, so reading the capacity of a datacenter
+never touches the inventory tables.
+"""
+
+from collections import defaultdict
+
+from django.apps import apps as global_apps
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+
+from .models import CapacityResourceType, CapacitySummary, DiskArray, Server
+
+METRICS = ("count", "cpu", "ram", "storage")
+
+SNAPSHOT_ATTR = "_capacity_state"
+
+RESOURCE_TYPES = {
+    Server: CapacityResourceType.SERVER,
+    DiskArray: CapacityResourceType.DISK_ARRAY,
+}
+
+
+def capacity_state(instance):
+    """
+    Return `(bucket, (count, cpu, ram, storage))` for a saved instance, or
+    None when it does not count (unsaved) or its fields were deferred.
+    """
+    values = instance.__dict__
+    fields = ["datacenter_id", "status", "storage"]
+    if isinstance(instance, Server):
+        fields += ["cluster_id", "cpu", "ram"]
+    if instance.pk is None or any(field not in values for field in fields):
+        return None
+
+    bucket = (
+        values["datacenter_id"],
+        values.get("cluster_id"),
+        RESOURCE_TYPES[type(instance)],
+        values["status"],
+    )
+    return bucket, (1, values.get("cpu") or 0, values.get("ram") or 0, values["storage"] or 0)
+
+
+def snapshot(instance):
+    setattr(instance, SNAPSHOT_ATTR, capacity_state(instance))
+
+
+def previous_state(instance):
+    """State of `instance` when it was loaded or last saved."""
+    return getattr(instance, SNAPSHOT_ATTR, None)
+
+
+def apply_changes(changes):
+    """
+    Apply `(old_state, new_state)` pairs, merging deltas per bucket so each
+    bucket is written once whatever the number of instances.
+    """
+    deltas = defaultdict(lambda: [0, 0, 0, 0])
+    for old, new in changes:
+        if old == new:
+            continue
+        for state, sign in ((old, -1), (new, 1)):
+            if state is None:
+                continue
+            bucket, values = state
+            for index, value in enumerate(values):
+                deltas[bucket][index] += sign * value
+
+    for bucket, delta in deltas.items():
+        if any(delta):
+            apply_delta(bucket, delta)
+
+
+def apply_delta(bucket, delta):
+    datacenter_id, cluster_id, resource_type, status = bucket
+    key = dict(
+        datacenter_id=datacenter_id,
+        cluster_id=cluster_id,
+        resource_type=resource_type,
+        status=status,
+    )
+    update = {metric: F(metric) + value for metric, value in zip(METRICS, delta)}
+    if CapacitySummary.objects.filter(**key).update(**update):
+        return
+    # Removing from a bucket that does not exist only happens while its
+    # datacenter or cluster is being deleted; there is nothing to update.
+    if delta[0] <= 0:
+        return
+    try:
+        with transaction.atomic():
+            CapacitySummary.objects.create(**key, **dict(zip(METRICS, delta)))
+    except IntegrityError:
+        # Created concurrently by another writer
+        CapacitySummary.objects.filter(**key).update(**update)
+
+
+def move_cluster_to_datacenter(cluster):
+    """
+    Fold the buckets of a cluster being deleted into the cluster-less
+    buckets of its datacenter, where its servers end up (`SET_NULL`).
+    """
+    changes = []
+    for row in CapacitySummary.objects.filter(cluster=cluster):
+        values = tuple(getattr(row, metric) for metric in METRICS)
+        old = (row.datacenter_id, row.cluster_id, row.resource_type, row.status)
+        new = (row.datacenter_id, None, row.resource_type, row.status)
+        changes.append(((old, values), (new, values)))
+    apply_changes(changes)
+
+
+def summarize(rows):
+    """Aggregate `CapacitySummary` rows into totals and per-status totals."""
+    result = {}
+    labels = {CapacityResourceType.SERVER: "servers", CapacityResourceType.DISK_ARRAY: "disk_arrays"}
+    for resource_type, label in labels.items():
+        by_status = {}
+        for row in rows:
+            if row["resource_type"] != resource_type:
+                continue
+            totals = by_status.setdefault(row["status"], dict.fromkeys(METRICS, 0))
+            for metric in METRICS:
+                totals[metric] += row[metric]
+        total = dict.fromkeys(METRICS, 0)
+        for totals in by_status.values():
+            for metric in METRICS:
+                total[metric] += totals[metric]
+        result[label] = {
+            "total": total,
+            "available": by_status.get("available", dict.fromkeys(METRICS, 0)),
+            "by_status": by_status,
+        }
+    return result
+
+
+def read_capacity(**filters):
+    rows = (
+        CapacitySummary.objects.filter(**filters)
+        .values("resource_type", "status")
+        .annotate(**{f"sum_{metric}": Sum(metric) for metric in METRICS})
+        .order_by()
+    )
+    return summarize([
+        {
+            "resource_type": row["resource_type"],
+            "status": row["status"],
+            **{metric: row[f"sum_{metric}"] for metric in METRICS},
+        }
+        for row in rows
+    ])
+
+
+def rebuild(apps=global_apps):
+    """Recompute every bucket from the inventory tables."""
+    Summary = apps.get_model("app", "CapacitySummary")
+    sources = (
+        (apps.get_model("app", "Server"), CapacityResourceType.SERVER, True),
+        (apps.get_model("app", "DiskArray"), CapacityResourceType.DISK_ARRAY, False),
+    )
+    rows = []
+    for model, resource_type, has_compute in sources:
+        group_by = ["datacenter_id", "status"] + (["cluster_id"] if has_compute else [])
+        aggregates = {"total_storage": Sum("storage")}
+        if has_compute:
+            aggregates.update(total_cpu=Sum("cpu"), total_ram=Sum("ram"))
+        for group in model.objects.values(*group_by).annotate(
+            total_count=Count("pk"), **aggregates
+        ).order_by():
+            rows.append(Summary(
+                datacenter_id=group["datacenter_id"],
+                cluster_id=group.get("cluster_id"),
+                resource_type=resource_type,
+                status=group["status"],
+                count=group["total_count"],
+                cpu=group.get("total_cpu") or 0,
+                ram=group.get("total_ram") or 0,
+                storage=group["total_storage"] or 0,
+            ))
+
+    with transaction.atomic():
+        Summary.objects.all().delete()
+        Summary.objects.bulk_create(rows)
+    return len(rows)
@@ -0,0 +1,75 @@
+"""
+Conditional GET support (`ETag`, `Last-Modified` and 304 responses).
+
+Validators of objects are computed from `updated_at`, so checking whether
+a client is up to date costs one indexed lookup instead of serializing the
+object. Pages of a list are validated by a digest of their body, which
+costs no query on top of the page but needs the page: a 304 for a page
+that is not in the response cache only saves sending the body. Pages have
+no `Last-Modified`.
+"""
+
+import hashlib
+from functools import wraps
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+
+
+def digest(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def make_etag(request, *state):
+    """
+    Strong ETag for `request` given the state of the data behind it.
+
+    The path, query parameters and the caller's role are part of the tag
+    since they all change the representation.
+    """
+    role = getattr(request.user, "role", None) or "anonymous"
+    params = sorted(request.GET.lists())
+    raw = repr((request.path, params, role, state))
+    return quote_etag(hashlib.sha256(raw.encode()).hexdigest())
+
+
+def not_modified(request, etag, last_modified):
+    """Return a 304 response if the client's copy is current, else None."""
+    # HTTP dates have a resolution of one second
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    return get_conditional_response(request, etag=etag, last_modified=timestamp)
+
+
+def set_validators(response, etag, last_modified):
+    if response.status_code in (200, 304):
+        response["ETag"] = etag
+        if last_modified:
+            response["Last-Modified"] = http_date(last_modified.timestamp())
+    return response
+
+
+def validate_page(request, response):
+    """Tag the rendered page `response` with the digest of its body, or answer 304."""
+    etag = make_etag(request, digest(response.content))
+    return set_validators(not_modified(request, etag, None) or response, etag, None)
+
+
+def page_condition(view):
+    """
+    Conditional GET for a function-based DRF view, from the page it returns.
+
+    Only complete bodies are validated: streamed pages get their ETag once
+    they are served from the response cache, so apply it above
+    `response_cache.cached_response` (and below `@api_view`).
+    """
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        # DRF responses are only rendered after the view returns
+        if response.status_code != 200 or response.streaming or isinstance(response, Response):
+            return response
+        return validate_page(request, response)
+
+    return wrapper
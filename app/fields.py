@@ -0,0 +1,89 @@
+import ipaddress
+
+from django.db import NotSupportedError, models
+
+
+class CidrField(models.CharField):
+    """
+    Network address stored as a native `cidr` column on PostgreSQL and as
+    text elsewhere.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("max_length", 43)
+        super().__init__(*args, **kwargs)
+
+    def db_type(self, connection):
+        if connection.vendor == "postgresql":
+            return "cidr"
+        return super().db_type(connection)
+
+
+class InetAddressField(models.GenericIPAddressField):
+    """
+    IP address stored as `inet` on PostgreSQL. Unlike a plain
+    `GenericIPAddressField` it supports the network lookups below.
+    """
+
+
+class NetworkLookup(models.Lookup):
+    """
+    PostgreSQL inet/cidr operator lookups, usable with a GiST `inet_ops`
+    index. Other backends should use the integer ranges on `Network`.
+    """
+
+    operator = None
+    prepare_rhs = False
+
+    def get_db_prep_lookup(self, value, connection):
+        return "%s", [str(value)]
+
+    def as_sql(self, compiler, connection):
+        raise NotSupportedError(
+            f"The {self.lookup_name} lookup is only supported on PostgreSQL."
+        )
+
+    def as_postgresql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} {self.operator} {rhs}::inet", lhs_params + rhs_params
+
+
+@CidrField.register_lookup
+@InetAddressField.register_lookup
+class NetContains(NetworkLookup):
+    lookup_name = "net_contains"
+    operator = ">>="
+
+
+@CidrField.register_lookup
+@InetAddressField.register_lookup
+class NetContainedBy(NetworkLookup):
+    lookup_name = "net_contained_by"
+    operator = "<<="
+
+
+@CidrField.register_lookup
+@InetAddressField.register_lookup
+class NetOverlaps(NetworkLookup):
+    lookup_name = "net_overlaps"
+    operator = "&&"
+
+
+def address_key(address):
+    """
+    Encode an address as a fixed-width hex string that sorts like the
+    integer value. IPv4 addresses are mapped into ::ffff:0:0/96 so both
+    families share one key space.
+    """
+    address = ipaddress.ip_address(address)
+    value = int(address)
+    if address.version == 4:
+        value += 0xFFFF << 32
+    return f"{value:032x}"
+
+
+def network_keys(cidr):
+    """Return the `(first, last)` address keys of a CIDR."""
+    network = ipaddress.ip_network(cidr, strict=False)
+    return address_key(network.network_address), address_key(network.broadcast_address)
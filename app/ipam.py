@@ -0,0 +1,165 @@
+"""
+IP address management for `Network`.
+
+The addresses in use in a network (allocations, server addresses and the
+gateway) are read with one query and turned into sorted integer offsets
+from the start of the CIDR. Free addresses are the gaps between those
+offsets, so finding N free addresses walks the gaps instead of probing the
+database one address at a time.
+"""
+
+import ipaddress
+
+from django.db import transaction
+
+from .models import IPAllocation, Network, Server
+
+
+class AddressPoolExhausted(Exception):
+    pass
+
+
+def host_bounds(subnet):
+    """
+    Return the first and last usable offsets of `subnet`.
+
+    Matches `ipaddress` host semantics: IPv4 networks larger than /31 lose
+    their network and broadcast addresses, IPv6 networks their
+    subnet-router anycast address.
+    """
+    last = subnet.num_addresses - 1
+    if subnet.version == 4 and subnet.prefixlen < 31:
+        return 1, last - 1
+    if subnet.version == 6 and subnet.prefixlen < 127:
+        return 1, last
+    return 0, last
+
+
+def used_offsets(network):
+    """Return the sorted offsets of every address in use in `network`."""
+    subnet = network.get_subnet()
+    base = int(subnet.network_address)
+
+    addresses = IPAllocation.objects.filter(network=network).values_list("address")
+    addresses = addresses.union(
+        Server.objects.filter(network=network, ip_address__isnull=False).values_list(
+            "ip_address"
+        ),
+        all=True,
+    )
+    used = {address for (address,) in addresses}
+    if network.gateway:
+        used.add(network.gateway)
+
+    offsets = set()
+    for address in used:
+        address = ipaddress.ip_address(address)
+        if address.version == subnet.version and address in subnet:
+            offsets.add(int(address) - base)
+    return sorted(offsets)
+
+
+def free_ranges(network, used=None):
+    """Yield `(first, last)` offset ranges of free addresses in `network`."""
+    first, last = host_bounds(network.get_subnet())
+    if used is None:
+        used = used_offsets(network)
+
+    start = first
+    for offset in used:
+        if offset < start:
+            continue
+        if offset > last:
+            break
+        if offset > start:
+            yield start, offset - 1
+        start = offset + 1
+    if start <= last:
+        yield start, last
+
+
+def next_free(network, count=1, used=None):
+    """
+    Return the lowest `count` free addresses of `network`.
+
+    Raises `AddressPoolExhausted` when the network has fewer free addresses.
+    """
+    subnet = network.get_subnet()
+    base = int(subnet.network_address)
+    addresses = []
+    for first, last in free_ranges(network, used):
+        take = min(count - len(addresses), last - first + 1)
+        addresses.extend(
+            str(ipaddress.ip_address(base + offset)) for offset in range(first, first + take)
+        )
+        if len(addresses) == count:
+            return addresses
+    raise AddressPoolExhausted(
+        f"{network.cidr} has only {len(addresses)} free address(es), {count} requested."
+    )
+
+
+def allocate(network, count=1, deployment_job=None):
+    """
+    Allocate the lowest `count` free addresses of `network`.
+
+    The network row is locked for the duration of the allocation so
+    concurrent requests are serialized, also with server writes (see
+    `assignment_conflicts`); the unique constraint on (network, address)
+    guards backends without row locks.
+    """
+    with transaction.atomic():
+        network = Network.objects.select_for_update().get(pk=network.pk)
+        addresses = next_free(network, count)
+        return IPAllocation.objects.bulk_create(
+            IPAllocation(network=network, address=address, deployment_job=deployment_job)
+            for address in addresses
+        )
+
+
+def assignment_conflicts(assignments):
+    """
+    Check server addresses against the allocations and servers of their
+    networks. `assignments` are `(key, network_id, address, server_pk)`
+    tuples; returns `{key: message}` for the conflicting ones.
+
+    Must run inside the transaction that writes the servers: the networks
+    are locked like `allocate` locks them, so an address cannot be
+    allocated and assigned to a server at the same time.
+    """
+    assignments = [
+        (key, network_id, str(ipaddress.ip_address(address)), pk)
+        for key, network_id, address, pk in assignments
+        if network_id and address
+    ]
+    if not assignments:
+        return {}
+    network_ids = sorted({network_id for _, network_id, _, _ in assignments})
+    # Locked in a fixed order so concurrent writers cannot deadlock
+    list(Network.objects.select_for_update().filter(pk__in=network_ids).order_by("pk").values_list("pk"))
+
+    addresses = {address for _, _, address, _ in assignments}
+    allocated = set(
+        IPAllocation.objects.filter(network_id__in=network_ids, address__in=addresses).values_list(
+            "network_id", "address"
+        )
+    )
+    assigned = {}
+    for pk, network_id, address in Server.objects.filter(
+        network_id__in=network_ids, ip_address__in=addresses
+    ).values_list("pk", "network_id", "ip_address"):
+        assigned.setdefault((network_id, str(ipaddress.ip_address(address))), set()).add(pk)
+
+    conflicts = {}
+    for key, network_id, address, pk in assignments:
+        if (network_id, address) in allocated:
+            conflicts[key] = f"{address} is allocated in this network."
+        elif assigned.get((network_id, address), set()) - {pk}:
+            conflicts[key] = f"{address} is already assigned."
+    return conflicts
+
+
+def release(network, addresses):
+    """Release `addresses` in `network`. Returns the number released."""
+    deleted, _ = IPAllocation.objects.filter(network=network, address__in=addresses).delete()
+    return deleted
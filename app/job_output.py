@@ -0,0 +1,152 @@
+"""
+Live output of deployment jobs.
+
+Terraform runs with its output on a pipe that the task reads line by line.
+Lines are sent in small batches, and whatever is pending is sent as soon as
+the pipe goes quiet, so a slow provider call never holds back the line
+announcing it. Each line goes to the job's log file, which is uploaded to MinIO as
+before, and to a Redis stream per job, which clients tail through
+`DeploymentJobOutputView`. Stream entry ids are the resume offsets. Jobs
+planned as one batch share their output, so each of their streams gets
+every line.
+
+A stream ends with an `end` entry carrying the final job status and
+expires `OUTPUT_RETENTION` seconds later; the MinIO log stays the
+permanent record. Redis errors never fail a job: streaming stops and the
+log file is still written.
+"""
+
+import logging
+import os
+import selectors
+import subprocess
+import time
+
+from .redis_client import get_redis
+from .terraform_pool import terraform_env
+
+logger = logging.getLogger(__name__)
+
+# Entries kept per stream; older lines are trimmed (approximately)
+OUTPUT_MAXLEN = 20000
+OUTPUT_RETENTION = 60 * 60 * 24
+
+# Lines are sent in batches of this size, or after this many seconds, or
+# when no output arrives for this many seconds
+FLUSH_LINES = 50
+FLUSH_INTERVAL = 0.25
+READ_SIZE = 65536
+
+
+def stream_key(job_id):
+    return f"deployment:{job_id}:output"
+
+
+class TerraformOutput:
+    """Runs Terraform commands for one job or a batch, teeing their output."""
+
+    def __init__(self, job_ids, log_file):
+        self.job_ids = [job_ids] if isinstance(job_ids, int) else list(job_ids)
+        self.log_file = log_file
+        self.keys = [stream_key(job_id) for job_id in self.job_ids]
+        self.enabled = True
+        self.pending = []
+        self.flushed_at = time.monotonic()
+
+    def run(self, args, cwd):
+        process = subprocess.Popen(
+            args,
+            cwd=cwd,
+            env=terraform_env(),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        with process, selectors.DefaultSelector() as selector:
+            selector.register(process.stdout, selectors.EVENT_READ)
+            fd = process.stdout.fileno()
+            partial = b""
+            while True:
+                # Flush before blocking on a quiet pipe
+                if self.pending and not selector.select(FLUSH_INTERVAL):
+                    self.flush()
+                chunk = os.read(fd, READ_SIZE)
+                if not chunk:
+                    break
+                *lines, partial = (partial + chunk).split(b"\n")
+                for line in lines:
+                    self.write(line.decode(errors="replace") + "\n")
+            if partial:
+                self.write(partial.decode(errors="replace"))
+        self.flush()
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, args)
+
+    def write(self, line):
+        self.log_file.write(line)
+        self.pending.append(line.rstrip("\n"))
+        if (
+            len(self.pending) >= FLUSH_LINES
+            or time.monotonic() - self.flushed_at >= FLUSH_INTERVAL
+        ):
+            self.flush()
+
+    def flush(self):
+        lines, self.pending = self.pending, []
+        self.flushed_at = time.monotonic()
+        if lines:
+            self.publish([{"line": line} for line in lines])
+
+    def close(self, status):
+        """Mark the stream finished with the final job `status`."""
+        self.flush()
+        self.publish([{"event": "end", "status": status}], expire=True)
+
+    def publish(self, entries, expire=False):
+        if not self.enabled:
+            return
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            for key in self.keys:
+                for fields in entries:
+                    pipe.xadd(key, fields, maxlen=OUTPUT_MAXLEN, approximate=True)
+                if expire:
+                    pipe.expire(key, OUTPUT_RETENTION)
+            pipe.execute()
+        except Exception as exc:
+            job_ids = ", ".join(map(str, self.job_ids))
+            logger.warning("Streaming output of job %s stopped: %s", job_ids, exc)
+            self.enabled = False
+
+
+def read_output(job_id, after="0-0", count=500, block_ms=None):
+    """
+    Read the output of a job after the stream id `after`, waiting up to
+    `block_ms` for new lines when there are none yet.
+
+    Returns `(lines, last_id, status)`: `lines` are `(id, text)` pairs,
+    `last_id` is the offset to resume from and `status` is the final job
+    status once the stream has ended, else None.
+    """
+    client = get_redis()
+    key = stream_key(job_id)
+    response = client.xread({key: after}, count=count, block=block_ms)
+
+    lines, last_id, status = [], after, None
+    for _, messages in response or ():
+        for entry_id, fields in messages:
+            last_id = entry_id
+            if fields.get("event") == "end":
+                status = fields.get("status")
+                break
+            lines.append((entry_id, fields.get("line", "")))
+
+    if not response:
+        # A client resuming after the end entry has nothing left to read
+        latest = client.xrevrange(key, count=1)
+        if latest and latest[0][1].get("event") == "end":
+            status = latest[0][1].get("status")
+    return lines, last_id, status
+
+
+def output_exists(job_id):
+    return bool(get_redis().exists(stream_key(job_id)))
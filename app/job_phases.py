@@ -0,0 +1,54 @@
+"""
+Timeline of deployment runs.
+
+A run times its phases (render, upload, init, plan, finalize) with
+`PhaseRecorder.phase` and writes them once it is over, one
+`DeploymentJobPhase` row per phase and job, so a batch costs a single
+INSERT. Phases are recorded for the jobs the run was working on when the
+phase started; `init` only appears when a working directory had to be
+initialized. Each phase is also observed once in the
+`deployment_phase_duration_seconds` metric.
+"""
+
+import time
+from contextlib import contextmanager
+
+from django.utils import timezone
+
+from .metrics import DEPLOYMENT_PHASE_DURATION
+from .models import DeploymentJobPhase
+
+
+class PhaseRecorder:
+    def __init__(self, job_ids):
+        self.job_ids = list(job_ids)
+        self.records = []
+
+    @contextmanager
+    def phase(self, name):
+        job_ids = list(self.job_ids)
+        started_at, start = timezone.now(), time.monotonic()
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            duration = time.monotonic() - start
+            DEPLOYMENT_PHASE_DURATION.labels(name, "true" if succeeded else "false").observe(duration)
+            self.records.append((job_ids, name, started_at, timezone.now(), duration, succeeded))
+
+    def save(self):
+        phases = [
+            DeploymentJobPhase(
+                job_id=job_id,
+                phase=name,
+                started_at=started_at,
+                finished_at=finished_at,
+                duration=duration,
+                succeeded=succeeded,
+            )
+            for job_ids, name, started_at, finished_at, duration, succeeded in self.records
+            for job_id in job_ids
+        ]
+        self.records = []
+        DeploymentJobPhase.objects.bulk_create(phases)
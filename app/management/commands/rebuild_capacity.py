@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from app.capacity import rebuild
+
+
+class Command(BaseCommand):
+    help = "Recompute the capacity summary from the server and disk array tables."
+
+    def handle(self, *args, **options):
+        buckets = rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {buckets} capacity bucket(s)."))
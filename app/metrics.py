@@ -0,0 +1,184 @@
+"""
+Prometheus metrics, served at `/metrics`.
+
+Metrics are plain `prometheus_client` objects updated in place, which is a
+lock and an addition per sample. With several web or Celery worker
+processes, set `PROMETHEUS_MULTIPROC_DIR` to an empty directory shared by
+all of them (and cleared on deploy) before they start: every process then
+writes its samples to memory-mapped files there and `/metrics` aggregates
+them. Without it each process only reports its own samples.
+
+Celery queue lengths are read from the broker when `/metrics` is scraped,
+so no process has to keep them up to date.
+"""
+
+import hmac
+import os
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+from .redis_client import get_redis
+
+# Terraform phases and queue waits take seconds to minutes
+LONG_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time to produce a response (the first chunk for streaming responses).",
+    ["method", "route", "status"],
+)
+REQUEST_QUERIES = Histogram(
+    "http_request_db_queries",
+    "Database queries run per request.",
+    ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+DEPLOYMENT_PHASE_DURATION = Histogram(
+    "deployment_phase_duration_seconds",
+    "Duration of the phases of deployment runs, see app.job_phases.",
+    ["phase", "succeeded"],
+    buckets=LONG_BUCKETS,
+)
+DEPLOYMENT_QUEUE_WAIT = Histogram(
+    "deployment_queue_wait_seconds",
+    "Time from submitting a deployment job to a worker picking it up.",
+    buckets=LONG_BUCKETS,
+)
+MINIO_BYTES = Counter(
+    "minio_transferred_bytes_total",
+    "Bytes uploaded to and downloaded from MinIO.",
+    ["direction"],
+)
+MINIO_LATENCY = Histogram(
+    "minio_request_duration_seconds",
+    "Duration of MinIO uploads and downloads.",
+    ["operation"],
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Cache lookups by cache and result (hit or miss).",
+    ["cache", "result"],
+)
+
+
+def count_cache(cache, hit):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+class QueryCounter:
+    """Database execute wrapper counting the queries it sees."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def observe_first_chunk(chunks, observe):
+    """Yield `chunks`, calling `observe` once the first one is ready (or there is none)."""
+    observed = False
+    try:
+        for chunk in chunks:
+            if not observed:
+                observe()
+                observed = True
+            yield chunk
+    finally:
+        if not observed:
+            observe()
+
+
+class MetricsMiddleware:
+    """
+    Records the latency and query count of every request, by route.
+    Streaming responses are timed until their first chunk; their query
+    count only covers the queries run before streaming starts.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+
+        # The URL pattern, not the path, keeps the number of series bounded
+        match = request.resolver_match
+        route = match.route if match is not None else "<unmatched>"
+        latency = REQUEST_LATENCY.labels(request.method, route, str(response.status_code))
+
+        def observe():
+            latency.observe(time.perf_counter() - start)
+
+        if response.streaming and not getattr(response, "is_async", False):
+            response.streaming_content = observe_first_chunk(response.streaming_content, observe)
+        else:
+            observe()
+        REQUEST_QUERIES.labels(route).observe(queries.count)
+        return response
+
+
+class QueueLengthCollector:
+    """Length of each Celery queue, read from the Redis broker."""
+
+    def queues(self):
+        routes = getattr(settings, "CELERY_TASK_ROUTES", {})
+        return sorted({"celery", *(route["queue"] for route in routes.values())})
+
+    def family(self):
+        return GaugeMetricFamily("celery_queue_length", "Messages waiting in a Celery queue.", labels=["queue"])
+
+    def describe(self):
+        # Lets the registry check names without querying the broker
+        yield self.family()
+
+    def collect(self):
+        metric = self.family()
+        queues = self.queues()
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            for queue in queues:
+                pipe.llen(queue)
+            lengths = pipe.execute()
+        except Exception:
+            # The queue lengths are missing from this scrape
+            lengths = []
+        for queue, length in zip(queues, lengths):
+            metric.add_metric([queue], length)
+        yield metric
+
+
+_registry = None
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        registry.register(QueueLengthCollector())
+        _registry = registry
+    return _registry
+
+
+def metrics_view(request):
+    """Prometheus text format. Requires `Bearer METRICS_TOKEN`; disabled while it is empty."""
+    token = settings.METRICS_TOKEN
+    if not token or not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {token}"
+    ):
+        return HttpResponseForbidden()
+    return HttpResponse(generate_latest(get_registry()), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,56 @@
+"""
+TOTP provisioning QR codes.
+
+Rendering a QR code is CPU-heavy and its output only depends on the user
+and their TOTP secret, so rendered images are cached under a key derived
+from both. Rotating the secret changes the key; stale images expire.
+"""
+
+import hashlib
+from io import BytesIO
+
+import pyotp
+import qrcode
+from django.core.cache import cache
+from qrcode.image.svg import SvgPathImage
+
+from .metrics import count_cache
+
+ISSUER_NAME = "Inventory App"
+
+QR_CONTENT_TYPES = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+}
+
+QR_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def provisioning_uri(user):
+    return pyotp.TOTP(user.totp_secret).provisioning_uri(name=user.email, issuer_name=ISSUER_NAME)
+
+
+def qr_digest(user, image_format):
+    """Identifies the QR image of a user; also used as its ETag."""
+    raw = f"{user.pk}:{user.totp_secret}:{image_format}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def render_qr(uri, image_format):
+    buffer = BytesIO()
+    if image_format == "svg":
+        qrcode.make(uri, image_factory=SvgPathImage).save(buffer)
+    else:
+        qrcode.make(uri).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def qr_image(user, image_format="png"):
+    """Return the rendered provisioning QR code of `user` as bytes."""
+    key = f"mfa:qr:{qr_digest(user, image_format)}"
+    image = cache.get(key)
+    count_cache("mfa_qr", image is not None)
+    if image is None:
+        image = render_qr(provisioning_uri(user), image_format)
+        cache.set(key, image, QR_CACHE_TIMEOUT)
+    return image
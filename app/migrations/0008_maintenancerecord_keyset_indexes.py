@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0007_deploymentjob_vm_count"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="maintenancerecord",
+            index=models.Index(
+                fields=["performed_at", "id"], name="maint_performed_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="maintenancerecord",
+            index=models.Index(
+                fields=["datacenter", "performed_at", "id"],
+                name="maint_dc_performed_id_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:13
+
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0008_maintenancerecord_keyset_indexes"),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name="datacenter",
+            constraint=models.UniqueConstraint(
+                django.db.models.functions.text.Lower("name"),
+                name="app_datacenter_name_ci_unique",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="diskarray",
+            constraint=models.UniqueConstraint(
+                django.db.models.functions.text.Lower("serial_number"),
+                name="app_diskarray_serial_number_ci_unique",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="server",
+            constraint=models.UniqueConstraint(
+                django.db.models.functions.text.Lower("serial_number"),
+                name="app_server_serial_number_ci_unique",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="user",
+            constraint=models.UniqueConstraint(
+                django.db.models.functions.text.Lower("email"),
+                condition=models.Q(("email", ""), _negated=True),
+                name="app_user_email_ci_unique",
+            ),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0009_case_insensitive_unique_constraints"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IPAllocation",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("address", models.GenericIPAddressField()),
+                ("allocated_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "deployment_job",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="ip_allocations",
+                        to="app.deploymentjob",
+                    ),
+                ),
+                (
+                    "network",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="allocations",
+                        to="app.network",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="ipallocation",
+            constraint=models.UniqueConstraint(
+                fields=("network", "address"),
+                name="app_ipallocation_network_address_unique",
+            ),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:16
+
+import app.fields
+from django.db import migrations, models
+
+
+def populate_ranges(apps, schema_editor):
+    Network = apps.get_model("app", "Network")
+    for network in Network.objects.all():
+        network.range_start, network.range_end = app.fields.network_keys(network.cidr)
+        network.save(update_fields=["range_start", "range_end"])
+
+
+def create_gist_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute(
+        "CREATE INDEX app_network_cidr_gist ON app_network USING gist (cidr inet_ops)"
+    )
+    schema_editor.execute(
+        "CREATE INDEX app_server_ip_address_gist ON app_server USING gist (ip_address inet_ops)"
+    )
+
+
+def drop_gist_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS app_network_cidr_gist")
+    schema_editor.execute("DROP INDEX IF EXISTS app_server_ip_address_gist")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0010_ipallocation"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="network",
+            name="range_end",
+            field=models.CharField(default="", editable=False, max_length=32),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="network",
+            name="range_start",
+            field=models.CharField(default="", editable=False, max_length=32),
+            preserve_default=False,
+        ),
+        migrations.RunPython(populate_ranges, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="network",
+            name="cidr",
+            field=app.fields.CidrField(max_length=43),
+        ),
+        migrations.AlterField(
+            model_name="server",
+            name="ip_address",
+            field=app.fields.InetAddressField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="network",
+            index=models.Index(
+                fields=["range_start", "range_end"], name="network_range_idx"
+            ),
+        ),
+        migrations.RunPython(create_gist_indexes, drop_gist_indexes),
+    ]
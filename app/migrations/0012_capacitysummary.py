@@ -0,0 +1,91 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_capacity(apps, schema_editor):
+    from app.capacity import rebuild
+
+    rebuild(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0011_network_inet_cidr"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CapacitySummary",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "resource_type",
+                    models.CharField(
+                        choices=[("server", "Server"), ("diskarray", "Disk Array")],
+                        max_length=10,
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("in_use", "In Use"),
+                            ("maintenance", "Maintenance"),
+                            ("available", "Available"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("count", models.BigIntegerField(default=0)),
+                ("cpu", models.BigIntegerField(default=0)),
+                ("ram", models.BigIntegerField(default=0)),
+                ("storage", models.BigIntegerField(default=0)),
+                (
+                    "cluster",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="capacity",
+                        to="app.cluster",
+                    ),
+                ),
+                (
+                    "datacenter",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="capacity",
+                        to="app.datacenter",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="capacitysummary",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("cluster__isnull", False)),
+                fields=("datacenter", "cluster", "resource_type", "status"),
+                name="app_capacity_cluster_bucket_unique",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="capacitysummary",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("cluster__isnull", True)),
+                fields=("datacenter", "resource_type", "status"),
+                name="app_capacity_datacenter_bucket_unique",
+            ),
+        ),
+        migrations.RunPython(build_capacity, migrations.RunPython.noop),
+    ]
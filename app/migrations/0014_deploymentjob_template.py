@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0013_updated_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="deploymentjob",
+            name="template",
+            field=models.CharField(default="vsphere_vm", max_length=100),
+        ),
+    ]
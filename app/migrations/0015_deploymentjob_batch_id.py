@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0014_deploymentjob_template"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="deploymentjob",
+            name="batch_id",
+            field=models.CharField(blank=True, db_index=True, max_length=32, null=True),
+        ),
+    ]
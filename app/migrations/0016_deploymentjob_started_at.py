@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0015_deploymentjob_batch_id"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="deploymentjob",
+            name="started_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
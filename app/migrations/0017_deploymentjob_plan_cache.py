@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0016_deploymentjob_started_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="deploymentjob",
+            name="artifact_prefix",
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name="deploymentjob",
+            name="config_hash",
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name="deploymentjob",
+            name="plan_cache_hit",
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0017_deploymentjob_plan_cache"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="deploymentjob",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("running", "Running"),
+                    ("completed", "Completed"),
+                    ("failed", "Failed"),
+                ],
+                db_index=True,
+                default="pending",
+                max_length=20,
+            ),
+        ),
+        migrations.CreateModel(
+            name="DeploymentJobPhase",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "phase",
+                    models.CharField(
+                        choices=[
+                            ("render", "Render"),
+                            ("upload", "Upload"),
+                            ("init", "Init"),
+                            ("plan", "Plan"),
+                            ("finalize", "Finalize"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("started_at", models.DateTimeField()),
+                ("finished_at", models.DateTimeField()),
+                ("duration", models.FloatField()),
+                ("succeeded", models.BooleanField(default=True)),
+                (
+                    "job",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="phases",
+                        to="app.deploymentjob",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["job", "started_at"], name="job_phase_job_started_idx"
+                    ),
+                    models.Index(
+                        fields=["phase", "duration"], name="job_phase_duration_idx"
+                    ),
+                ],
+            },
+        ),
+    ]
@@ -1,22 +1,215 @@
-from minio import Minio
+"""
+Object storage access.
+
+Clients are created on first use, in the process that uses them, over a
+urllib3 pool sized by `MINIO_POOL_MAXSIZE`; tests can point `get_client`
+at a local stand-in or call `reset` to start over. Buckets are checked or
+created once per process.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import urllib3
 from django.conf import settings
+from minio import Minio
+from minio.error import S3Error
 
-minio_client = Minio(
-    settings.MINIO_ENDPOINT,
-    access_key=settings.MINIO_ACCESS_KEY,
-    secret_key=settings.MINIO_SECRET_KEY,
-    secure=False
-)
+from .metrics import MINIO_BYTES, MINIO_LATENCY
 
-def upload_to_minio(bucket_name, file_path, object_name):
-    # Create bucket if it doesn't exist
-    if not minio_client.bucket_exists(bucket_name):
-        minio_client.make_bucket(bucket_name)
+_clients = {}
+_ensured_buckets = set()
+_lock = threading.Lock()
+
+
+def parse_endpoint(endpoint, secure=False):
+    """Accept `host:port` as well as `http(s)://host:port`."""
+    for scheme, is_secure in (("https://", True), ("http://", False)):
+        if endpoint.startswith(scheme):
+            return endpoint[len(scheme):].rstrip("/"), is_secure
+    return endpoint, secure
+
+
+def build_http_client():
+    return urllib3.PoolManager(
+        maxsize=settings.MINIO_POOL_MAXSIZE,
+        block=False,
+        timeout=urllib3.Timeout(
+            connect=settings.MINIO_CONNECT_TIMEOUT, read=settings.MINIO_READ_TIMEOUT
+        ),
+        retries=urllib3.Retry(
+            total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]
+        ),
+    )
+
+
+def build_client(endpoint, secure=False, region=None):
+    host, secure = parse_endpoint(endpoint, secure)
+    return Minio(
+        host,
+        access_key=settings.MINIO_ACCESS_KEY,
+        secret_key=settings.MINIO_SECRET_KEY,
+        secure=secure,
+        region=region,
+        http_client=build_http_client(),
+    )
+
+
+def _client(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+
+def get_client():
+    return _client("default", lambda: build_client(settings.MINIO_ENDPOINT))
+
+
+def get_presign_client():
+    """
+    Client used to sign URLs. Pre-signed URLs embed the host they were
+    signed for, so they are signed for the endpoint clients can reach. A
+    fixed region keeps signing local.
+    """
+    if not settings.MINIO_PUBLIC_ENDPOINT:
+        return get_client()
+    return _client(
+        "presign",
+        lambda: build_client(
+            settings.MINIO_PUBLIC_ENDPOINT,
+            secure=settings.MINIO_PUBLIC_SECURE,
+            region=settings.MINIO_REGION,
+        ),
+    )
+
+
+def reset():
+    """Forget clients and ensured buckets."""
+    with _lock:
+        _clients.clear()
+        _ensured_buckets.clear()
 
-    # Upload
-    minio_client.fput_object(bucket_name, object_name, file_path)
+
+def ensure_bucket(bucket_name):
+    if bucket_name in _ensured_buckets:
+        return
+    client = get_client()
+    if not client.bucket_exists(bucket_name):
+        try:
+            client.make_bucket(bucket_name)
+        except S3Error as e:
+            # Created concurrently by another process
+            if e.code not in ("BucketAlreadyOwnedByYou", "BucketAlreadyExists"):
+                raise
+    _ensured_buckets.add(bucket_name)
+
+
+def upload_to_minio(bucket_name, file_path, object_name):
+    ensure_bucket(bucket_name)
+    try:
+        _put(bucket_name, object_name, file_path)
+    except S3Error as e:
+        if e.code != "NoSuchBucket":
+            raise
+        # The bucket was removed since it was ensured
+        _ensured_buckets.discard(bucket_name)
+        ensure_bucket(bucket_name)
+        _put(bucket_name, object_name, file_path)
     return f"{bucket_name}/{object_name}"
 
+
+def _put(bucket_name, object_name, file_path):
+    start = time.perf_counter()
+    get_client().fput_object(
+        bucket_name,
+        object_name,
+        file_path,
+        part_size=settings.MINIO_PART_SIZE,
+        num_parallel_uploads=settings.MINIO_PARALLEL_PARTS,
+    )
+    MINIO_LATENCY.labels("upload").observe(time.perf_counter() - start)
+    MINIO_BYTES.labels("upload").inc(os.path.getsize(file_path))
+
+
+def upload_many(bucket_name, files):
+    """
+    Upload `files` (`{object_name: file_path}`) concurrently. Returns
+    `{object_name: "bucket/object_name"}`; the first failure is raised once
+    every upload has finished.
+    """
+    ensure_bucket(bucket_name)
+    workers = max(1, min(settings.MINIO_UPLOAD_WORKERS, len(files)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            object_name: executor.submit(upload_to_minio, bucket_name, file_path, object_name)
+            for object_name, file_path in files.items()
+        }
+    return {object_name: future.result() for object_name, future in futures.items()}
+
+
 def get_file_from_minio(bucket_name, object_name):
-    response = minio_client.get_object(bucket_name, object_name)
-    return response.read().decode("utf-8")
\ No newline at end of file
+    return b"".join(iter_object(bucket_name, object_name)).decode("utf-8")
+
+
+def object_size(bucket_name, object_name):
+    return get_client().stat_object(bucket_name, object_name).size
+
+
+def iter_object(bucket_name, object_name, offset=0, length=0, chunk_size=64 * 1024):
+    """
+    Yield the bytes of an object in chunks, optionally only `length` bytes
+    from `offset` (a ranged GET). The HTTP connection is returned to the
+    pool once the generator is exhausted or closed.
+    """
+    start = time.perf_counter()
+    response = get_client().get_object(bucket_name, object_name, offset=offset, length=length)
+    size = 0
+    try:
+        for chunk in response.stream(chunk_size):
+            size += len(chunk)
+            yield chunk
+    finally:
+        response.close()
+        response.release_conn()
+        MINIO_LATENCY.labels("download").observe(time.perf_counter() - start)
+        MINIO_BYTES.labels("download").inc(size)
+
+
+def read_tail(bucket_name, object_name, lines, size=None, chunk_size=64 * 1024):
+    """
+    Return the last `lines` lines of an object as bytes, reading it
+    backwards in ranged chunks so memory depends on the tail, not the size.
+    """
+    if lines <= 0:
+        return b""
+    if size is None:
+        size = object_size(bucket_name, object_name)
+    end, chunks, newlines = size, [], 0
+    # N lines need N + 1 newlines in view, as the last line usually ends with one
+    while end > 0 and newlines <= lines:
+        start = max(0, end - chunk_size)
+        chunk = b"".join(iter_object(bucket_name, object_name, start, end - start))
+        chunks.insert(0, chunk)
+        newlines += chunk.count(b"\n")
+        end = start
+    data = b"".join(chunks)
+    body = data[:-1] if data.endswith(b"\n") else data
+    return b"\n".join(body.split(b"\n")[-lines:]) + data[len(body):]
+
+
+def list_objects(bucket_name, prefix):
+    return get_client().list_objects(bucket_name, prefix=prefix, recursive=True)
+
+
+def presigned_url(bucket_name, object_name, expires):
+    """Short-lived GET URL for an object; `expires` is in seconds."""
+    return get_presign_client().presigned_get_object(
+        bucket_name, object_name, expires=timedelta(seconds=expires)
+    )
@@ -4,10 +4,13 @@ import ipaddress
 from django.contrib.auth.models import AbstractUser
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import connections, models
+from django.db.models.functions import Lower
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 
+from .fields import CidrField, InetAddressField, network_keys
+
 
 # ==============================
 # Constants and Choices
@@ -38,6 +41,29 @@ class ConnectionType(models.TextChoices):
     OTHER = "other", "Other"
 
 
+class JobStatus(models.TextChoices):
+    PENDING = "pending", "Pending"
+    RUNNING = "running", "Running"
+    COMPLETED = "completed", "Completed"
+    FAILED = "failed", "Failed"
+
+
+# Status changes a deployment job may go through, see `DeploymentJobQuerySet.transition`.
+# Running jobs go back to pending when their run expired, see `app.batching.reclaim_expired`.
+JOB_TRANSITIONS = {
+    JobStatus.PENDING: {JobStatus.RUNNING},
+    JobStatus.RUNNING: {JobStatus.COMPLETED, JobStatus.FAILED, JobStatus.PENDING},
+}
+
+
+class JobPhase(models.TextChoices):
+    RENDER = "render", "Render"
+    UPLOAD = "upload", "Upload"
+    INIT = "init", "Init"
+    PLAN = "plan", "Plan"
+    FINALIZE = "finalize", "Finalize"
+
+
 # ==============================
 # User and Authentication
 # ==============================
@@ -51,11 +77,22 @@ class User(AbstractUser):
     role = models.CharField(max_length=10, choices=Role.choices, default=Role.OPERATOR)
     mfa_enabled = models.BooleanField(default=True)
     totp_secret = models.CharField(max_length=32, blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta(AbstractUser.Meta):
+        constraints = [
+            models.UniqueConstraint(
+                Lower("email"),
+                condition=~models.Q(email=""),
+                name="app_user_email_ci_unique",
+            ),
+        ]
 
     def generate_totp_secret(self):
         if not self.totp_secret:
             self.totp_secret = pyotp.random_base32()
-            self.save()
+            # The instance may be a cached copy: leave its other fields alone
+            self.save(update_fields=["totp_secret", "updated_at"])
 
     def __str__(self):
         return self.username
@@ -68,6 +105,12 @@ class DataCenter(models.Model):
     name = models.CharField(max_length=100)
     location = models.CharField(max_length=255)
     admins = models.ManyToManyField(User, related_name="datacenters")
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(Lower("name"), name="app_datacenter_name_ci_unique"),
+        ]
 
     def __str__(self):
         return self.name
@@ -76,20 +119,74 @@ class Cluster(models.Model):
     name = models.CharField(max_length=100, unique=True)
     datacenter = models.ForeignKey(DataCenter, related_name="clusters", on_delete=models.CASCADE)
     description = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return self.name
 
+class NetworkQuerySet(models.QuerySet):
+    """
+    Containment and overlap queries on `cidr`.
+
+    PostgreSQL uses the inet operators, backed by a GiST index. Other
+    backends compare the `range_start`/`range_end` address keys.
+    """
+
+    def _native(self):
+        return connections[self.db].vendor == "postgresql"
+
+    def containing(self, address):
+        """Networks that contain `address` (an IP or a CIDR)."""
+        if self._native():
+            return self.filter(cidr__net_contains=address)
+        first, last = network_keys(address)
+        return self.filter(range_start__lte=first, range_end__gte=last)
+
+    def contained_by(self, cidr):
+        if self._native():
+            return self.filter(cidr__net_contained_by=cidr)
+        first, last = network_keys(cidr)
+        return self.filter(range_start__gte=first, range_end__lte=last)
+
+    def overlapping(self, cidr):
+        if self._native():
+            return self.filter(cidr__net_overlaps=cidr)
+        first, last = network_keys(cidr)
+        return self.filter(range_start__lte=last, range_end__gte=first)
+
+    def most_specific_first(self):
+        return self.order_by("-range_start", "range_end")
+
+
 class Network(models.Model):
     name = models.CharField(max_length=100)
     vlan_id = models.PositiveIntegerField(null=True, blank=True)
-    cidr = models.CharField(max_length=32)  # e.g. "192.168.1.0/24"
+    cidr = CidrField()  # e.g. "192.168.1.0/24"
     gateway = models.GenericIPAddressField(protocol="IPv4", null=True, blank=True)
     datacenter = models.ForeignKey(DataCenter, related_name="networks", on_delete=models.CASCADE)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    # First and last address of `cidr`, see `network_keys`
+    range_start = models.CharField(max_length=32, editable=False)
+    range_end = models.CharField(max_length=32, editable=False)
+
+    objects = NetworkQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["range_start", "range_end"], name="network_range_idx"),
+        ]
 
     def __str__(self):
         return f"{self.name} ({self.cidr})"
 
+    def save(self, *args, **kwargs):
+        self.range_start, self.range_end = network_keys(self.cidr)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "cidr" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "range_start", "range_end"}
+        super().save(*args, **kwargs)
+
     def get_subnet(self):
         return ipaddress.ip_network(self.cidr)
 
@@ -112,6 +209,29 @@ class Network(models.Model):
             raise ValidationError(f"Invalid CIDR: {self.cidr}")
 
 
+class IPAllocation(models.Model):
+    network = models.ForeignKey(Network, related_name="allocations", on_delete=models.CASCADE)
+    address = models.GenericIPAddressField(protocol="both")
+    deployment_job = models.ForeignKey(
+        "DeploymentJob",
+        related_name="ip_allocations",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+    )
+    allocated_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["network", "address"], name="app_ipallocation_network_address_unique"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.address} ({self.network.name})"
+
+
 # ==============================
 # Resource Base and Subtypes
 # ==============================
@@ -126,15 +246,21 @@ class Resource(models.Model):
         choices=AssetStatus.choices,
         default=AssetStatus.AVAILABLE,
     )
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     class Meta:
         abstract = True
+        constraints = [
+            models.UniqueConstraint(
+                Lower("serial_number"), name="app_%(class)s_serial_number_ci_unique"
+            ),
+        ]
 
 
 class Server(Resource):
     cpu = models.PositiveIntegerField()
     ram = models.PositiveIntegerField()
-    ip_address = models.GenericIPAddressField(
+    ip_address = InetAddressField(
         protocol="both",
         blank=True,
         null=True
@@ -177,6 +303,7 @@ class ServerDiskArrayMap(models.Model):
         max_length=10, choices=ConnectionType.choices, default=ConnectionType.ISCSI
     )
     mount_point = models.CharField(max_length=255, blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     class Meta:
         unique_together = ("server", "disk_array")
@@ -184,11 +311,67 @@ class ServerDiskArrayMap(models.Model):
     def __str__(self):
         return f"{self.server.serial_number} ↔ {self.disk_array.serial_number}"
 
+
+class CapacityResourceType(models.TextChoices):
+    SERVER = "server", "Server"
+    DISK_ARRAY = "diskarray", "Disk Array"
+
+
+class CapacitySummary(models.Model):
+    """
+    Running totals of servers and disk arrays per datacenter, cluster,
+    resource type and status. Kept up to date incrementally by
+    `app.capacity`; `manage.py rebuild_capacity` recomputes it.
+    """
+
+    datacenter = models.ForeignKey(
+        DataCenter, related_name="capacity", on_delete=models.CASCADE
+    )
+    cluster = models.ForeignKey(
+        Cluster, related_name="capacity", on_delete=models.CASCADE, null=True, blank=True
+    )
+    resource_type = models.CharField(max_length=10, choices=CapacityResourceType.choices)
+    status = models.CharField(max_length=20, choices=AssetStatus.choices)
+
+    count = models.BigIntegerField(default=0)
+    cpu = models.BigIntegerField(default=0)
+    ram = models.BigIntegerField(default=0)
+    storage = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["datacenter", "cluster", "resource_type", "status"],
+                condition=models.Q(cluster__isnull=False),
+                name="app_capacity_cluster_bucket_unique",
+            ),
+            models.UniqueConstraint(
+                fields=["datacenter", "resource_type", "status"],
+                condition=models.Q(cluster__isnull=True),
+                name="app_capacity_datacenter_bucket_unique",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.datacenter_id}/{self.cluster_id}/{self.resource_type}/{self.status}"
+
 # ==============================
 # Maintenance Tracking
 # ==============================
 
 
+class MaintenanceRecordQuerySet(models.QuerySet):
+    def with_resources(self):
+        """
+        Resolve `resource` for every record up front.
+
+        Records are grouped by content type and each resource model is loaded
+        with a single `IN` query, so the query count depends on the number of
+        resource types rather than the number of records.
+        """
+        return self.select_related("content_type").prefetch_related("resource")
+
+
 class MaintenanceRecord(models.Model):
     title = models.CharField(max_length=200)
     description = models.TextField()
@@ -201,6 +384,19 @@ class MaintenanceRecord(models.Model):
     datacenter = models.ForeignKey(
         DataCenter, related_name="maintenance_records", on_delete=models.CASCADE
     )
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = MaintenanceRecordQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination orders by (performed_at, id)
+            models.Index(fields=["performed_at", "id"], name="maint_performed_id_idx"),
+            models.Index(
+                fields=["datacenter", "performed_at", "id"],
+                name="maint_dc_performed_id_idx",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.title} ({self.performed_at})"
@@ -209,6 +405,24 @@ class MaintenanceRecord(models.Model):
 # VM Deployment Jobs
 # ==============================
 
+class InvalidTransition(Exception):
+    pass
+
+
+class DeploymentJobQuerySet(models.QuerySet):
+    def transition(self, source, target, **fields):
+        """
+        Move the jobs of this queryset that are `source` to `target`, also
+        setting `fields`, with a single `UPDATE ... WHERE status = source`.
+        Returns the number of jobs moved: jobs whose status was changed
+        concurrently are left alone.
+        """
+        if target not in JOB_TRANSITIONS.get(source, ()):
+            raise InvalidTransition(f"A {source} deployment job cannot become {target}.")
+        # `update` does not apply `auto_now`
+        return self.filter(status=source).update(status=target, updated_at=timezone.now(), **fields)
+
+
 class DeploymentJob(models.Model):
     name = models.CharField(max_length=255)
     vm_name = models.CharField(max_length=255)
@@ -222,15 +436,74 @@ class DeploymentJob(models.Model):
     network = models.ForeignKey("Network", null=True, blank=True, on_delete=models.SET_NULL)
 
     datastore = models.CharField(max_length=255, default="LocalDS_0")
+    # Name of a template in app/terraform_templates, see `app.template_registry`
+    template = models.CharField(max_length=100, default="vsphere_vm")
 
     minio_object = models.CharField(max_length=255, null=True, blank=True)
     plan_output = models.TextField(null=True, blank=True)
+    # SHA-256 of the planned configuration and the MinIO prefix of the
+    # artifacts, see `app.plan_cache`
+    config_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    artifact_prefix = models.CharField(max_length=255, null=True, blank=True)
+    # Whether the plan was reused from an earlier job instead of run
+    plan_cache_hit = models.BooleanField(default=False)
+    # Jobs claimed together and planned as one configuration, see `app.batching`
+    batch_id = models.CharField(max_length=32, null=True, blank=True, db_index=True)
 
-    status = models.CharField(max_length=20, default="pending")
+    status = models.CharField(
+        max_length=20, choices=JobStatus.choices, default=JobStatus.PENDING, db_index=True
+    )
     created_at = models.DateTimeField(auto_now_add=True)
+    # When a worker picked the job up; the queue wait is `started_at - created_at`
+    started_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = DeploymentJobQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.name} ({self.vm_name})"
 
+    def transition(self, target, **fields):
+        """
+        Move this job from its current status to `target`, writing only the
+        status and `fields`. Returns False, changing nothing, if the job is
+        no longer in the status it was loaded with.
+        """
+        moved = DeploymentJob.objects.filter(pk=self.pk).transition(self.status, target, **fields)
+        if moved:
+            self.status = target
+            for name, value in fields.items():
+                setattr(self, name, value)
+        return bool(moved)
+
+    @property
+    def storage_prefix(self):
+        """MinIO prefix of the job's artifacts; older jobs stored them under `job_<id>/`."""
+        return self.artifact_prefix or f"job_{self.id}/"
+
+    @property
+    def queue_wait(self):
+        if self.started_at is None:
+            return None
+        return (self.started_at - self.created_at).total_seconds()
+
+
+class DeploymentJobPhase(models.Model):
+    """How long one phase of a deployment run took, see `app.job_phases`."""
+
+    job = models.ForeignKey(DeploymentJob, related_name="phases", on_delete=models.CASCADE)
+    phase = models.CharField(max_length=20, choices=JobPhase.choices)
+    started_at = models.DateTimeField()
+    finished_at = models.DateTimeField()
+    duration = models.FloatField()  # seconds
+    succeeded = models.BooleanField(default=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["job", "started_at"], name="job_phase_job_started_idx"),
+            # Slowest runs of a phase
+            models.Index(fields=["phase", "duration"], name="job_phase_duration_idx"),
+        ]
 
+    def __str__(self):
+        return f"{self.job_id}/{self.phase} ({self.duration:.1f}s)"
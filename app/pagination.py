@@ -0,0 +1,67 @@
+import json
+
+from django.db import connections
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination over a stable, indexed ordering.
+
+    Pages are fetched with `WHERE <key> > <cursor> ORDER BY <key> LIMIT n`,
+    so the cost of a page does not depend on how deep the client has paged.
+    Pass `?count=true` to also receive an approximate total.
+    """
+
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 500
+    ordering = "id"
+    count_query_param = "count"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = None
+        if self.wants_count(request):
+            self.count = approximate_count(queryset)
+        return super().paginate_queryset(queryset, request, view)
+
+    def wants_count(self, request):
+        value = request.query_params.get(self.count_query_param, "")
+        return value.lower() in ("1", "true", "yes")
+
+    def get_paginated_response(self, data):
+        payload = {
+            "next": self.get_next_link(),
+            "previous": self.get_previous_link(),
+        }
+        if self.count is not None:
+            payload["count"] = self.count
+        payload["results"] = data
+        return Response(payload)
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema["properties"]["count"] = {
+            "type": "integer",
+            "description": "Approximate number of rows, only present with ?count=true.",
+        }
+        return response_schema
+
+
+class MaintenanceRecordPagination(KeysetPagination):
+    ordering = ("-performed_at", "-id")
+
+
+def approximate_count(queryset):
+    """
+    Return a cheap row estimate for `queryset`.
+
+    On PostgreSQL the planner estimate is used instead of a `COUNT(*)`,
+    which would scan every matching row. Other backends fall back to an
+    exact count.
+    """
+    if connections[queryset.db].vendor == "postgresql":
+        plan = json.loads(queryset.order_by().explain(format="json"))
+        return int(plan[0]["Plan"]["Plan Rows"])
+    return queryset.count()
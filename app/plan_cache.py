@@ -0,0 +1,65 @@
+"""
+Reuse of recent Terraform plans.
+
+A job's `config_hash` is the SHA-256 of the configuration that was planned
+for it. Successful plans store their `main.tf` and `logs.txt` under
+`plans/<config_hash>/` in MinIO, so identical configurations share one set
+of objects. Failed runs store theirs under `runs/<batch_id>/` and never
+replace a cached plan.
+
+A job whose own configuration was planned successfully less than
+`PLAN_CACHE_TTL` seconds ago takes over that job's `plan_output` and
+objects instead of running Terraform, and is marked `plan_cache_hit`.
+"""
+
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .metrics import count_cache
+from .models import DeploymentJob, JobStatus
+
+
+def config_hash(tf_config):
+    return hashlib.sha256(tf_config.encode("utf-8")).hexdigest()
+
+
+def plan_prefix(digest):
+    return f"plans/{digest}/"
+
+
+def run_prefix(batch_id):
+    return f"runs/{batch_id}/"
+
+
+def find_cached_plan(job, digest):
+    """The most recent job that actually planned `digest` within the TTL, if any."""
+    if settings.PLAN_CACHE_TTL <= 0:
+        return None
+    cached = (
+        DeploymentJob.objects.filter(
+            config_hash=digest,
+            status=JobStatus.COMPLETED,
+            plan_cache_hit=False,
+            started_at__gte=timezone.now() - timedelta(seconds=settings.PLAN_CACHE_TTL),
+        )
+        .exclude(id=job.id)
+        .order_by("-started_at")
+        .first()
+    )
+    count_cache("plan", cached is not None)
+    return cached
+
+
+def reuse_plan(job, cached):
+    """Complete `job` with the plan of `cached`. Returns False if `job` is no longer running."""
+    return job.transition(
+        JobStatus.COMPLETED,
+        config_hash=cached.config_hash,
+        artifact_prefix=cached.artifact_prefix,
+        minio_object=cached.minio_object,
+        plan_output=cached.plan_output,
+        plan_cache_hit=True,
+    )
@@ -0,0 +1,173 @@
+"""
+Response cache for read-heavy endpoints.
+
+Entries are stored in the default Django cache (the Redis instance at
+`REDIS_URL` unless `CACHE_URL` says otherwise). Each cached endpoint
+depends on one or more scopes, e.g. "networks" or "datacenter:3:resources".
+Every scope has a version number that is part of the cache key, so
+invalidating a scope is a single `INCR`: older entries are never read again
+and expire on their own.
+
+Cache errors never fail a request; they are logged and treated as misses.
+"""
+
+import hashlib
+import logging
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from rest_framework.response import Response
+
+from .metrics import count_cache
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "respcache"
+
+
+def _safe(default, operation, *args, **kwargs):
+    try:
+        return operation(*args, **kwargs)
+    except Exception as exc:
+        logger.warning("Response cache unavailable: %s", exc)
+        return default
+
+
+def _version_key(scope):
+    return f"{PREFIX}:version:{scope}"
+
+
+def _stats_key(name, outcome):
+    return f"{PREFIX}:stats:{name}:{outcome}"
+
+
+def scope_versions(scopes):
+    keys = [_version_key(scope) for scope in scopes]
+    versions = _safe({}, cache.get_many, keys)
+    return [versions.get(key, 0) for key in keys]
+
+
+def invalidate(*scopes):
+    """Bump the version of `scopes`, orphaning every entry built on them."""
+    for scope in set(scopes):
+        key = _version_key(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # First invalidation of this scope; a concurrent add is fine too
+            _safe(None, cache.add, key, 1, timeout=None)
+        except Exception as exc:
+            logger.warning("Response cache unavailable: %s", exc)
+
+
+def cache_key(request, scopes):
+    """
+    Key an entry by path, query parameters, the negotiated media type, the
+    caller's role (responses mask fields for non-admins) and the current
+    version of every scope.
+    """
+    role = getattr(request.user, "role", None) or "anonymous"
+    params = sorted(request.GET.lists())
+    media_type = getattr(request, "accepted_media_type", None)
+    versions = scope_versions(scopes)
+    raw = repr((request.path, params, media_type, role, list(zip(scopes, versions))))
+    return f"{PREFIX}:entry:{hashlib.sha256(raw.encode()).hexdigest()}"
+
+
+def count(name, outcome):
+    key = _stats_key(name, outcome)
+    try:
+        cache.incr(key)
+    except ValueError:
+        _safe(None, cache.add, key, 1, timeout=None)
+    except Exception as exc:
+        logger.warning("Response cache unavailable: %s", exc)
+
+
+def lookup(name, key):
+    entry = _safe(None, cache.get, key)
+    count(name, "hits" if entry is not None else "misses")
+    count_cache(f"response:{name}", entry is not None)
+    if entry is None:
+        return None
+    content, content_type = entry
+    response = HttpResponse(content, content_type=content_type)
+    response["X-Cache"] = "HIT"
+    return response
+
+
+def store(key, content, content_type):
+    _safe(None, cache.set, key, (content, content_type), settings.RESPONSE_CACHE_TIMEOUT)
+
+
+def stats(names):
+    keys = {
+        (name, outcome): _stats_key(name, outcome)
+        for name in names
+        for outcome in ("hits", "misses")
+    }
+    values = _safe({}, cache.get_many, list(keys.values()))
+    result = {}
+    for name in names:
+        hits = values.get(keys[(name, "hits")], 0)
+        misses = values.get(keys[(name, "misses")], 0)
+        total = hits + misses
+        result[name] = {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / total, 4) if total else None,
+        }
+    return result
+
+
+def tee_into_cache(key, chunks, content_type):
+    content = []
+    for chunk in chunks:
+        content.append(chunk)
+        yield chunk
+    store(key, b"".join(content), content_type)
+
+
+# Endpoints registered with the response cache, for `stats()`
+CACHED_ENDPOINTS = set()
+
+
+def cached_response(name, scopes):
+    """
+    Cache successful responses of a function-based DRF view.
+
+    `scopes(request, *args, **kwargs)` returns the scopes the response
+    depends on. Apply it below `@api_view` so `request.user` is set.
+    Streaming responses keep streaming on a miss and are stored once the
+    last chunk has been sent.
+    """
+    CACHED_ENDPOINTS.add(name)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not settings.RESPONSE_CACHE_ENABLED:
+                return view(request, *args, **kwargs)
+            key = cache_key(request, scopes(request, *args, **kwargs))
+            hit = lookup(name, key)
+            if hit is not None:
+                return hit
+
+            response = view(request, *args, **kwargs)
+            # DRF responses are only rendered after the view returns
+            if response.status_code != 200 or isinstance(response, Response):
+                return response
+            if response.streaming:
+                response.streaming_content = tee_into_cache(
+                    key, response.streaming_content, response["Content-Type"]
+                )
+            else:
+                store(key, response.content, response["Content-Type"])
+            response["X-Cache"] = "MISS"
+            return response
+
+        return wrapper
+
+    return decorator
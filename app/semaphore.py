@@ -0,0 +1,85 @@
+"""
+Distributed counting semaphore on Redis.
+
+Each semaphore is a sorted set of holder tokens scored by the time their
+lease expires, so slots held by a worker that died are reclaimed after
+`ttl` seconds. A `Semaphore` takes a slot in several semaphores at once, or
+in none of them, with a single script.
+
+Like the job output streams, the limit is best effort: when Redis is
+unreachable or misconfigured, `acquire` logs a warning and lets the caller
+run.
+"""
+
+import logging
+import time
+import uuid
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+ACQUIRE_SCRIPT = """
+local now, expires, ttl, token = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now)
+    if redis.call('ZCARD', key) >= tonumber(ARGV[4 + i]) then
+        return 0
+    end
+end
+for _, key in ipairs(KEYS) do
+    redis.call('ZADD', key, expires, token)
+    redis.call('EXPIRE', key, ttl)
+end
+return 1
+"""
+
+
+def semaphore_key(name):
+    return f"semaphore:{name}"
+
+
+class Semaphore:
+    def __init__(self, limits, ttl):
+        """`limits` maps semaphore names to their size; sizes below 1 mean no limit."""
+        self.limits = {name: limit for name, limit in limits.items() if limit > 0}
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+        self.held = False
+
+    def acquire(self):
+        """Take a slot in every semaphore. Returns False if one is full."""
+        if not self.limits:
+            return True
+        now = time.time()
+        try:
+            client = get_redis()
+            acquired = client.eval(
+                ACQUIRE_SCRIPT,
+                len(self.limits),
+                *map(semaphore_key, self.limits),
+                now,
+                now + self.ttl,
+                self.ttl,
+                self.token,
+                *self.limits.values(),
+            )
+        except Exception as exc:
+            # Client setup errors (e.g. a bad URL) are not RedisErrors
+            logger.warning("Semaphores %s unavailable, not limiting: %s", ", ".join(self.limits), exc)
+            return True
+        self.held = bool(acquired)
+        return self.held
+
+    def release(self):
+        if not self.held:
+            return
+        self.held = False
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            for name in self.limits:
+                pipe.zrem(semaphore_key(name), self.token)
+            pipe.execute()
+        except Exception as exc:
+            # The lease expires on its own
+            logger.warning("Releasing semaphores %s failed: %s", ", ".join(self.limits), exc)
@@ -1,35 +1,106 @@
+import ipaddress
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import IntegrityError, transaction
 from rest_framework import serializers
 
-from .models import (AssetStatus, Cluster, DataCenter, DeploymentJob, DiskArray, MaintenanceRecord, Network, Role, Server,
-                     ServerDiskArrayMap, User)
+from . import ipam
+from .models import (AssetStatus, Cluster, DataCenter, DeploymentJob, DeploymentJobPhase, DiskArray, IPAllocation,
+                     MaintenanceRecord, Network, Role, Server, ServerDiskArrayMap, User)
+from .template_registry import get_registry
+
+
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Primary key relation that resolves against `context["preloaded"]`.
+
+    Bulk endpoints fetch every referenced object with one query per model and
+    pass them in the context, so validating N items does not run N lookups.
+    Without preloaded objects it behaves like `PrimaryKeyRelatedField`.
+    """
+
+    def to_internal_value(self, data):
+        preloaded = self.context.get("preloaded", {}).get(self.get_queryset().model)
+        if preloaded is None:
+            return super().to_internal_value(data)
+        try:
+            if isinstance(data, bool):
+                raise TypeError
+            pk = self.get_queryset().model._meta.pk.to_python(data)
+        except (TypeError, ValueError, DjangoValidationError):
+            self.fail("incorrect_type", data_type=type(data).__name__)
+        if pk not in preloaded:
+            self.fail("does_not_exist", pk_value=data)
+        return preloaded[pk]
+
 
+class UniqueConstraintErrorsMixin:
+    """
+    Report violations of database unique constraints as validation errors.
+
+    Uniqueness is enforced by indexes rather than by an `exists()` query
+    before each write. `unique_constraint_errors` maps a constraint name to
+    the errors returned when that constraint is violated.
+    """
+
+    unique_constraint_errors = {}
+
+    def create(self, validated_data):
+        return self.save_or_raise(super().create, validated_data)
+
+    def update(self, instance, validated_data):
+        return self.save_or_raise(super().update, instance, validated_data)
+
+    def save_or_raise(self, save, *args):
+        try:
+            with transaction.atomic():
+                return save(*args)
+        except IntegrityError as exc:
+            error = constraint_validation_error(exc, self.unique_constraint_errors)
+            if error is None:
+                raise
+            raise error from exc
+
+
+def constraint_validation_error(exc, constraint_errors):
+    """
+    Return the `ValidationError` for the constraint violated in `exc`, or
+    None when it is not one of `constraint_errors`.
+    """
+    for name, errors in constraint_errors.items():
+        if name in str(exc):
+            return serializers.ValidationError(errors)
+    return None
+
+
+class UserSerializer(UniqueConstraintErrorsMixin, serializers.ModelSerializer):
+    unique_constraint_errors = {
+        "app_user_email_ci_unique": {"email": ["A user with this email already exists."]},
+    }
 
-class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = "__all__"
-
-    def validate_email(self, value):
-        if User.objects.filter(email__iexact=value).exists():
-            raise serializers.ValidationError("A user with this email already exists.")
-        return value
+        extra_kwargs = {
+            "password": {"write_only": True},
+            "totp_secret": {"write_only": True},
+        }
 
     def create(self, validated_data):
-        return User.objects.create_user(**validated_data)
+        return self.save_or_raise(lambda data: User.objects.create_user(**data), validated_data)
 
 
-class DataCenterSerializer(serializers.ModelSerializer):
+class DataCenterSerializer(UniqueConstraintErrorsMixin, serializers.ModelSerializer):
+    unique_constraint_errors = {
+        "app_datacenter_name_ci_unique": {
+            "name": ["A DataCenter with this name already exists."]
+        },
+    }
+
     class Meta:
         model = DataCenter
         fields = "__all__"
 
-    def validate_name(self, value):
-        if DataCenter.objects.filter(name__iexact=value).exists():
-            raise serializers.ValidationError(
-                "A DataCenter with this name already exists."
-            )
-        return value
-
 class ClusterSerializer(serializers.ModelSerializer):
     class Meta:
         model = Cluster
@@ -38,10 +109,47 @@ class ClusterSerializer(serializers.ModelSerializer):
 class NetworkSerializer(serializers.ModelSerializer):
     class Meta:
         model = Network
-        fields = "__all__"
+        exclude = ["range_start", "range_end"]
 
+    def validate_cidr(self, value):
+        try:
+            return str(ipaddress.ip_network(value))
+        except ValueError:
+            raise serializers.ValidationError(f"Invalid CIDR: {value}")
 
-class ServerSerializer(serializers.ModelSerializer):
+
+class IPAllocationSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = IPAllocation
+        fields = ["id", "network", "address", "deployment_job", "allocated_at"]
+
+
+class IPAllocationRequestSerializer(serializers.Serializer):
+    count = serializers.IntegerField(min_value=1, max_value=65536, required=False)
+    deployment_job = serializers.PrimaryKeyRelatedField(
+        queryset=DeploymentJob.objects.all(), required=False
+    )
+
+    def validate(self, attrs):
+        # A deployment job gets one address per VM unless a count is given
+        if "count" not in attrs:
+            if "deployment_job" not in attrs:
+                raise serializers.ValidationError("Provide a count or a deployment_job.")
+            attrs["count"] = attrs["deployment_job"].vm_count
+        return attrs
+
+
+class IPReleaseSerializer(serializers.Serializer):
+    addresses = serializers.ListField(child=serializers.IPAddressField(), allow_empty=False)
+
+
+class ServerSerializer(UniqueConstraintErrorsMixin, serializers.ModelSerializer):
+    unique_constraint_errors = {
+        "app_server_serial_number_ci_unique": {
+            "serial_number": ["A Server with this serial number already exists."]
+        },
+    }
+    serializer_related_field = PreloadedPrimaryKeyRelatedField
     ip_address = serializers.IPAddressField(allow_blank=True, allow_null=True, required=False)
 
     class Meta:
@@ -57,13 +165,6 @@ class ServerSerializer(serializers.ModelSerializer):
             data.pop("serial_number", None)
         return data
 
-    def validate_serial_number(self, value):
-        if Server.objects.filter(serial_number__iexact=value).exists():
-            raise serializers.ValidationError(
-                "A Server with this serial number already exists."
-            )
-        return value
-    
     def validate(self, attrs):
         # Convert blank string to None
         if attrs.get("ip_address") == "":
@@ -84,8 +185,37 @@ class ServerSerializer(serializers.ModelSerializer):
 
         return attrs
 
+    def create(self, validated_data):
+        with transaction.atomic():
+            self.check_assignment(validated_data, None)
+            return super().create(validated_data)
+
+    def update(self, instance, validated_data):
+        with transaction.atomic():
+            self.check_assignment(validated_data, instance)
+            return super().update(instance, validated_data)
+
+    def check_assignment(self, attrs, instance):
+        """Re-check the address under the network lock `ipam.allocate` takes."""
+        if "ip_address" not in attrs and "network" not in attrs:
+            return
+        network = attrs.get("network", getattr(instance, "network", None))
+        ip_address = attrs.get("ip_address", getattr(instance, "ip_address", None))
+        conflicts = ipam.assignment_conflicts(
+            [(None, getattr(network, "pk", None), ip_address, getattr(instance, "pk", None))]
+        )
+        if conflicts:
+            raise serializers.ValidationError({"ip_address": [conflicts[None]]})
+
+
+class DiskArraySerializer(UniqueConstraintErrorsMixin, serializers.ModelSerializer):
+    unique_constraint_errors = {
+        "app_diskarray_serial_number_ci_unique": {
+            "serial_number": ["A Disk Array with this serial number already exists."]
+        },
+    }
+    serializer_related_field = PreloadedPrimaryKeyRelatedField
 
-class DiskArraySerializer(serializers.ModelSerializer):
     class Meta:
         model = DiskArray
         fields = "__all__"
@@ -99,13 +229,6 @@ class DiskArraySerializer(serializers.ModelSerializer):
             data.pop("serial_number", None)
         return data
 
-    def validate_serial_number(self, value):
-        if DiskArray.objects.filter(serial_number__iexact=value).exists():
-            raise serializers.ValidationError(
-                "A Disk Array with this serial number already exists."
-            )
-        return value
-
 
 class MaintenanceRecordSerializer(serializers.ModelSerializer):
     resource_type = serializers.SerializerMethodField()
@@ -153,11 +276,31 @@ class UnifiedResourceSerializer(serializers.Serializer):
     content_type_id = serializers.IntegerField()
 
 
+class DeploymentJobPhaseSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DeploymentJobPhase
+        fields = ['phase', 'started_at', 'finished_at', 'duration', 'succeeded']
+
+
 class DeploymentJobSerializer(serializers.ModelSerializer):
+    # Seconds between submission and a worker picking the job up
+    queue_wait = serializers.FloatField(read_only=True)
+    phases = DeploymentJobPhaseSerializer(many=True, read_only=True)
+
     class Meta:
         model = DeploymentJob
         fields = '__all__'
-        read_only_fields = ['status', 'created_at']
+        read_only_fields = [
+            'status', 'created_at', 'started_at', 'batch_id', 'config_hash', 'artifact_prefix', 'plan_cache_hit'
+        ]
+
+    def validate_template(self, value):
+        names = get_registry().names()
+        if value not in names:
+            raise serializers.ValidationError(
+                f"Unknown template: {value}. Available: {', '.join(names)}."
+            )
+        return value
 
 
 
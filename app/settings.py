@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import tempfile
 from datetime import timedelta
 from pathlib import Path
 
@@ -55,11 +56,17 @@ AUTH_USER_MODEL = "app.User"
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "app.authentication.ClaimsJWTAuthentication",
     ),
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
     ],
+    "DEFAULT_PAGINATION_CLASS": "app.pagination.KeysetPagination",
+    "PAGE_SIZE": 50,
+    "DEFAULT_THROTTLE_RATES": {
+        "login_ip": env("LOGIN_RATE_PER_IP", default="30/min"),
+        "login_user": env("LOGIN_RATE_PER_USER", default="5/min"),
+    },
 }
 
 SIMPLE_JWT = {
@@ -68,6 +75,7 @@ SIMPLE_JWT = {
 }
 
 MIDDLEWARE = [
+    "app.metrics.MetricsMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -151,8 +159,30 @@ CORS_ALLOWED_ORIGINS = [
     env("CLIENT_API_URL")
 ]
 
-CELERY_BROKER_URL = env("REDIS_URL")
-CELERY_RESULT_BACKEND = env("REDIS_URL")
+# Used directly by `app.redis_client` for job output streams and semaphores
+REDIS_URL = env("REDIS_URL")
+
+CELERY_BROKER_URL = REDIS_URL
+CELERY_RESULT_BACKEND = REDIS_URL
+# Deployments run on their own queue (`celery worker -Q deployments`), one
+# message at a time per worker process, so they cannot starve other tasks
+CELERY_TASK_ROUTES = {
+    "app.tasks.deploy_vm_via_terraform": {"queue": "deployments"},
+}
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# Seconds task results are kept in the result backend
+CELERY_RESULT_EXPIRES = env.int("CELERY_RESULT_EXPIRES", default=60 * 60 * 24)
+
+CACHES = {
+    "default": env.cache("CACHE_URL", default=REDIS_URL),
+}
+
+RESPONSE_CACHE_ENABLED = env.bool("RESPONSE_CACHE_ENABLED", default=True)
+RESPONSE_CACHE_TIMEOUT = env.int("RESPONSE_CACHE_TIMEOUT", default=300)
+
+# Seconds a User row is cached for authentication and views that need the
+# full model; 0 disables (one query per authenticated request)
+AUTH_USER_CACHE_TIMEOUT = env.int("AUTH_USER_CACHE_TIMEOUT", default=60)
 
 
 
@@ -160,6 +190,52 @@ VSPHERE_USER = env("VSPHERE_USER")
 VSPHERE_PASSWORD = env("VSPHERE_PASSWORD")
 VSPHERE_SERVER = env("VSPHERE_SERVER")
 
+# Terraform working directories are initialized once per worker and reused
+TERRAFORM_WORKDIR_ROOT = env(
+    "TERRAFORM_WORKDIR_ROOT", default=str(Path(tempfile.gettempdir()) / "terraform-workdirs")
+)
+TERRAFORM_POOL_SIZE = env.int("TERRAFORM_POOL_SIZE", default=2)
+TERRAFORM_TEMPLATE_CACHE_DIR = env(
+    "TERRAFORM_TEMPLATE_CACHE_DIR",
+    default=str(Path(tempfile.gettempdir()) / "terraform-template-cache"),
+)
+TF_PLUGIN_CACHE_DIR = env(
+    "TF_PLUGIN_CACHE_DIR", default=str(Path(tempfile.gettempdir()) / "terraform-plugin-cache")
+)
+# Pending jobs with the same target that are submitted within this many
+# seconds run as one Terraform configuration, up to DEPLOYMENT_BATCH_SIZE jobs
+DEPLOYMENT_BATCH_WINDOW = env.int("DEPLOYMENT_BATCH_WINDOW", default=5)
+DEPLOYMENT_BATCH_SIZE = env.int("DEPLOYMENT_BATCH_SIZE", default=50)
+# Concurrent Terraform runs per datacenter and against VSPHERE_SERVER (0 for
+# no limit). Slots are leased for DEPLOYMENT_SLOT_TTL seconds; a job that
+# finds no free slot is retried after DEPLOYMENT_SLOT_RETRY_DELAY seconds.
+DEPLOYMENT_MAX_PER_DATACENTER = env.int("DEPLOYMENT_MAX_PER_DATACENTER", default=2)
+DEPLOYMENT_MAX_PER_VSPHERE = env.int("DEPLOYMENT_MAX_PER_VSPHERE", default=4)
+DEPLOYMENT_SLOT_TTL = env.int("DEPLOYMENT_SLOT_TTL", default=60 * 60)
+DEPLOYMENT_SLOT_RETRY_DELAY = env.int("DEPLOYMENT_SLOT_RETRY_DELAY", default=15)
+# Bearer token Prometheus must send to /metrics (disabled when empty)
+METRICS_TOKEN = env("METRICS_TOKEN", default="")
+
+# Seconds a successful plan is reused for jobs with an identical
+# configuration (0 to always run Terraform)
+PLAN_CACHE_TTL = env.int("PLAN_CACHE_TTL", default=60 * 60)
+
 MINIO_ENDPOINT = env("MINIO_ENDPOINT")
 MINIO_ACCESS_KEY = env("MINIO_ACCESS_KEY")
 MINIO_SECRET_KEY = env("MINIO_SECRET_KEY")
+
+# Endpoint clients download artifacts from, when it differs from MINIO_ENDPOINT
+MINIO_PUBLIC_ENDPOINT = env("MINIO_PUBLIC_ENDPOINT", default=None)
+MINIO_PUBLIC_SECURE = env.bool("MINIO_PUBLIC_SECURE", default=False)
+MINIO_REGION = env("MINIO_REGION", default="us-east-1")
+# HTTP connections kept per MinIO host, and timeouts in seconds
+MINIO_POOL_MAXSIZE = env.int("MINIO_POOL_MAXSIZE", default=10)
+MINIO_CONNECT_TIMEOUT = env.float("MINIO_CONNECT_TIMEOUT", default=5)
+MINIO_READ_TIMEOUT = env.float("MINIO_READ_TIMEOUT", default=60)
+# Multipart uploads: part size in bytes (0 lets the client decide) and
+# parts sent in parallel; artifacts of a job are uploaded concurrently
+MINIO_PART_SIZE = env.int("MINIO_PART_SIZE", default=16 * 1024 * 1024)
+MINIO_PARALLEL_PARTS = env.int("MINIO_PARALLEL_PARTS", default=3)
+MINIO_UPLOAD_WORKERS = env.int("MINIO_UPLOAD_WORKERS", default=4)
+# Lifetime in seconds of pre-signed artifact URLs
+ARTIFACT_URL_EXPIRY = env.int("ARTIFACT_URL_EXPIRY", default=300)
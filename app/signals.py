@@ -0,0 +1,188 @@
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete, pre_save
+from django.dispatch import Signal, receiver
+from django.utils import timezone
+
+from . import capacity, response_cache
+from .authentication import invalidate_user
+from .models import Cluster, DataCenter, DeploymentJob, DiskArray, Network, Server, User
+
+# Sent by the bulk endpoints after `bulk_create`/`bulk_update`, which do not
+# send `post_save`. Arguments: `instances`, `created`.
+bulk_saved = Signal()
+
+
+# ==============================
+# Capacity Summary
+# ==============================
+
+@receiver(post_init, sender=Server)
+@receiver(post_init, sender=DiskArray)
+def snapshot_capacity(sender, instance, **kwargs):
+    capacity.snapshot(instance)
+
+
+def stored_state(sender, instance):
+    """Capacity state of the row of `instance` as currently stored."""
+    current = sender.objects.filter(pk=instance.pk).first()
+    return capacity.previous_state(current) if current is not None else None
+
+
+@receiver(pre_save, sender=Server)
+@receiver(pre_save, sender=DiskArray)
+@receiver(pre_delete, sender=Server)
+@receiver(pre_delete, sender=DiskArray)
+def load_previous_capacity(sender, instance, **kwargs):
+    # Instances loaded with deferred fields have no usable snapshot
+    if instance.pk and capacity.previous_state(instance) is None:
+        setattr(instance, capacity.SNAPSHOT_ATTR, stored_state(sender, instance))
+
+
+@receiver(post_save, sender=Server)
+@receiver(post_save, sender=DiskArray)
+def update_capacity_on_save(sender, instance, **kwargs):
+    new = capacity.capacity_state(instance)
+    if new is None:
+        new = stored_state(sender, instance)
+    capacity.apply_changes([(capacity.previous_state(instance), new)])
+    setattr(instance, capacity.SNAPSHOT_ATTR, new)
+
+
+@receiver(post_delete, sender=Server)
+@receiver(post_delete, sender=DiskArray)
+def update_capacity_on_delete(sender, instance, **kwargs):
+    capacity.apply_changes([(capacity.previous_state(instance), None)])
+
+
+@receiver(pre_delete, sender=Cluster)
+def release_cluster_capacity(sender, instance, **kwargs):
+    capacity.move_cluster_to_datacenter(instance)
+
+
+@receiver(bulk_saved, sender=Server)
+@receiver(bulk_saved, sender=DiskArray)
+def update_capacity_on_bulk_save(sender, instances, **kwargs):
+    capacity.apply_changes(
+        [(capacity.previous_state(obj), capacity.capacity_state(obj)) for obj in instances]
+    )
+    for obj in instances:
+        capacity.snapshot(obj)
+
+
+# ==============================
+# Response Cache
+# ==============================
+
+DATACENTER_ATTR = "_response_cache_datacenter"
+
+# Scope of the list/detail responses of each model
+MODEL_SCOPES = {
+    DataCenter: "datacenters",
+    Cluster: "clusters",
+    Network: "networks",
+}
+
+
+def datacenter_resources_scope(datacenter_id):
+    return f"datacenter:{datacenter_id}:resources"
+
+
+@receiver(post_init, sender=Cluster)
+@receiver(post_init, sender=Network)
+@receiver(post_init, sender=Server)
+@receiver(post_init, sender=DiskArray)
+def remember_datacenter(sender, instance, **kwargs):
+    setattr(instance, DATACENTER_ATTR, instance.__dict__.get("datacenter_id"))
+
+
+def resource_scopes(sender, instances):
+    scopes = []
+    if sender in MODEL_SCOPES:
+        scopes.append(MODEL_SCOPES[sender])
+    for instance in instances:
+        if isinstance(instance, DataCenter):
+            datacenter_ids = {instance.pk}
+        else:
+            # A resource moved to another datacenter leaves the old listing
+            datacenter_ids = {
+                getattr(instance, DATACENTER_ATTR, None),
+                instance.__dict__.get("datacenter_id"),
+            }
+        scopes += [datacenter_resources_scope(pk) for pk in datacenter_ids if pk is not None]
+    return scopes
+
+
+@receiver(post_save, sender=DataCenter)
+@receiver(post_save, sender=Cluster)
+@receiver(post_save, sender=Network)
+@receiver(post_save, sender=Server)
+@receiver(post_save, sender=DiskArray)
+@receiver(post_delete, sender=DataCenter)
+@receiver(post_delete, sender=Cluster)
+@receiver(post_delete, sender=Network)
+@receiver(post_delete, sender=Server)
+@receiver(post_delete, sender=DiskArray)
+def invalidate_responses(sender, instance, **kwargs):
+    response_cache.invalidate(*resource_scopes(sender, [instance]))
+    remember_datacenter(sender, instance)
+
+
+@receiver(bulk_saved, sender=Server)
+@receiver(bulk_saved, sender=DiskArray)
+def invalidate_responses_on_bulk_save(sender, instances, **kwargs):
+    response_cache.invalidate(*resource_scopes(sender, instances))
+    for instance in instances:
+        remember_datacenter(sender, instance)
+
+
+@receiver(m2m_changed, sender=DataCenter.admins.through)
+def invalidate_datacenter_admins(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        response_cache.invalidate(MODEL_SCOPES[DataCenter])
+
+
+@receiver(post_delete, sender=User)
+def invalidate_deleted_admin(sender, instance, **kwargs):
+    # The cascade deletes the admin rows without sending `m2m_changed`
+    response_cache.invalidate(MODEL_SCOPES[DataCenter])
+
+
+# ==============================
+# Modification Time
+# ==============================
+
+@receiver(pre_delete, sender=Cluster)
+@receiver(pre_delete, sender=Network)
+def touch_nulled_references(sender, instance, **kwargs):
+    # SET_NULL is applied with a plain UPDATE that skips `auto_now`
+    now = timezone.now()
+    field = sender._meta.model_name
+    instance.servers.update(updated_at=now)
+    DeploymentJob.objects.filter(**{field: instance}).update(updated_at=now)
+
+
+@receiver(m2m_changed, sender=DataCenter.admins.through)
+def touch_datacenters_on_admins_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse and action in ("post_add", "post_remove", "post_clear"):
+        datacenters = DataCenter.objects.filter(pk=instance.pk)
+    elif reverse and action in ("post_add", "post_remove"):
+        datacenters = DataCenter.objects.filter(pk__in=pk_set)
+    elif reverse and action == "pre_clear":
+        datacenters = DataCenter.objects.filter(admins=instance)
+    else:
+        return
+    datacenters.update(updated_at=timezone.now())
+
+
+@receiver(pre_delete, sender=User)
+def touch_datacenters_of_deleted_admin(sender, instance, **kwargs):
+    DataCenter.objects.filter(admins=instance).update(updated_at=timezone.now())
+
+
+# ==============================
+# Authentication
+# ==============================
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def evict_cached_user(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
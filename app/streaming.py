@@ -0,0 +1,98 @@
+import codecs
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+encoder = DjangoJSONEncoder()
+
+
+def iter_json_page(rows, trailer):
+    """
+    Yield a JSON object `{"results": [...], **trailer()}` piece by piece.
+
+    `trailer` is called once every row has been written, so it can depend on
+    what was streamed (e.g. the cursor of the last row).
+    """
+    yield '{"results": ['
+    for index, row in enumerate(rows):
+        yield ("," if index else "") + encoder.encode(row)
+    yield "]"
+    for key, value in trailer().items():
+        yield f", {json.dumps(key)}: {encoder.encode(value)}"
+    yield "}"
+
+
+def stream_json_page(rows, trailer):
+    return StreamingHttpResponse(
+        iter_json_page(rows, trailer), content_type="application/json"
+    )
+
+
+def iter_json_text(key, chunks):
+    """
+    Yield `{key: "<text>"}` where the text is UTF-8 `chunks`, decoding and
+    escaping them as they arrive.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    yield f"{{{json.dumps(key)}: \""
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield json.dumps(text, ensure_ascii=False)[1:-1]
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield json.dumps(text, ensure_ascii=False)[1:-1]
+    yield "\"}"
+
+
+class _Echo:
+    """File-like object whose `write` hands the line back to `csv.writer`."""
+
+    def write(self, value):
+        return value
+
+
+def _chunked(lines, size):
+    buffer = []
+    for line in lines:
+        buffer.append(line)
+        if len(buffer) >= size:
+            yield "".join(buffer)
+            buffer = []
+    if buffer:
+        yield "".join(buffer)
+
+
+def iter_ndjson(rows):
+    for row in rows:
+        yield encoder.encode(row) + "\n"
+
+
+def iter_csv(rows, fields):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([row[field] for field in fields])
+
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def stream_export(rows, fields, output, filename, chunk_lines=500):
+    """
+    Stream `rows` (dicts keyed by `fields`) as NDJSON or CSV.
+
+    Lines are grouped into chunks of `chunk_lines` so each write to the
+    client carries a useful amount of data.
+    """
+    lines = iter_csv(rows, fields) if output == "csv" else iter_ndjson(rows)
+    response = StreamingHttpResponse(
+        _chunked(lines, chunk_lines), content_type=EXPORT_FORMATS[output]
+    )
+    response["Content-Disposition"] = f'attachment; filename="{filename}.{output}"'
+    return response
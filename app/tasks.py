@@ -1,106 +1,201 @@
+import math
 import os
+import shutil
 import tempfile
-import subprocess
 import traceback
 import logging
 
 from celery import shared_task
-from jinja2 import Template
+from celery.signals import worker_init, worker_process_shutdown
 from django.conf import settings
 
-from app.minio_client import upload_to_minio
-from app.models import DeploymentJob
+from app.batching import claim_batch, reclaim_expired, render_batch, run_expires_in, split_plan
+from app.minio_client import upload_many
+from app.job_phases import PhaseRecorder
+from app.metrics import DEPLOYMENT_QUEUE_WAIT
+from app.models import DeploymentJob, JobPhase, JobStatus
+from app.plan_cache import config_hash, find_cached_plan, plan_prefix, reuse_plan, run_prefix
+from app.semaphore import Semaphore
+from app.template_registry import get_registry
+from app.job_output import TerraformOutput
+from app.terraform_pool import get_pool, shutdown_pool
 
 logger = logging.getLogger(__name__)
 
 
-@shared_task
-def deploy_vm_via_terraform(job_id):
-    try:
-        job = DeploymentJob.objects.get(id=job_id)
-        job.status = 'running'
-        job.save()
-
-        template_path = os.path.join(
-            settings.BASE_DIR, "app", "terraform_templates", "vsphere_vm.tf.j2"
-        )
-        logger.debug(f"Using Terraform template at: {template_path}")
-
-        with open(template_path) as f:
-            template = Template(f.read())
-
-        tf_config = template.render(
-            vsphere_user=settings.VSPHERE_USER,
-            vsphere_password=settings.VSPHERE_PASSWORD,
-            vsphere_server=settings.VSPHERE_SERVER,
-            datacenter=job.datacenter.name,
-            cluster=job.cluster.name,
-            datastore=job.datastore,
-            network=job.network.name,
-            vm_name=job.vm_name,
-            cpu=job.cpu,
-            memory=job.memory,
-            vm_count=job.vm_count,
-        )
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            tf_path = os.path.join(tmpdir, "main.tf")
-            logs_path = os.path.join(tmpdir, "logs.txt")
+@worker_init.connect
+def load_deployment_templates(**kwargs):
+    # Fail fast on a broken template; the compiled templates are inherited
+    # by the pool processes
+    templates = get_registry().load()
+    logger.info("Loaded deployment templates: %s", ", ".join(templates))
 
-            # Write the Terraform config file
-            with open(tf_path, "w") as f:
-                f.write(tf_config)
 
-            bucket = "terraform-jobs"
-            object_prefix = f"job_{job.id}"
-
-            # Upload main.tf to MinIO
-            job.minio_object = upload_to_minio(bucket, tf_path, f"{object_prefix}/main.tf")
-
-            # Run Terraform and capture logs
-            with open(logs_path, "w") as log_file:
-                subprocess.run(
-                    ["terraform", "init"],
-                    cwd=tmpdir,
-                    stdout=log_file,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    check=True,
-                )
-                subprocess.run(
-                    ["terraform", "plan"],
-                    cwd=tmpdir,
-                    stdout=log_file,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    check=True,
-                )
+@worker_process_shutdown.connect
+def remove_terraform_workdirs(**kwargs):
+    shutdown_pool()
+
 
-            # Upload logs.txt to MinIO
-            upload_to_minio(bucket, logs_path, f"{object_prefix}/logs.txt")
+def enqueue_deployment(job):
+    """Queue `job`, leaving time for jobs with the same target to join it."""
+    deploy_vm_via_terraform.apply_async((job.id,), countdown=settings.DEPLOYMENT_BATCH_WINDOW)
 
-            # Save part of log output to DB
-            with open(logs_path) as log_file:
-                job.plan_output = log_file.read()[:5000]
 
-            job.status = 'completed'
-            job.save()
+def deployment_slots(job):
+    """Concurrency slots a run for `job` needs: its datacenter and vSphere server."""
+    return Semaphore(
+        {
+            f"deployments:datacenter:{job.datacenter_id}": settings.DEPLOYMENT_MAX_PER_DATACENTER,
+            f"deployments:vsphere:{settings.VSPHERE_SERVER}": settings.DEPLOYMENT_MAX_PER_VSPHERE,
+        },
+        ttl=settings.DEPLOYMENT_SLOT_TTL,
+    )
 
-            logger.info(f"Terraform deployment completed successfully for job {job.id}")
-            return f"Terraform init and plan completed for job {job.id}."
 
-    except DeploymentJob.DoesNotExist:
+# Long Terraform runs are acknowledged when they finish, so a worker that
+# dies mid-run does not lose the message (its redelivery reclaims the
+# expired batch, see `app.batching`); see also CELERY_TASK_ROUTES
+@shared_task(bind=True, acks_late=True, max_retries=None)
+def deploy_vm_via_terraform(self, job_id):
+    """
+    Plan `job_id` together with the pending jobs batched with it, see
+    `app.batching`. Does nothing if the job is already done, and retries
+    later while it is running or its datacenter or vSphere server is busy.
+    """
+    job = DeploymentJob.objects.filter(id=job_id).first()
+    if job is None:
         error_msg = f"DeploymentJob with id {job_id} does not exist."
         logger.error(error_msg)
         return error_msg
+    if reclaim_expired(job):
+        logger.warning(f"Run of job {job_id} expired, planning it again")
+        job.refresh_from_db()
+    if job.status == JobStatus.RUNNING:
+        # Claimed by another task, or this is the redelivery of a task whose
+        # worker died: look again once the run has expired
+        raise self.retry(countdown=math.ceil(run_expires_in(job)) + 1)
+    if job.status != JobStatus.PENDING:
+        return f"DeploymentJob {job_id} was already picked up by another task."
+
+    slots = deployment_slots(job)
+    if not slots.acquire():
+        logger.info(f"No free deployment slot for job {job_id}, retrying")
+        raise self.retry(countdown=settings.DEPLOYMENT_SLOT_RETRY_DELAY)
+    try:
+        return run_deployment(job)
+    finally:
+        slots.release()
+
+
+def run_deployment(job):
+    """
+    Claim the batch of `job`, reuse recent identical plans and plan the
+    rest. Status changes are conditional updates, see
+    `DeploymentJob.transition`, and phases are timed, see `app.job_phases`.
+    """
+    output = None
+    jobs = []
+    phases = None
+    artifacts = {}
+    job_id = job.id
+    try:
+        jobs = claim_batch(job)
+        if not jobs:
+            return f"DeploymentJob {job_id} was already picked up by another task."
+        for job in jobs:
+            logger.info(f"Job {job.id} started after {job.queue_wait:.1f}s in the queue")
+            DEPLOYMENT_QUEUE_WAIT.observe(job.queue_wait)
+        phases = PhaseRecorder(job.id for job in jobs)
+
+        with phases.phase(JobPhase.RENDER):
+            # Jobs whose own configuration was planned recently reuse that plan
+            cached_ids = []
+            for job in jobs:
+                cached = find_cached_plan(job, config_hash(render_batch([job])))
+                if cached is not None and reuse_plan(job, cached):
+                    cached_ids.append(job.id)
+            if cached_ids:
+                TerraformOutput(cached_ids, None).close(JobStatus.COMPLETED)
+                logger.info(f"Reused cached plans for job {', '.join(map(str, cached_ids))}")
+                jobs = [job for job in jobs if not job.plan_cache_hit]
+                if not jobs:
+                    return f"Reused cached plans for job {', '.join(map(str, cached_ids))}."
+            job_ids = phases.job_ids = [job.id for job in jobs]
+
+            tf_config = render_batch(jobs)
+            digest = config_hash(tf_config)
+
+        with tempfile.TemporaryDirectory() as artifact_dir:
+            tf_path = os.path.join(artifact_dir, "main.tf")
+            logs_path = os.path.join(artifact_dir, "logs.txt")
+            bucket = "terraform-jobs"
+
+            # Write the Terraform config file
+            with open(tf_path, "w") as f:
+                f.write(tf_config)
+
+            def store_artifacts(prefix):
+                # Upload main.tf and logs.txt to MinIO, once for the batch
+                with phases.phase(JobPhase.UPLOAD):
+                    uploaded = upload_many(bucket, {
+                        f"{prefix}main.tf": tf_path,
+                        f"{prefix}logs.txt": logs_path,
+                    })
+                artifacts.update(
+                    config_hash=digest,
+                    artifact_prefix=prefix,
+                    minio_object=uploaded[f"{prefix}main.tf"],
+                )
+
+            def init(args, cwd):
+                with phases.phase(JobPhase.INIT):
+                    output.run(args, cwd)
+
+            # Run Terraform in a pooled working directory. Output is
+            # captured in logs.txt and streamed live to clients of every
+            # job in the batch. `terraform init` only runs when the pool
+            # has to create one.
+            try:
+                with open(logs_path, "w") as log_file:
+                    output = TerraformOutput(job_ids, log_file)
+                    with get_pool().acquire(run=init) as workdir:
+                        shutil.copyfile(tf_path, os.path.join(workdir, "main.tf"))
+                        with phases.phase(JobPhase.PLAN):
+                            output.run(["terraform", "plan", "-input=false"], cwd=workdir)
+            except Exception:
+                # Failed runs never replace a cached plan
+                store_artifacts(run_prefix(jobs[0].batch_id))
+                raise
+            store_artifacts(plan_prefix(digest))
+
+            with phases.phase(JobPhase.FINALIZE):
+                # Save each job's part of the log output to DB
+                with open(logs_path) as log_file:
+                    plans = split_plan(log_file.read(), job_ids)
+
+                output.close(JobStatus.COMPLETED)
+                for job in jobs:
+                    if not job.transition(JobStatus.COMPLETED, plan_output=plans[job.id][:5000], **artifacts):
+                        logger.warning(f"Job {job.id} changed status during its run, not completing it")
+
+            job_list = ", ".join(map(str, job_ids))
+            logger.info(f"Terraform deployment completed successfully for job {job_list}")
+            return f"Terraform init and plan completed for job {job_list}."
 
     except Exception as e:
         error_msg = f"Deployment failed for job {job_id}: {str(e)}"
         logger.error(error_msg)
         logger.debug(traceback.format_exc())
+        if output is not None:
+            output.close(JobStatus.FAILED)
         try:
-            job.status = 'failed'
-            job.save()
-        except:
-            pass
+            DeploymentJob.objects.filter(id__in=[job.id for job in jobs]).transition(
+                JobStatus.RUNNING, JobStatus.FAILED, **artifacts
+            )
+        except Exception:
+            logger.exception(f"Could not mark job {job_id} as failed")
         return error_msg
+
+    finally:
+        if phases is not None:
+            phases.save()
@@ -0,0 +1,104 @@
+"""
+Registry of Terraform deployment templates.
+
+Every `<name>.tf.j2` file in `terraform_templates` is a template that a
+`DeploymentJob` can select by name. Templates are compiled once per worker
+through a Jinja2 `Environment` whose bytecode cache is shared on disk, so
+rendering a job is a dictionary lookup and a render call.
+
+`<name>_batch.tf.j2` is the batch variant of `<name>`: it renders the VMs of
+several jobs (`vms`) with `for_each` so they are planned together, see
+`app.batching`. Batch variants are not selectable on their own.
+"""
+
+import os
+
+from django.conf import settings
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, StrictUndefined, TemplateError
+
+TEMPLATES_DIR = os.path.join(settings.BASE_DIR, "app", "terraform_templates")
+TEMPLATE_SUFFIX = ".tf.j2"
+BATCH_SUFFIX = "_batch"
+DEFAULT_TEMPLATE = "vsphere_vm"
+
+
+class TemplateValidationError(Exception):
+    pass
+
+
+class TemplateRegistry:
+    def __init__(self, directory=TEMPLATES_DIR, bytecode_dir=None):
+        self.directory = directory
+        bytecode_dir = str(bytecode_dir or settings.TERRAFORM_TEMPLATE_CACHE_DIR)
+        os.makedirs(bytecode_dir, exist_ok=True)
+        self.environment = Environment(
+            loader=FileSystemLoader(directory),
+            bytecode_cache=FileSystemBytecodeCache(bytecode_dir),
+            undefined=StrictUndefined,
+            keep_trailing_newline=True,
+            # Templates are validated at startup; never stat them per render
+            auto_reload=False,
+        )
+        self._templates = None
+
+    def discover(self):
+        return sorted(
+            filename[: -len(TEMPLATE_SUFFIX)]
+            for filename in os.listdir(self.directory)
+            if filename.endswith(TEMPLATE_SUFFIX)
+        )
+
+    def load(self):
+        """
+        Compile every template. Raises `TemplateValidationError` listing
+        the templates that fail to compile or declare their own providers
+        (working directories are initialized against `versions.tf` only).
+        """
+        templates, errors = {}, []
+        for name in self.discover():
+            filename = name + TEMPLATE_SUFFIX
+            try:
+                source, _, _ = self.environment.loader.get_source(self.environment, filename)
+                templates[name] = self.environment.get_template(filename)
+            except TemplateError as exc:
+                errors.append(f"{filename}: {exc}")
+                continue
+            if "required_providers" in source:
+                errors.append(f"{filename}: providers must be declared in versions.tf")
+        if errors:
+            raise TemplateValidationError("; ".join(errors))
+        self._templates = templates
+        return templates
+
+    @property
+    def templates(self):
+        if self._templates is None:
+            self.load()
+        return self._templates
+
+    def names(self):
+        """Templates a job can select."""
+        return [name for name in self.templates if not name.endswith(BATCH_SUFFIX)]
+
+    def batch_template(self, name):
+        """Name of the batch variant of `name`, or None if it has none."""
+        batch_name = name + BATCH_SUFFIX
+        return batch_name if batch_name in self.templates else None
+
+    def render(self, name, **context):
+        try:
+            template = self.templates[name]
+        except KeyError:
+            raise TemplateValidationError(f"Unknown deployment template: {name}")
+        return template.render(**context)
+
+
+_registry = None
+
+
+def get_registry():
+    """The template registry of the current process, loaded on first use."""
+    global _registry
+    if _registry is None:
+        _registry = TemplateRegistry()
+    return _registry
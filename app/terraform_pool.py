@@ -0,0 +1,170 @@
+"""
+Worker-local pool of initialized Terraform working directories.
+
+`terraform init` only depends on the provider requirements in
+`terraform_templates/versions.tf`, so a working directory initialized
+against it can run any number of jobs: each job writes its own `main.tf`,
+runs `plan`, and the directory is reset and returned to the pool. Providers
+are installed into the shared `TF_PLUGIN_CACHE_DIR`, so even a new
+directory links them instead of downloading them.
+
+The pool is keyed by a fingerprint of `versions.tf`; when it changes, idle
+directories are discarded and new ones are initialized on demand.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+VERSIONS_PATH = os.path.join(settings.BASE_DIR, "app", "terraform_templates", "versions.tf")
+
+# Files that survive between jobs; everything else is removed on check-in
+PERSISTENT_FILES = {"versions.tf", ".terraform", ".terraform.lock.hcl"}
+
+
+def terraform_env():
+    """Environment for Terraform commands, sharing the plugin cache."""
+    os.makedirs(settings.TF_PLUGIN_CACHE_DIR, exist_ok=True)
+    return {
+        **os.environ,
+        "TF_PLUGIN_CACHE_DIR": str(settings.TF_PLUGIN_CACHE_DIR),
+        "TF_IN_AUTOMATION": "1",
+        "TF_INPUT": "0",
+    }
+
+
+class WorkdirPool:
+    def __init__(self, root=None, versions_path=VERSIONS_PATH, max_idle=None):
+        self.root = str(root or settings.TERRAFORM_WORKDIR_ROOT)
+        self.versions_path = versions_path
+        self.max_idle = settings.TERRAFORM_POOL_SIZE if max_idle is None else max_idle
+        self._idle = []
+        self._fingerprint = None
+        # Lock file of the first successful init, so later inits resolve the
+        # same provider builds straight from the plugin cache
+        self._lock_file = None
+        self._mutex = threading.Lock()
+
+    def read_versions(self):
+        with open(self.versions_path, "rb") as f:
+            return f.read()
+
+    @contextmanager
+    def acquire(self, log_file=None, run=None):
+        """
+        Yield an initialized working directory. When one has to be created,
+        `terraform init` runs through `run(args, cwd)` if given, else with
+        its output going to `log_file`. A directory that saw an exception
+        is discarded rather than reused.
+        """
+        versions = self.read_versions()
+        fingerprint = hashlib.sha256(versions).hexdigest()
+        workdir = self._checkout(fingerprint)
+        if workdir is None:
+            workdir = self._create(fingerprint, versions, log_file, run)
+        try:
+            yield workdir
+        except BaseException:
+            shutil.rmtree(workdir, ignore_errors=True)
+            raise
+        self._checkin(workdir, fingerprint)
+
+    def invalidate(self):
+        """Discard every idle directory."""
+        with self._mutex:
+            idle, self._idle = self._idle, []
+            self._fingerprint = None
+            self._lock_file = None
+        for workdir in idle:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def _checkout(self, fingerprint):
+        with self._mutex:
+            if fingerprint != self._fingerprint:
+                stale, self._idle = self._idle, []
+                self._fingerprint = fingerprint
+                self._lock_file = None
+            else:
+                stale = []
+            workdir = self._idle.pop() if self._idle else None
+        for path in stale:
+            logger.info("Provider requirements changed, discarding %s", path)
+            shutil.rmtree(path, ignore_errors=True)
+        return workdir
+
+    def _create(self, fingerprint, versions, log_file, run):
+        os.makedirs(self.root, exist_ok=True)
+        workdir = tempfile.mkdtemp(prefix=f"tf-{fingerprint[:12]}-", dir=self.root)
+        try:
+            with open(os.path.join(workdir, "versions.tf"), "wb") as f:
+                f.write(versions)
+            lock_file = self._lock_file
+            if lock_file is not None:
+                with open(os.path.join(workdir, ".terraform.lock.hcl"), "wb") as f:
+                    f.write(lock_file)
+
+            logger.info("Initializing Terraform working directory %s", workdir)
+            args = ["terraform", "init", "-input=false"]
+            if run is not None:
+                run(args, cwd=workdir)
+            else:
+                subprocess.run(
+                    args,
+                    cwd=workdir,
+                    env=terraform_env(),
+                    stdout=log_file,
+                    stderr=subprocess.STDOUT,
+                    text=True,
+                    check=True,
+                )
+        except BaseException:
+            shutil.rmtree(workdir, ignore_errors=True)
+            raise
+
+        lock_path = os.path.join(workdir, ".terraform.lock.hcl")
+        if lock_file is None and os.path.exists(lock_path):
+            with open(lock_path, "rb") as f, self._mutex:
+                if self._fingerprint == fingerprint:
+                    self._lock_file = f.read()
+        return workdir
+
+    def _checkin(self, workdir, fingerprint):
+        for name in os.listdir(workdir):
+            if name in PERSISTENT_FILES:
+                continue
+            path = os.path.join(workdir, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+        with self._mutex:
+            if fingerprint == self._fingerprint and len(self._idle) < self.max_idle:
+                self._idle.append(workdir)
+                return
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+_pool = None
+
+
+def get_pool():
+    """The pool of the current worker process, created on first use."""
+    global _pool
+    if _pool is None:
+        _pool = WorkdirPool()
+    return _pool
+
+
+def shutdown_pool():
+    if _pool is not None:
+        _pool.invalidate()
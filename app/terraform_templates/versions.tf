@@ -0,0 +1,12 @@
+# Provider requirements shared by every deployment template. Working
+# directories are initialized against this file once and reused, so the
+# rendered main.tf must not declare providers of its own. Editing this file
+# invalidates the pool of initialized directories.
+terraform {
+  required_providers {
+    vsphere = {
+      source  = "vmware/vsphere"
+      version = "~> 2.0"
+    }
+  }
+}
@@ -1,9 +1,12 @@
+from django.db import IntegrityError
 from django.test import TestCase
 from django.contrib.contenttypes.models import ContentType
 from django.utils import timezone
+from app.capacity import rebuild
 from app.models import (
-    User, Role, UserStatus, AssetStatus, ConnectionType,
-    DataCenter, MaintenanceRecord, Server, DiskArray, ServerDiskArrayMap
+    User, Role, UserStatus, AssetStatus, ConnectionType, CapacitySummary, Cluster,
+    DataCenter, DeploymentJob, InvalidTransition, JobStatus, MaintenanceRecord, Server, DiskArray,
+    ServerDiskArrayMap
 )
 
 
@@ -133,3 +136,91 @@ class MaintenanceRecordTest(TestCase):
         )
         self.assertEqual(record.resource, self.server)
         self.assertIn("Firmware Upgrade", str(record))
+
+
+class CaseInsensitiveUniquenessTest(TestCase):
+    def test_serial_numbers_are_unique_ignoring_case(self):
+        datacenter = DataCenter.objects.create(name="DC1", location="Oslo")
+        fields = dict(model="M", manufacturer="X", storage=1, datacenter=datacenter)
+        DiskArray.objects.create(serial_number="DA1", **fields)
+        with self.assertRaises(IntegrityError):
+            DiskArray.objects.create(serial_number="da1", **fields)
+
+    def test_blank_emails_do_not_collide(self):
+        User.objects.create_user(username="first", password="password123")
+        User.objects.create_user(username="second", password="password123")
+        self.assertEqual(User.objects.filter(email="").count(), 2)
+
+
+class CapacitySummaryTest(TestCase):
+    def setUp(self):
+        self.datacenter = DataCenter.objects.create(name="DC1", location="Athens")
+        self.cluster = Cluster.objects.create(name="C1", datacenter=self.datacenter)
+
+    def add_server(self, serial, **extra):
+        fields = dict(model="M", manufacturer="X", storage=100, cpu=8, ram=64)
+        fields.update(extra)
+        return Server.objects.create(serial_number=serial, datacenter=self.datacenter, **fields)
+
+    def buckets(self):
+        return list(
+            CapacitySummary.objects.filter(count__gt=0)
+            .order_by("cluster_id", "resource_type", "status")
+            .values_list("cluster_id", "resource_type", "status", "count", "cpu", "ram", "storage")
+        )
+
+    def assert_matches_rebuild(self):
+        incremental = self.buckets()
+        rebuild()
+        self.assertEqual(incremental, self.buckets())
+
+    def test_incremental_updates_match_rebuild(self):
+        first = self.add_server("S1", cluster=self.cluster)
+        second = self.add_server("S2", cpu=16)
+        DiskArray.objects.create(
+            serial_number="DA1", model="M", manufacturer="X", storage=4096, datacenter=self.datacenter
+        )
+        self.assert_matches_rebuild()
+
+        first.status = AssetStatus.MAINTENANCE
+        first.save()
+        Server.objects.get(pk=second.pk).delete()
+        self.assert_matches_rebuild()
+
+        deferred = Server.objects.only("id").get(pk=first.pk)
+        deferred.ram = 128
+        deferred.save()
+        self.assert_matches_rebuild()
+
+    def test_cluster_deletion_moves_capacity(self):
+        self.add_server("S1", cluster=self.cluster)
+        self.cluster.delete()
+        self.assertEqual(self.buckets(), [(None, "server", "available", 1, 8, 64, 100)])
+        self.assert_matches_rebuild()
+
+
+class DeploymentJobTransitionTest(TestCase):
+    def setUp(self):
+        datacenter = DataCenter.objects.create(name="DC1", location="Athens")
+        self.job = DeploymentJob.objects.create(name="web", vm_name="web", datacenter=datacenter)
+
+    def test_transitions_are_conditional(self):
+        stale = DeploymentJob.objects.get(pk=self.job.pk)
+        self.assertTrue(self.job.transition(JobStatus.RUNNING, batch_id="b1"))
+        self.assertEqual(self.job.batch_id, "b1")
+
+        # Another worker loaded the job while it was pending
+        self.assertFalse(stale.transition(JobStatus.RUNNING, batch_id="b2"))
+        self.assertEqual(stale.status, JobStatus.PENDING)
+        self.assertEqual(DeploymentJob.objects.get(pk=self.job.pk).batch_id, "b1")
+
+        self.assertEqual(
+            DeploymentJob.objects.transition(JobStatus.RUNNING, JobStatus.FAILED), 1
+        )
+        self.assertEqual(DeploymentJob.objects.filter(status=JobStatus.FAILED).count(), 1)
+
+    def test_invalid_transitions_are_rejected(self):
+        with self.assertRaises(InvalidTransition):
+            self.job.transition(JobStatus.COMPLETED)
+        with self.assertRaises(InvalidTransition):
+            DeploymentJob.objects.transition(JobStatus.FAILED, JobStatus.RUNNING)
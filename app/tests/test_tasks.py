@@ -0,0 +1,405 @@
+import io
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from unittest import mock
+
+import redis
+from celery.exceptions import Retry
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from prometheus_client import REGISTRY
+
+from app import minio_client, redis_client
+from app.job_output import TerraformOutput
+from app.models import Cluster, DataCenter, DeploymentJob, Network
+from app.semaphore import Semaphore
+from app.tasks import deploy_vm_via_terraform
+from app.template_registry import DEFAULT_TEMPLATE, TemplateRegistry, TemplateValidationError
+from app.terraform_pool import WorkdirPool
+
+
+def fake_init(args, cwd, **kwargs):
+    os.makedirs(os.path.join(cwd, ".terraform", "providers"))
+    with open(os.path.join(cwd, ".terraform.lock.hcl"), "w") as f:
+        f.write("# lock")
+
+
+class WorkdirPoolTest(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.versions = os.path.join(tmp.name, "versions.tf")
+        self.write_versions('version = "~> 2.0"')
+        self.pool = WorkdirPool(
+            root=os.path.join(tmp.name, "pool"), versions_path=self.versions, max_idle=2
+        )
+        patcher = mock.patch("app.terraform_pool.subprocess.run", side_effect=fake_init)
+        self.run = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_versions(self, content):
+        with open(self.versions, "w") as f:
+            f.write(content)
+
+    def test_directories_are_initialized_once_and_reset(self):
+        with self.pool.acquire() as first:
+            with open(os.path.join(first, "main.tf"), "w") as f:
+                f.write("resource {}")
+        with self.pool.acquire() as second:
+            self.assertEqual(sorted(os.listdir(second)), [".terraform", ".terraform.lock.hcl", "versions.tf"])
+        self.assertEqual(first, second)
+        self.assertEqual(self.run.call_count, 1)
+
+    def test_provider_change_invalidates_idle_directories(self):
+        with self.pool.acquire() as first:
+            pass
+        self.write_versions('version = "~> 3.0"')
+        with self.pool.acquire() as second:
+            with open(os.path.join(second, "versions.tf")) as f:
+                self.assertIn("3.0", f.read())
+        self.assertNotEqual(first, second)
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual(self.run.call_count, 2)
+
+    def test_failed_job_discards_directory(self):
+        with self.assertRaises(RuntimeError), self.pool.acquire() as workdir:
+            raise RuntimeError("plan failed")
+        self.assertFalse(os.path.exists(workdir))
+
+        with self.pool.acquire() as workdir:
+            pass
+        self.pool.invalidate()
+        self.assertFalse(os.path.exists(workdir))
+
+
+class TemplateRegistryTest(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = os.path.join(tmp.name, "templates")
+        os.makedirs(self.directory)
+        self.bytecode_dir = os.path.join(tmp.name, "bytecode")
+
+    def write(self, filename, content):
+        with open(os.path.join(self.directory, filename), "w") as f:
+            f.write(content)
+
+    def registry(self):
+        return TemplateRegistry(self.directory, bytecode_dir=self.bytecode_dir)
+
+    def test_render_by_name(self):
+        self.write("small_vm.tf.j2", 'name = "{{ vm_name }}"\n')
+        self.write("README.md", "not a template")
+        registry = self.registry()
+        self.assertEqual(registry.names(), ["small_vm"])
+        self.assertEqual(registry.render("small_vm", vm_name="web"), 'name = "web"\n')
+        with self.assertRaises(TemplateValidationError):
+            registry.render("large_vm", vm_name="web")
+
+    def test_invalid_templates_fail_to_load(self):
+        self.write("broken.tf.j2", "{% if %}")
+        self.write("providers.tf.j2", "terraform { required_providers {} }")
+        with self.assertRaisesMessage(TemplateValidationError, "broken.tf.j2") as caught:
+            self.registry().load()
+        self.assertIn("providers.tf.j2", str(caught.exception))
+
+    def test_bundled_templates_are_valid(self):
+        registry = TemplateRegistry(bytecode_dir=self.bytecode_dir)
+        self.assertIn(DEFAULT_TEMPLATE, registry.load())
+
+
+class TerraformOutputTest(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch("app.job_output.get_redis")
+        self.redis = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pipe = self.redis.return_value.pipeline.return_value
+        self.log = io.StringIO()
+
+    def test_lines_are_logged_and_streamed(self):
+        output = TerraformOutput(7, self.log)
+        output.run([sys.executable, "-c", "print('Refreshing'); print('Plan: 1 to add')"], cwd=None)
+        output.close("completed")
+
+        self.assertEqual(self.log.getvalue(), "Refreshing\nPlan: 1 to add\n")
+        entries = [call.args for call in self.pipe.xadd.call_args_list]
+        self.assertEqual(entries, [
+            ("deployment:7:output", {"line": "Refreshing"}),
+            ("deployment:7:output", {"line": "Plan: 1 to add"}),
+            ("deployment:7:output", {"event": "end", "status": "completed"}),
+        ])
+        self.pipe.expire.assert_called_once()
+
+    def test_lines_are_sent_when_the_output_pauses(self):
+        sent = []
+        self.pipe.execute.side_effect = lambda: sent.append(
+            ([call.args[1]["line"] for call in self.pipe.xadd.call_args_list], time.monotonic())
+        )
+        output = TerraformOutput(7, self.log)
+        output.run(
+            [sys.executable, "-c", "import time; print('a', flush=True); time.sleep(1); print('b')"],
+            cwd=None,
+        )
+        (first, first_at), (second, second_at) = sent
+        self.assertEqual((first, second), (["a"], ["a", "b"]))
+        self.assertGreater(second_at - first_at, 0.5)
+
+    def test_failures_raise_and_redis_errors_do_not(self):
+        self.pipe.execute.side_effect = ConnectionError("redis down")
+        output = TerraformOutput(7, self.log)
+        with self.assertRaises(subprocess.CalledProcessError), self.assertLogs("app.job_output", "WARNING"):
+            output.run([sys.executable, "-c", "print('Error'); raise SystemExit(1)"], cwd=None)
+        self.assertEqual(self.log.getvalue(), "Error\n")
+        self.assertFalse(output.enabled)
+
+
+class FakeMinio:
+    """Local stand-in for the MinIO client."""
+
+    def __init__(self):
+        self.buckets = set()
+        self.objects = {}
+        self.bucket_checks = 0
+
+    def bucket_exists(self, bucket):
+        self.bucket_checks += 1
+        return bucket in self.buckets
+
+    def make_bucket(self, bucket):
+        self.buckets.add(bucket)
+
+    def fput_object(self, bucket, name, path, **kwargs):
+        with open(path, "rb") as f:
+            self.objects[f"{bucket}/{name}"] = f.read()
+
+
+class StorageTest(SimpleTestCase):
+    def setUp(self):
+        minio_client.reset()
+        self.addCleanup(minio_client.reset)
+        self.minio = FakeMinio()
+        patcher = mock.patch("app.minio_client.get_client", return_value=self.minio)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.files = {}
+        for name in ("main.tf", "logs.txt", "plan.json"):
+            path = os.path.join(tmp.name, name)
+            with open(path, "w") as f:
+                f.write(name)
+            self.files[f"job_1/{name}"] = path
+
+    def test_bucket_is_ensured_once(self):
+        minio_client.upload_to_minio("jobs", self.files["job_1/main.tf"], "job_1/main.tf")
+        minio_client.upload_to_minio("jobs", self.files["job_1/logs.txt"], "job_1/logs.txt")
+        self.assertEqual(self.minio.bucket_checks, 1)
+        self.assertEqual(self.minio.objects["jobs/job_1/logs.txt"], b"logs.txt")
+
+    def test_upload_many(self):
+        def uploaded_bytes():
+            return REGISTRY.get_sample_value("minio_transferred_bytes_total", {"direction": "upload"}) or 0
+
+        before = uploaded_bytes()
+        uploaded = minio_client.upload_many("jobs", self.files)
+        self.assertEqual(uploaded_bytes() - before, len("main.tflogs.txtplan.json"))
+        self.assertEqual(uploaded["job_1/plan.json"], "jobs/job_1/plan.json")
+        self.assertEqual(len(self.minio.objects), 3)
+        self.assertEqual(self.minio.bucket_checks, 1)
+
+    def test_parse_endpoint(self):
+        self.assertEqual(minio_client.parse_endpoint("http://localhost:9000"), ("localhost:9000", False))
+        self.assertEqual(minio_client.parse_endpoint("https://s3.example.com/"), ("s3.example.com", True))
+        self.assertEqual(minio_client.parse_endpoint("minio:9000", True), ("minio:9000", True))
+
+
+class FakePool:
+    def __init__(self, workdir):
+        self.workdir = workdir
+
+    @contextmanager
+    def acquire(self, log_file=None, run=None):
+        yield self.workdir
+
+
+def fake_plan(output, args, cwd):
+    with open(os.path.join(cwd, "main.tf")) as f:
+        keys = re.findall(r'"(job_\d+_\d+)" =', f.read())
+    output.write("Terraform will perform the following actions:\n\n")
+    for key in keys:
+        output.write(f'  # vsphere_virtual_machine.vm["{key}"] will be created\n')
+        output.write(f'  + resource "vsphere_virtual_machine" "vm" {{\n      + name = "{key}"\n    }}\n\n')
+    output.write(f"Plan: {len(keys)} to add, 0 to change, 0 to destroy.\n")
+
+
+class DeploymentBatchTest(TestCase):
+    def setUp(self):
+        datacenter = DataCenter.objects.create(name="DC1", location="Paris")
+        cluster = Cluster.objects.create(name="C1", datacenter=datacenter)
+        network = Network.objects.create(name="LAN", cidr="10.0.0.0/24", datacenter=datacenter)
+        target = dict(datacenter=datacenter, cluster=cluster, network=network)
+        self.jobs = [
+            DeploymentJob.objects.create(name=f"job{i}", vm_name=f"web{i}", vm_count=i, **target)
+            for i in (1, 2, 3)
+        ]
+        self.other = DeploymentJob.objects.create(name="other", vm_name="db", datastore="LocalDS_1", **target)
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for target, kwargs in (
+            ("app.job_output.get_redis", {}),
+            ("app.semaphore.get_redis", {}),
+            ("app.tasks.get_pool", {"return_value": FakePool(tmp.name)}),
+            ("app.tasks.upload_many", {"side_effect": lambda bucket, files: {name: f"{bucket}/{name}" for name in files}}),
+        ):
+            patcher = mock.patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(TerraformOutput, "run", autospec=True, side_effect=fake_plan)
+        self.run = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_jobs_with_the_same_target_are_planned_together(self):
+        deploy_vm_via_terraform(self.jobs[0].id)
+        self.assertEqual(self.run.call_count, 1)
+
+        jobs = DeploymentJob.objects.filter(id__in=[job.id for job in self.jobs])
+        self.assertEqual({job.status for job in jobs}, {"completed"})
+        self.assertEqual(len({job.batch_id for job in jobs}), 1)
+        self.assertEqual(DeploymentJob.objects.get(id=self.other.id).status, "pending")
+
+        job = jobs.get(id=self.jobs[1].id)
+        self.assertTrue(job.artifact_prefix.startswith("plans/"))
+        self.assertEqual(job.minio_object, f"terraform-jobs/{job.artifact_prefix}main.tf")
+        self.assertEqual(job.plan_output.count("will be created"), 2)
+        self.assertIn(f'["job_{job.id}_2"]', job.plan_output)
+        self.assertTrue(job.plan_output.endswith("Plan: 6 to add, 0 to change, 0 to destroy.\n"))
+
+        self.assertEqual(
+            sorted(job.phases.values_list("phase", flat=True)), ["finalize", "plan", "render", "upload"]
+        )
+
+        result = deploy_vm_via_terraform(self.jobs[1].id)
+        self.assertIn("already picked up", result)
+        self.assertEqual(self.run.call_count, 1)
+
+    def test_redelivered_task_reclaims_an_expired_run(self):
+        started_at = timezone.now() - timedelta(seconds=settings.DEPLOYMENT_SLOT_TTL + 1)
+        DeploymentJob.objects.filter(id__in=[job.id for job in self.jobs[:2]]).update(
+            status="running", batch_id="dead", started_at=started_at
+        )
+        with self.assertLogs("app.tasks", "WARNING"):
+            deploy_vm_via_terraform(self.jobs[0].id)
+        jobs = DeploymentJob.objects.filter(id__in=[job.id for job in self.jobs])
+        self.assertEqual({job.status for job in jobs}, {"completed"})
+        self.assertNotIn("dead", {job.batch_id for job in jobs})
+
+    def test_redelivery_before_expiry_retries_when_the_run_expires(self):
+        DeploymentJob.objects.filter(id=self.other.id).update(
+            status="running", batch_id="live", started_at=timezone.now()
+        )
+        with mock.patch.object(deploy_vm_via_terraform, "retry", side_effect=Retry) as retry:
+            with self.assertRaises(Retry):
+                deploy_vm_via_terraform(self.other.id)
+        self.assertAlmostEqual(retry.call_args.kwargs["countdown"], settings.DEPLOYMENT_SLOT_TTL, delta=2)
+        self.assertEqual(DeploymentJob.objects.get(id=self.other.id).status, "running")
+        self.run.assert_not_called()
+
+    def test_busy_target_retries_later(self):
+        with mock.patch.object(Semaphore, "acquire", return_value=False), self.assertRaises(Retry):
+            deploy_vm_via_terraform(self.jobs[0].id)
+        self.run.assert_not_called()
+        self.assertEqual(DeploymentJob.objects.filter(status="pending").count(), 4)
+
+    def test_a_job_without_peers_runs_alone(self):
+        deploy_vm_via_terraform(self.other.id)
+        other = DeploymentJob.objects.get(id=self.other.id)
+        self.assertEqual(other.status, "completed")
+        self.assertIn("Plan: 0 to add", other.plan_output)
+        self.assertEqual(DeploymentJob.objects.filter(status="pending").count(), 3)
+
+    def test_identical_configuration_reuses_the_plan(self):
+        deploy_vm_via_terraform(self.other.id)
+        other = DeploymentJob.objects.get(id=self.other.id)
+        self.assertEqual(other.artifact_prefix, f"plans/{other.config_hash}/")
+
+        again = DeploymentJob.objects.create(
+            name="again", vm_name="db", datastore="LocalDS_1",
+            datacenter=other.datacenter, cluster=other.cluster, network=other.network,
+        )
+        deploy_vm_via_terraform(again.id)
+        again.refresh_from_db()
+        self.assertEqual(self.run.call_count, 1)
+        self.assertTrue(again.plan_cache_hit)
+        self.assertEqual(again.status, "completed")
+        self.assertEqual(
+            (again.config_hash, again.artifact_prefix, again.plan_output),
+            (other.config_hash, other.artifact_prefix, other.plan_output),
+        )
+
+        with override_settings(PLAN_CACHE_TTL=0):
+            self.run.side_effect = subprocess.CalledProcessError(1, "terraform")
+            third = DeploymentJob.objects.create(
+                name="third", vm_name="db", datastore="LocalDS_1",
+                datacenter=other.datacenter, cluster=other.cluster, network=other.network,
+            )
+            deploy_vm_via_terraform(third.id)
+        third.refresh_from_db()
+        self.assertEqual((third.status, third.plan_cache_hit), ("failed", False))
+        self.assertEqual(third.artifact_prefix, f"runs/{third.batch_id}/")
+        self.assertFalse(third.phases.get(phase="plan").succeeded)
+        self.assertFalse(third.phases.filter(phase="finalize").exists())
+
+
+class RedisClientTest(SimpleTestCase):
+    @override_settings(REDIS_URL="redis://redis.example:6380/2")
+    def test_client_from_settings(self):
+        with mock.patch.object(redis_client, "_client", None):
+            client = redis_client.get_redis()
+            self.assertIs(redis_client.get_redis(), client)
+        kwargs = client.connection_pool.connection_kwargs
+        self.assertEqual((kwargs["host"], kwargs["port"], kwargs["db"]), ("redis.example", 6380, 2))
+        self.assertTrue(kwargs["decode_responses"])
+
+
+class SemaphoreTest(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch("app.semaphore.get_redis")
+        self.redis = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    def test_slots_are_taken_together(self):
+        self.redis.eval.return_value = 1
+        semaphore = Semaphore({"dc:1": 2, "vsphere": 4, "unlimited": 0}, ttl=60)
+        self.assertTrue(semaphore.acquire())
+        args = self.redis.eval.call_args.args
+        self.assertEqual(args[1:4], (2, "semaphore:dc:1", "semaphore:vsphere"))
+        self.assertEqual(args[-2:], (2, 4))
+
+        semaphore.release()
+        pipe = self.redis.pipeline.return_value
+        self.assertEqual(pipe.zrem.call_count, 2)
+
+    def test_full_or_unreachable(self):
+        self.redis.eval.return_value = 0
+        self.assertFalse(Semaphore({"dc:1": 1}, ttl=60).acquire())
+
+        self.redis.eval.side_effect = redis.ConnectionError("down")
+        with self.assertLogs("app.semaphore", "WARNING"):
+            semaphore = Semaphore({"dc:1": 1}, ttl=60)
+            self.assertTrue(semaphore.acquire())
+        semaphore.release()
+        self.redis.pipeline.assert_not_called()
+
+    @mock.patch("app.semaphore.get_redis", side_effect=ValueError("Redis URL must specify a scheme"))
+    def test_client_setup_errors_do_not_block(self, get_redis):
+        with self.assertLogs("app.semaphore", "WARNING"):
+            self.assertTrue(Semaphore({"dc:1": 1}, ttl=60).acquire())
@@ -0,0 +1,1015 @@
+import json
+from unittest import mock
+
+import pyotp
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from prometheus_client import REGISTRY
+from rest_framework.test import APITestCase
+
+from app import mfa
+from app.authentication import user_cache_key
+from app.models import (Cluster, DataCenter, DeploymentJob, DiskArray, MaintenanceRecord, Network, Role, Server,
+                        User)
+from app.throttling import LoginUserThrottle
+from app.views.auth_views import MyAccessTokenSerializer
+from app.views.viewsets import datacenter_resources_query
+
+
+class KeysetPaginationTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="admin", password="adminpass", role=Role.ADMIN
+        )
+        self.client.force_authenticate(self.user)
+        self.datacenter = DataCenter.objects.create(name="DC1", location="Oslo")
+        for i in range(5):
+            Server.objects.create(
+                serial_number=f"SRV{i}",
+                model="Dell R740",
+                manufacturer="Dell",
+                storage=1024,
+                cpu=8,
+                ram=64,
+                datacenter=self.datacenter,
+            )
+
+    def test_list_is_paginated_by_cursor(self):
+        response = self.client.get("/api/servers/", {"page_size": 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), 2)
+        self.assertNotIn("count", response.data)
+
+        seen = [row["id"] for row in response.data["results"]]
+        while response.data["next"]:
+            response = self.client.get(response.data["next"])
+            seen += [row["id"] for row in response.data["results"]]
+
+        self.assertEqual(seen, list(Server.objects.order_by("id").values_list("id", flat=True)))
+
+    def test_optional_count(self):
+        response = self.client.get("/api/servers/", {"count": "true"})
+        self.assertEqual(response.data["count"], 5)
+
+    def test_maintenance_records_ordered_by_performed_at(self):
+        content_type = ContentType.objects.get_for_model(Server)
+        server = Server.objects.first()
+        now = timezone.now()
+        for days in (3, 1, 2):
+            MaintenanceRecord.objects.create(
+                title=f"Check {days}",
+                description="Routine check",
+                performed_at=now - timezone.timedelta(days=days),
+                content_type=content_type,
+                object_id=server.id,
+                datacenter=self.datacenter,
+            )
+
+        response = self.client.get(
+            f"/api/maintenance/by-datacenter/{self.datacenter.id}/"
+        )
+        titles = [row["title"] for row in response.data["results"]]
+        self.assertEqual(titles, ["Check 1", "Check 2", "Check 3"])
+
+
+class MaintenanceRecordResourceTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="admin", password="adminpass", role=Role.ADMIN
+        )
+        self.client.force_authenticate(self.user)
+        self.datacenter = DataCenter.objects.create(name="DC1", location="Rome")
+
+    def add_records(self, count):
+        for i in range(count):
+            server = Server.objects.create(
+                serial_number=f"SRV-{count}-{i}",
+                model="HP ProLiant",
+                manufacturer="HP",
+                storage=512,
+                cpu=4,
+                ram=32,
+                datacenter=self.datacenter,
+            )
+            array = DiskArray.objects.create(
+                serial_number=f"DA-{count}-{i}",
+                model="EMC VNX",
+                manufacturer="EMC",
+                storage=2048,
+                datacenter=self.datacenter,
+            )
+            for resource in (server, array):
+                MaintenanceRecord.objects.create(
+                    title="Firmware Upgrade",
+                    description="Upgraded firmware",
+                    content_type=ContentType.objects.get_for_model(resource),
+                    object_id=resource.id,
+                    datacenter=self.datacenter,
+                )
+
+    def count_list_queries(self, path):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_query_count_does_not_grow_with_rows(self):
+        paths = ["/api/maintenance/", f"/api/maintenance/by-datacenter/{self.datacenter.id}/"]
+        self.add_records(2)
+        small = [self.count_list_queries(path)[0] for path in paths]
+        self.add_records(10)
+        large = [self.count_list_queries(path)[0] for path in paths]
+        self.assertEqual(small, large)
+
+    def test_resource_fields(self):
+        self.add_records(1)
+        _, response = self.count_list_queries("/api/maintenance/")
+        reprs = sorted(row["resource_repr"] for row in response.data["results"])
+        types = sorted(row["resource_type"] for row in response.data["results"])
+        self.assertEqual(reprs, ["DiskArray: DA-1-0", "Server: SRV-1-0"])
+        self.assertEqual(types, ["diskarray", "server"])
+
+
+class DatacenterResourcesTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="operator", password="operatorpass")
+        self.client.force_authenticate(self.user)
+        self.datacenter = DataCenter.objects.create(name="DC1", location="Lisbon")
+        other = DataCenter.objects.create(name="DC2", location="Porto")
+        self.cluster = Cluster.objects.create(name="C1", datacenter=self.datacenter)
+        Network.objects.create(name="LAN", cidr="10.0.0.0/24", datacenter=self.datacenter)
+        for serial, datacenter in (("SRV1", self.datacenter), ("SRV2", self.datacenter), ("SRV3", other)):
+            Server.objects.create(
+                serial_number=serial,
+                model="Dell R740",
+                manufacturer="Dell",
+                storage=1024,
+                cpu=8,
+                ram=64,
+                datacenter=datacenter,
+            )
+        DiskArray.objects.create(
+            serial_number="DA1",
+            model="NetApp FAS",
+            manufacturer="NetApp",
+            storage=4096,
+            datacenter=self.datacenter,
+        )
+
+    def get(self, **params):
+        response = self.client.get(f"/api/datacenters/{self.datacenter.id}/resources/", params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b"".join(response.streaming_content))
+
+    def test_lists_all_resource_types(self):
+        body = self.get()
+        self.assertEqual(
+            [row["name"] for row in body["results"]],
+            ["Cluster: C1", "DiskArray: DA1", "Network: LAN (10.0.0.0/24)", "Server: SRV1", "Server: SRV2"],
+        )
+        self.assertIsNone(body["next"])
+
+    def test_type_filter_and_cursor(self):
+        body = self.get(type="server,diskarray", page_size=2)
+        names = [row["name"] for row in body["results"]]
+        self.assertEqual(names, ["DiskArray: DA1", "Server: SRV1"])
+
+        response = self.client.get(body["next"])
+        body = json.loads(b"".join(response.streaming_content))
+        self.assertEqual([row["name"] for row in body["results"]], ["Server: SRV2"])
+        self.assertIsNone(body["next"])
+
+    def test_repeated_type_is_listed_once(self):
+        body = self.get(type="server,server")
+        self.assertEqual([row["name"] for row in body["results"]], ["Server: SRV1", "Server: SRV2"])
+
+    def test_each_branch_is_limited(self):
+        with mock.patch.object(connection.features, "supports_slicing_ordering_in_compound", True):
+            query = datacenter_resources_query(self.datacenter.id, ["server", "network"], limit=3)
+            sql = str(query.query)
+        self.assertEqual(sql.count("LIMIT 3"), 3)
+
+    def test_unknown_type(self):
+        response = self.client.get(
+            f"/api/datacenters/{self.datacenter.id}/resources/", {"type": "rack"}
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class ExportTest(APITestCase):
+    def setUp(self):
+        self.datacenter = DataCenter.objects.create(name="DC1", location="Madrid")
+        for i in range(3):
+            Server.objects.create(
+                serial_number=f"SRV{i}",
+                model="Dell R740",
+                manufacturer="Dell",
+                storage=1024,
+                cpu=8,
+                ram=64,
+                datacenter=self.datacenter,
+            )
+
+    def export(self, user, output):
+        self.client.force_authenticate(user)
+        response = self.client.get("/api/servers/export/", {"output": output})
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content).decode()
+
+    def test_ndjson_export(self):
+        admin = User.objects.create_user(username="admin", password="adminpass", role=Role.ADMIN)
+        rows = [json.loads(line) for line in self.export(admin, "ndjson").splitlines()]
+        self.assertEqual([row["serial_number"] for row in rows], ["SRV0", "SRV1", "SRV2"])
+        self.assertEqual(rows[0]["datacenter"], self.datacenter.id)
+
+    def test_csv_export_hides_serial_numbers_from_operators(self):
+        operator = User.objects.create_user(username="operator", password="operatorpass")
+        lines = self.export(operator, "csv").splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith("id,model,manufacturer"))
+        self.assertNotIn("SRV0", "".join(lines))
+
+    def test_maintenance_export_projects_resource(self):
+        server = Server.objects.first()
+        MaintenanceRecord.objects.create(
+            title="Disk swap",
+            description="Replaced disk 3",
+            content_type=ContentType.objects.get_for_model(Server),
+            object_id=server.id,
+            datacenter=self.datacenter,
+        )
+        self.client.force_authenticate(User.objects.create_user(username="u", password="p"))
+        response = self.client.get("/api/maintenance/export/")
+        row = json.loads(b"".join(response.streaming_content))
+        self.assertEqual((row["resource_type"], row["resource_id"]), ("server", server.id))
+
+
+class BulkServerTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="admin", password="adminpass", role=Role.ADMIN
+        )
+        self.client.force_authenticate(self.user)
+        self.datacenter = DataCenter.objects.create(name="DC1", location="Dublin")
+        self.network = Network.objects.create(
+            name="LAN", cidr="10.0.0.0/24", datacenter=self.datacenter
+        )
+        Server.objects.create(
+            serial_number="SRV-EXISTING",
+            model="Dell R740",
+            manufacturer="Dell",
+            storage=1024,
+            cpu=8,
+            ram=64,
+            status="in_use",
+            ip_address="10.0.0.1",
+            network=self.network,
+            datacenter=self.datacenter,
+        )
+
+    def server(self, serial, **extra):
+        return {
+            "serial_number": serial,
+            "model": "Dell R740",
+            "manufacturer": "Dell",
+            "storage": 1024,
+            "cpu": 8,
+            "ram": 64,
+            "datacenter": self.datacenter.id,
+            **extra,
+        }
+
+    def test_bulk_create_uses_constant_queries(self):
+        def create(prefix, offset, count):
+            items = [
+                self.server(
+                    f"{prefix}{i}",
+                    status="in_use",
+                    ip_address=f"10.0.0.{offset + i}",
+                    network=self.network.id,
+                )
+                for i in range(count)
+            ]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post("/api/servers/bulk/", items, format="json")
+            self.assertEqual(response.status_code, 201, response.data)
+            self.assertEqual(len(response.data), count)
+            return len(queries)
+
+        self.assertEqual(create("A", 10, 2), create("B", 100, 20))
+        self.assertEqual(Server.objects.count(), 23)
+
+    def test_bulk_create_reports_per_item_errors(self):
+        items = [
+            self.server("NEW1"),
+            self.server("srv-existing"),
+            self.server("NEW2", status="in_use", ip_address="10.0.0.1", network=self.network.id),
+            self.server("NEW3", status="in_use", ip_address="192.168.0.5", network=self.network.id),
+            self.server("NEW4", ip_address="10.0.0.9"),
+            self.server("new1"),
+        ]
+        response = self.client.post("/api/servers/bulk/", items, format="json")
+        self.assertEqual(response.status_code, 400)
+        errors = response.data["errors"]
+        self.assertEqual(errors[0].keys(), {"serial_number"})
+        self.assertEqual(errors[1].keys(), {"serial_number"})
+        self.assertEqual(errors[2].keys(), {"ip_address"})
+        self.assertEqual(errors[3].keys(), {"ip_address"})
+        self.assertEqual(errors[4].keys(), {"ip_address"})
+        self.assertEqual(errors[5].keys(), {"serial_number"})
+        self.assertEqual(Server.objects.count(), 1)
+
+    def test_bulk_update_and_delete(self):
+        response = self.client.post(
+            "/api/servers/bulk/", [self.server("X1"), self.server("X2")], format="json"
+        )
+        ids = [row["id"] for row in response.data]
+
+        response = self.client.patch(
+            "/api/servers/bulk/",
+            [{"id": pk, "status": "maintenance"} for pk in ids],
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(Server.objects.filter(status="maintenance").count(), 2)
+
+        response = self.client.delete("/api/servers/bulk/", ids + [999], format="json")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.delete("/api/servers/bulk/", ids, format="json")
+        self.assertEqual(response.data, {"deleted": 2})
+        self.assertEqual(Server.objects.count(), 1)
+
+
+class CaseInsensitiveUniquenessTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="admin", password="adminpass", role=Role.ADMIN, email="admin@example.com"
+        )
+        self.client.force_authenticate(self.user)
+        self.datacenter = DataCenter.objects.create(name="DC1", location="Vienna")
+
+    def test_duplicate_serial_number_is_a_400(self):
+        payload = {
+            "serial_number": "SRV1",
+            "model": "Dell R740",
+            "manufacturer": "Dell",
+            "storage": 1024,
+            "cpu": 8,
+            "ram": 64,
+            "datacenter": self.datacenter.id,
+        }
+        self.assertEqual(self.client.post("/api/servers/", payload).status_code, 201)
+        response = self.client.post("/api/servers/", {**payload, "serial_number": "srv1"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("serial_number", response.data)
+
+    def test_datacenter_name(self):
+        response = self.client.post(
+            "/api/datacenters/",
+            {"name": "dc1", "location": "Graz", "admins": [self.user.id]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("name", response.data)
+
+        response = self.client.patch(
+            f"/api/datacenters/{self.datacenter.id}/", {"location": "Linz", "name": "DC1"}
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_user_email(self):
+        response = self.client.post(
+            "/api/users/",
+            {"username": "other", "password": "otherpass", "email": "ADMIN@example.com"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("email", response.data)
+
+
+class IPAMTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="admin", password="adminpass", role=Role.ADMIN
+        )
+        self.client.force_authenticate(self.user)
+        self.datacenter = DataCenter.objects.create(name="DC1", location="Prague")
+        self.network = Network.objects.create(
+            name="LAN", cidr="10.1.0.0/29", gateway="10.1.0.1", datacenter=self.datacenter
+        )
+        Server.objects.create(
+            serial_number="SRV1",
+            model="Dell R740",
+            manufacturer="Dell",
+            storage=1024,
+            cpu=8,
+            ram=64,
+            status="in_use",
+            ip_address="10.1.0.3",
+            network=self.network,
+            datacenter=self.datacenter,
+        )
+
+    def url(self, action):
+        return f"/api/networks/{self.network.id}/{action}/"
+
+    def test_next_free_skips_used_addresses(self):
+        response = self.client.get(self.url("next-free"), {"count": 3})
+        self.assertEqual(response.data["addresses"], ["10.1.0.2", "10.1.0.4", "10.1.0.5"])
+
+    def test_allocate_release_and_exhaustion(self):
+        response = self.client.post(self.url("allocate"), {"count": 2}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([row["address"] for row in response.data], ["10.1.0.2", "10.1.0.4"])
+
+        response = self.client.post(self.url("allocate"), {"count": 3}, format="json")
+        self.assertEqual(response.status_code, 409)
+
+        response = self.client.post(self.url("release"), {"addresses": ["10.1.0.2"]}, format="json")
+        self.assertEqual(response.data, {"released": 1})
+        response = self.client.get(self.url("next-free"))
+        self.assertEqual(response.data["addresses"], ["10.1.0.2"])
+
+    def test_allocate_for_deployment_job_in_one_round_trip(self):
+        network = Network.objects.create(name="Big", cidr="10.2.0.0/16", datacenter=self.datacenter)
+        job = DeploymentJob.objects.create(
+            name="batch", vm_name="web", vm_count=1000, datacenter=self.datacenter, network=network
+        )
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                f"/api/networks/{network.id}/allocate/", {"deployment_job": job.id}, format="json"
+            )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(job.ip_allocations.count(), 1000)
+        # SQLite splits the INSERT into batches, but nothing is probed per address
+        selects = [q for q in queries.captured_queries if q["sql"].startswith("SELECT")]
+        self.assertEqual(len(selects), 4)
+
+    def test_servers_cannot_take_allocated_addresses(self):
+        self.client.post(self.url("allocate"), {"count": 1}, format="json")
+        server = {
+            "serial_number": "SRV2",
+            "model": "Dell R740",
+            "manufacturer": "Dell",
+            "storage": 1024,
+            "cpu": 8,
+            "ram": 64,
+            "status": "in_use",
+            "ip_address": "10.1.0.2",
+            "network": self.network.id,
+            "datacenter": self.datacenter.id,
+        }
+        response = self.client.post("/api/servers/", server, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("ip_address", response.data)
+
+        response = self.client.post("/api/servers/bulk/", [server], format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("ip_address", response.data["errors"][0])
+        self.assertFalse(Server.objects.filter(serial_number="SRV2").exists())
+
+
+class NetworkContainmentTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="operator", password="operatorpass")
+        self.client.force_authenticate(self.user)
+        self.datacenter = DataCenter.objects.create(name="DC1", location="Bern")
+        self.wide = Network.objects.create(name="Wide", cidr="10.0.0.0/16", datacenter=self.datacenter)
+        self.narrow = Network.objects.create(name="Narrow", cidr="10.0.5.0/24", datacenter=self.datacenter)
+        self.other = Network.objects.create(name="Other", cidr="192.168.0.0/24", datacenter=self.datacenter)
+        Network.objects.create(name="V6", cidr="2001:db8::/64", datacenter=self.datacenter)
+
+    def names(self, **params):
+        response = self.client.get("/api/networks/", params)
+        self.assertEqual(response.status_code, 200)
+        return sorted(row["name"] for row in response.data["results"])
+
+    def test_list_filters(self):
+        self.assertEqual(self.names(contains="10.0.5.7"), ["Narrow", "Wide"])
+        self.assertEqual(self.names(contains="10.0.9.0/24"), ["Wide"])
+        self.assertEqual(self.names(contained_by="10.0.0.0/8"), ["Narrow", "Wide"])
+        self.assertEqual(self.names(overlaps="192.168.0.128/25"), ["Other"])
+        self.assertEqual(self.names(contains="2001:db8::1"), ["V6"])
+        self.assertEqual(self.client.get("/api/networks/", {"contains": "nope"}).status_code, 400)
+
+    def test_ip_lookup(self):
+        Server.objects.create(
+            serial_number="SRV1",
+            model="Dell R740",
+            manufacturer="Dell",
+            storage=1024,
+            cpu=8,
+            ram=64,
+            status="in_use",
+            ip_address="10.0.5.7",
+            network=self.narrow,
+            datacenter=self.datacenter,
+        )
+        response = self.client.get("/api/ip-lookup/", {"ip": "10.0.5.7"})
+        self.assertEqual([row["name"] for row in response.data["networks"]], ["Narrow", "Wide"])
+        self.assertEqual(len(response.data["servers"]), 1)
+
+    def test_cidr_with_host_bits_is_rejected(self):
+        admin = User.objects.create_user(username="admin", password="adminpass", role=Role.ADMIN)
+        self.client.force_authenticate(admin)
+        response = self.client.post(
+            "/api/networks/",
+            {"name": "Bad", "cidr": "10.9.0.5/24", "datacenter": self.datacenter.id},
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class CapacityEndpointTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="admin", password="adminpass", role=Role.ADMIN
+        )
+        self.client.force_authenticate(self.user)
+        self.datacenter = DataCenter.objects.create(name="DC1", location="Sofia")
+
+    def server(self, serial, **extra):
+        return {
+            "serial_number": serial,
+            "model": "Dell R740",
+            "manufacturer": "Dell",
+            "storage": 1000,
+            "cpu": 8,
+            "ram": 64,
+            "datacenter": self.datacenter.id,
+            **extra,
+        }
+
+    def test_capacity_tracks_api_writes(self):
+        self.client.post("/api/servers/", self.server("S1"), format="json")
+        self.client.post(
+            "/api/servers/bulk/",
+            [self.server("S2"), self.server("S3", status="maintenance")],
+            format="json",
+        )
+        url = f"/api/datacenters/{self.datacenter.id}/capacity/"
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(len(queries), 2)
+
+        servers = response.data["servers"]
+        self.assertEqual(servers["total"], {"count": 3, "cpu": 24, "ram": 192, "storage": 3000})
+        self.assertEqual(servers["available"]["count"], 2)
+        self.assertEqual(servers["by_status"]["maintenance"]["cpu"], 8)
+
+        pk = Server.objects.get(serial_number="S1").pk
+        self.client.patch("/api/servers/bulk/", [{"id": pk, "cpu": 32}], format="json")
+        self.client.delete(f"/api/servers/{Server.objects.get(serial_number='S3').pk}/")
+        servers = self.client.get(url).data["servers"]
+        self.assertEqual(servers["total"], {"count": 2, "cpu": 40, "ram": 128, "storage": 2000})
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    RESPONSE_CACHE_ENABLED=True,
+)
+class ResponseCacheTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user(username="admin", password="p", role=Role.ADMIN)
+        self.operator = User.objects.create_user(username="op", password="p")
+        self.client.force_authenticate(self.admin)
+        self.datacenter = DataCenter.objects.create(name="DC1", location="Lima")
+
+    def test_hit_until_model_changes(self):
+        first = self.client.get("/api/datacenters/")
+        self.assertEqual(first["X-Cache"], "MISS")
+
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get("/api/datacenters/")
+            unchanged = self.client.get("/api/datacenters/", HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(second["X-Cache"], "HIT")
+        self.assertEqual(json.loads(second.content), first.data)
+        self.assertEqual(unchanged.status_code, 304)
+
+        DataCenter.objects.create(name="DC2", location="Quito")
+        response = self.client.get("/api/datacenters/")
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertEqual(len(response.data["results"]), 2)
+
+    def test_deleting_an_admin_invalidates_datacenters(self):
+        self.datacenter.admins.add(self.operator)
+        before = DataCenter.objects.get(pk=self.datacenter.pk).updated_at
+        self.client.get("/api/datacenters/")
+        self.operator.delete()
+
+        response = self.client.get("/api/datacenters/")
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertEqual(response.data["results"][0]["admins"], [])
+        self.assertGreater(DataCenter.objects.get(pk=self.datacenter.pk).updated_at, before)
+
+    def test_key_includes_media_type(self):
+        html = self.client.get("/api/datacenters/", HTTP_ACCEPT="text/html")
+        self.assertTrue(html["Content-Type"].startswith("text/html"))
+        response = self.client.get("/api/datacenters/", HTTP_ACCEPT="application/json")
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertEqual(response["Content-Type"], "application/json")
+
+    def test_key_includes_query_params_and_role(self):
+        self.client.get("/api/networks/")
+        self.assertEqual(self.client.get("/api/networks/", {"page_size": 1})["X-Cache"], "MISS")
+        self.client.force_authenticate(self.operator)
+        self.assertEqual(self.client.get("/api/networks/")["X-Cache"], "MISS")
+
+    def test_datacenter_resources_invalidated_by_moves(self):
+        other = DataCenter.objects.create(name="DC2", location="Quito")
+        server = Server.objects.create(
+            serial_number="S1", model="R740", manufacturer="Dell",
+            storage=100, cpu=4, ram=16, datacenter=self.datacenter,
+        )
+        url = f"/api/datacenters/{self.datacenter.id}/resources/"
+        body = json.loads(b"".join(self.client.get(url).streaming_content))
+        self.assertEqual(len(body["results"]), 1)
+        self.assertEqual(self.client.get(url)["X-Cache"], "HIT")
+
+        server.datacenter = other
+        server.save()
+        response = self.client.get(url)
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertEqual(json.loads(b"".join(response.streaming_content))["results"], [])
+
+    def test_stats(self):
+        self.client.get("/api/clusters/")
+        self.client.get("/api/clusters/")
+        stats = self.client.get("/api/cache/stats/").data
+        self.assertEqual(stats["clusters"], {"hits": 1, "misses": 1, "hit_ratio": 0.5})
+
+        self.client.force_authenticate(self.operator)
+        self.assertEqual(self.client.get("/api/cache/stats/").status_code, 403)
+
+
+class ConditionalGetTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="admin", password="p", role=Role.ADMIN)
+        self.client.force_authenticate(self.user)
+        self.datacenter = DataCenter.objects.create(name="DC1", location="Riga")
+        self.server = Server.objects.create(
+            serial_number="S1", model="R740", manufacturer="Dell",
+            storage=100, cpu=4, ram=16, datacenter=self.datacenter,
+        )
+
+    def test_unchanged_list_costs_the_page_query(self):
+        etag = self.client.get("/api/servers/")["ETag"]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/servers/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(len(queries), 1)
+
+        self.client.patch("/api/servers/bulk/", [{"id": self.server.id, "cpu": 8}], format="json")
+        self.assertEqual(self.client.get("/api/servers/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_delete_and_params_change_etag(self):
+        etag = self.client.get("/api/servers/")["ETag"]
+        self.assertNotEqual(self.client.get("/api/servers/", {"page_size": 1})["ETag"], etag)
+        self.server.delete()
+        self.assertEqual(self.client.get("/api/servers/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_detail_if_modified_since(self):
+        url = f"/api/datacenters/{self.datacenter.id}/"
+        last_modified = self.client.get(url)["Last-Modified"]
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertEqual(self.client.get("/api/datacenters/0/").status_code, 404)
+
+    def test_datacenter_resources(self):
+        cache.clear()
+        url = f"/api/datacenters/{self.datacenter.id}/resources/"
+        # Streamed on a miss, tagged once cached
+        response = self.client.get(url)
+        self.assertFalse(response.has_header("ETag"))
+        b"".join(response.streaming_content)
+        with CaptureQueriesContext(connection) as queries:
+            etag = self.client.get(url)["ETag"]
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 0)
+
+        Cluster.objects.create(name="C1", datacenter=self.datacenter)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertEqual(self.client.get("/api/datacenters/0/resources/").status_code, 404)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ClaimsAuthenticationTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="admin", password="p", email="a@example.com", role=Role.ADMIN
+        )
+        token = MyAccessTokenSerializer().get_token(self.user).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def test_requests_do_not_load_the_user(self):
+        self.client.get("/api/servers/")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/servers/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 1)  # the page; the user is cached
+        self.assertEqual(
+            self.client.post("/api/datacenters/", {"name": "DC", "location": "Bern", "admins": [self.user.id]},
+                             format="json").status_code,
+            201,
+        )
+
+    def test_me_reads_cached_user_until_saved(self):
+        self.assertEqual(self.client.get("/api/me/").data["user"]["email"], "a@example.com")
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get("/api/me/")
+        self.assertFalse(any('"app_user"' in query["sql"] for query in queries))
+
+        self.user.email = "b@example.com"
+        self.user.save()
+        self.assertEqual(self.client.get("/api/me/").data["user"]["email"], "b@example.com")
+
+    def test_secrets_are_not_cached(self):
+        data = self.client.get("/api/me/").data["user"]
+        self.assertNotIn("password", data)
+        cached = cache.get(user_cache_key(self.user.id))
+        self.assertEqual(cached.get_deferred_fields(), {"password", "totp_secret"})
+
+        # A stale copy only writes the secret
+        User.objects.filter(pk=self.user.pk).update(email="c@example.com")
+        cached.generate_totp_secret()
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.email, self.user.totp_secret), ("c@example.com", cached.totp_secret))
+
+    def test_tokens_issued_before_a_change_are_rejected(self):
+        self.assertEqual(self.client.get("/api/users/").status_code, 200)
+        self.user.role = Role.OPERATOR
+        self.user.save()
+        self.assertEqual(self.client.get("/api/users/").status_code, 401)
+
+        self.user.role = Role.ADMIN
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get("/api/servers/").status_code, 401)
+
+        self.user.is_active = True
+        self.user.save()
+        self.assertEqual(self.client.get("/api/servers/").status_code, 200)
+        self.user.delete()
+        self.assertEqual(self.client.get("/api/servers/").status_code, 401)
+
+    def test_operator_claims(self):
+        operator = User.objects.create_user(username="op", password="p")
+        token = MyAccessTokenSerializer().get_token(operator).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+        self.assertEqual(self.client.get("/api/users/").status_code, 403)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class LoginTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="alice", password="secret", totp_secret=pyotp.random_base32()
+        )
+
+    def login(self, **extra):
+        return self.client.post(
+            "/api/login/", {"username": "alice", "password": "secret", **extra}, format="json"
+        )
+
+    def test_password_hashed_once_and_otp_not_replayable(self):
+        self.assertEqual(self.login().data["detail"], ["MFA_REQUIRED"])
+
+        otp = pyotp.TOTP(self.user.totp_secret).now()
+        with mock.patch.object(
+            PBKDF2PasswordHasher, "verify", autospec=True, side_effect=PBKDF2PasswordHasher.verify
+        ) as verify:
+            response = self.login(otp=otp)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("access_token", response.data)
+        self.assertEqual(verify.call_count, 1)
+
+        self.assertEqual(self.login(otp=otp).status_code, 400)
+
+    def test_throttled_before_hashing(self):
+        with mock.patch.object(LoginUserThrottle, "rate", "2/min", create=True), mock.patch.object(
+            PBKDF2PasswordHasher, "verify", autospec=True, return_value=False
+        ) as verify:
+            statuses = [self.login().status_code for _ in range(3)]
+        self.assertEqual(statuses, [401, 401, 429])
+        self.assertEqual(verify.call_count, 2)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class MFAQRCodeTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="bob", password="p", email="b@example.com")
+        self.client.force_authenticate(self.user)
+
+    def test_setup_renders_once(self):
+        with mock.patch("app.mfa.render_qr", wraps=mfa.render_qr) as render:
+            first = self.client.get("/api/mfa/setup/", {"image": "svg"})
+            second = self.client.get("/api/mfa/setup/", {"image": "svg"})
+            self.client.get(first.data["qr_code_url"])
+            self.client.get(second.data["qr_code_url"])
+        self.assertEqual(render.call_count, 1)
+        self.assertNotIn("qr_code_base64", first.data)
+        self.assertEqual(first.data, second.data)
+        self.assertIn("secret=", first.data["otp_uri"])
+
+    def test_binary_endpoint(self):
+        response = self.client.get("/api/mfa/qr/", {"image": "svg"})
+        self.assertEqual(response["Content-Type"], "image/svg+xml")
+        self.assertIn(b"<svg", response.content)
+        self.assertEqual(response["Cache-Control"], "private, max-age=300")
+
+        again = self.client.get("/api/mfa/qr/", {"image": "svg"}, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(self.client.get("/api/mfa/qr/", {"image": "gif"}).status_code, 400)
+
+
+class DeploymentTemplateTest(APITestCase):
+    def test_unknown_template_is_rejected(self):
+        self.client.force_authenticate(User.objects.create_user(username="u", password="p"))
+        datacenter = DataCenter.objects.create(name="DC1", location="Turin")
+        response = self.client.post(
+            "/api/deployments/",
+            {"name": "web", "vm_name": "web", "datacenter": datacenter.id, "template": "nope"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("vsphere_vm", str(response.data["template"]))
+
+
+class DeploymentOutputTest(APITestCase):
+    def setUp(self):
+        self.client.force_authenticate(User.objects.create_user(username="u", password="p"))
+        datacenter = DataCenter.objects.create(name="DC1", location="Kyiv")
+        self.job = DeploymentJob.objects.create(
+            name="web", vm_name="web", datacenter=datacenter, status="running"
+        )
+        self.url = f"/api/deployments/{self.job.id}/output/"
+
+    @mock.patch("app.views.deployment_views.read_output")
+    def test_long_poll_resumes_from_offset(self, read_output):
+        read_output.return_value = ([("1-0", "Plan: 1 to add")], "1-0", None)
+        response = self.client.get(self.url, {"after": "0-5", "wait": 5})
+        read_output.assert_called_once_with(self.job.id, "0-5", block_ms=5000)
+        self.assertEqual(response.data, {
+            "lines": ["Plan: 1 to add"], "next": "1-0", "finished": False, "status": None,
+        })
+
+    @mock.patch("app.views.deployment_views.read_output")
+    def test_event_stream(self, read_output):
+        read_output.return_value = ([("2-0", "done")], "3-0", "completed")
+        response = self.client.get(self.url, HTTP_ACCEPT="text/event-stream", HTTP_LAST_EVENT_ID="1-0")
+        body = b"".join(response.streaming_content).decode()
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual(body, 'id: 2-0\ndata: "done"\n\nevent: end\ndata: {"status": "completed"}\n\n')
+        self.assertEqual(read_output.call_args.args[1], "1-0")
+
+    @mock.patch("app.views.deployment_views.output_exists", return_value=False)
+    def test_expired_output_of_finished_job(self, output_exists):
+        DeploymentJob.objects.filter(pk=self.job.pk).update(status="completed")
+        response = self.client.get(self.url)
+        self.assertTrue(response.data["finished"])
+        self.assertEqual(self.client.get("/api/deployments/0/output/").status_code, 404)
+
+
+class FakeObjectResponse:
+    def __init__(self, data):
+        self.data = data
+        self.released = False
+
+    def stream(self, chunk_size):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        self.released = True
+
+
+class DeploymentLogsTest(APITestCase):
+    def setUp(self):
+        self.client.force_authenticate(User.objects.create_user(username="u", password="p"))
+        datacenter = DataCenter.objects.create(name="DC1", location="Kyiv")
+        self.job = DeploymentJob.objects.create(name="web", vm_name="web", datacenter=datacenter)
+        self.url = f"/api/deployments/{self.job.id}/logs/"
+        self.log = "".join(f"line {i} ✓\n" for i in range(5000)).encode()
+        self.responses = []
+
+        patcher = mock.patch("app.minio_client.get_client")
+        minio = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        minio.stat_object.return_value.size = len(self.log)
+        minio.get_object.side_effect = self.get_object
+
+    def get_object(self, bucket, name, offset=0, length=0):
+        data = self.log[offset:offset + length] if length else self.log[offset:]
+        self.responses.append(FakeObjectResponse(data))
+        return self.responses[-1]
+
+    def test_tail_reads_only_the_end(self):
+        response = self.client.get(self.url, {"tail": 3})
+        body = b"".join(response.streaming_content)
+        self.assertEqual(body.decode(), "line 4997 ✓\nline 4998 ✓\nline 4999 ✓\n")
+        self.assertEqual(int(response["X-Log-Size"]), len(self.log))
+        self.assertEqual(len(self.responses), 1)
+        self.assertLessEqual(len(self.responses[0].data), 64 * 1024)
+        self.assertTrue(self.responses[0].released)
+
+    def test_byte_range(self):
+        response = self.client.get(self.url, {"offset": 7, "limit": 10})
+        self.assertEqual(b"".join(response.streaming_content), self.log[7:17])
+        self.assertEqual(response["X-Log-Offset"], "7")
+        self.assertEqual(self.client.get(self.url, {"offset": -1}).status_code, 400)
+
+    def test_full_log_streams_json(self):
+        response = self.client.get(self.url)
+        body = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(body["logs"], self.log.decode())
+        self.assertTrue(all(r.released for r in self.responses))
+
+
+class DeploymentArtifactsTest(APITestCase):
+    def setUp(self):
+        self.client.force_authenticate(User.objects.create_user(username="u", password="p"))
+        datacenter = DataCenter.objects.create(name="DC1", location="Kyiv")
+        self.job = DeploymentJob.objects.create(name="web", vm_name="web", datacenter=datacenter)
+
+    @mock.patch("app.minio_client.get_client")
+    def test_lists_objects_with_presigned_urls(self, get_client):
+        minio = get_client.return_value
+        prefix = f"job_{self.job.id}/"
+        minio.list_objects.return_value = [
+            mock.Mock(object_name=prefix + "main.tf", size=120, last_modified=None),
+            mock.Mock(object_name=prefix + "logs.txt", size=4096, last_modified=None),
+        ]
+        minio.presigned_get_object.side_effect = lambda bucket, name, expires: f"https://minio/{name}?sig"
+
+        response = self.client.get(f"/api/deployments/{self.job.id}/artifacts/")
+        minio.list_objects.assert_called_once_with("terraform-jobs", prefix=prefix, recursive=True)
+        self.assertEqual(response["Cache-Control"], "no-store")
+        self.assertEqual(
+            [(a["name"], a["size"], a["url"]) for a in response.data["artifacts"]],
+            [("main.tf", 120, f"https://minio/{prefix}main.tf?sig"),
+             ("logs.txt", 4096, f"https://minio/{prefix}logs.txt?sig")],
+        )
+        self.assertEqual(self.client.get("/api/deployments/0/artifacts/").status_code, 404)
+
+
+@override_settings(METRICS_TOKEN="secret")
+class MetricsTest(APITestCase):
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    @mock.patch("app.metrics.get_redis")
+    def test_requests_and_queues_are_reported(self, get_redis):
+        get_redis.return_value.pipeline.return_value.execute.return_value = [3, 1]
+        self.client.force_authenticate(User.objects.create_user(username="u", password="p"))
+        route = resolve("/api/servers/").route
+        requests = self.sample("http_request_duration_seconds_count", method="GET", route=route, status="200")
+        queries = self.sample("http_request_db_queries_sum", route=route)
+
+        with CaptureQueriesContext(connection) as captured:
+            self.client.get("/api/servers/")
+        self.assertEqual(
+            self.sample("http_request_duration_seconds_count", method="GET", route=route, status="200"),
+            requests + 1,
+        )
+        self.assertEqual(self.sample("http_request_db_queries_sum", route=route), queries + len(captured))
+
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('celery_queue_length{queue="celery"} 3.0', body)
+        self.assertIn('celery_queue_length{queue="deployments"} 1.0', body)
+
+    @mock.patch("app.metrics.get_redis")
+    def test_token(self, get_redis):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+        with override_settings(METRICS_TOKEN=""):
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer ").status_code, 403)
+
+    def test_streaming_responses_are_timed_until_the_first_chunk(self):
+        cache.clear()
+        self.client.force_authenticate(User.objects.create_user(username="u", password="p"))
+        datacenter = DataCenter.objects.create(name="DC1", location="Oslo")
+        url = f"/api/datacenters/{datacenter.id}/resources/"
+        labels = dict(method="GET", route=resolve(url).route, status="200")
+        before = self.sample("http_request_duration_seconds_count", **labels)
+
+        response = self.client.get(url)
+        self.assertEqual(self.sample("http_request_duration_seconds_count", **labels), before)
+        b"".join(response.streaming_content)
+        self.assertEqual(self.sample("http_request_duration_seconds_count", **labels), before + 1)
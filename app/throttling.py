@@ -0,0 +1,22 @@
+from rest_framework.throttling import SimpleRateThrottle
+
+
+class LoginIPThrottle(SimpleRateThrottle):
+    """Login attempts per client IP, checked before any password hashing."""
+
+    scope = "login_ip"
+
+    def get_cache_key(self, request, view):
+        return self.cache_format % {"scope": self.scope, "ident": self.get_ident(request)}
+
+
+class LoginUserThrottle(SimpleRateThrottle):
+    """Login attempts per username, whichever IP they come from."""
+
+    scope = "login_user"
+
+    def get_cache_key(self, request, view):
+        username = request.data.get("username")
+        if not isinstance(username, str) or not username:
+            return None
+        return self.cache_format % {"scope": self.scope, "ident": username.lower()}
@@ -2,13 +2,16 @@ from django.contrib import admin
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
+from app.metrics import metrics_view
 from app.swagger import schema_view
-from app.views.auth_views import MyTokenObtainPairView, get_me, mfa_setup
-from app.views.deployment_views import DeploymentJobLogsView, DeploymentJobView
+from app.views.auth_views import MyTokenObtainPairView, get_me, mfa_qr, mfa_setup
+from app.views.deployment_views import (DeploymentJobArtifactsView, DeploymentJobLogsView, DeploymentJobOutputView,
+                                        DeploymentJobView)
 from app.views.viewsets import (ClusterViewSet, DataCenterViewSet, DiskArrayViewSet,
                                 MaintenanceRecordViewSet, NetworkViewSet,
                                 ServerDiskArrayMapViewSet, ServerViewSet,
-                                UserViewSet, get_datacenter_resources)
+                                UserViewSet, get_datacenter_resources, ip_lookup,
+                                response_cache_stats)
 
 router = DefaultRouter()
 router.register(r"users", UserViewSet)
@@ -30,8 +33,14 @@ urlpatterns = [
     path("api/login/", MyTokenObtainPairView.as_view(), name="token_obtain_pair"),
     path("api/me/", get_me, name="get-me"),
     path("api/mfa/setup/", mfa_setup, name="mfa_setup"),
+    path("api/mfa/qr/", mfa_qr, name="mfa_qr"),
     path("api/", include(router.urls)),
     path("api/deployments/", DeploymentJobView.as_view(), name="create-deployment"),
     path("api/deployments/<int:job_id>/logs/", DeploymentJobLogsView.as_view(), name="deployment-logs"),
+    path("api/deployments/<int:job_id>/artifacts/", DeploymentJobArtifactsView.as_view(), name="deployment-artifacts"),
+    path("api/deployments/<int:job_id>/output/", DeploymentJobOutputView.as_view(), name="deployment-output"),
     path('api/datacenters/<int:id>/resources/', get_datacenter_resources, name='datacenter-resources'),
+    path("api/ip-lookup/", ip_lookup, name="ip-lookup"),
+    path("api/cache/stats/", response_cache_stats, name="response-cache-stats"),
+    path("metrics", metrics_view, name="metrics"),
 ]
@@ -1,9 +1,13 @@
-import base64
-from io import BytesIO
-
+from app import conditional
+from app.authentication import get_model_user
+from app.mfa import QR_CONTENT_TYPES, provisioning_uri, qr_digest, qr_image
 from app.serializers import UserSerializer
+from app.throttling import LoginIPThrottle, LoginUserThrottle
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.urls import reverse
+from django.utils.http import quote_etag
 import pyotp
-import qrcode
 from rest_framework import serializers
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
@@ -15,6 +19,7 @@ from rest_framework_simplejwt.views import TokenObtainPairView
 class MyAccessTokenSerializer(TokenObtainPairSerializer):
     otp = serializers.CharField(required=False)
 
+    @classmethod
     def get_token(cls, user):
         token = super().get_token(user)
 
@@ -24,7 +29,7 @@ class MyAccessTokenSerializer(TokenObtainPairSerializer):
         return token
 
     def validate(self, attrs):
-
+        # Authenticates (one password hash) and issues the tokens
         data = super().validate(attrs)
         user = self.user
 
@@ -36,38 +41,76 @@ class MyAccessTokenSerializer(TokenObtainPairSerializer):
             totp = pyotp.TOTP(user.totp_secret)
             if not totp.verify(otp):
                 raise serializers.ValidationError("Invalid OTP")
-
-        data = super().validate(attrs)
+            if not claim_otp(user, otp, totp.interval):
+                raise serializers.ValidationError("OTP already used")
 
         return {
             "access_token": data["access"],
         }
 
 
+def claim_otp(user, otp, interval):
+    """
+    Mark `otp` as used by `user`. Returns False if it was already used, so
+    a code observed in transit cannot be replayed while it is still valid.
+    """
+    return cache.add(f"auth:otp:{user.pk}:{otp}", True, timeout=interval * 2)
+
+
 class MyTokenObtainPairView(TokenObtainPairView):
     serializer_class = MyAccessTokenSerializer
+    throttle_classes = [LoginIPThrottle, LoginUserThrottle]
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def get_me(request):
-    user = request.user
+    user = get_model_user(request)
     serializer = UserSerializer(user)
     return Response({"user": serializer.data})
 
+
+def qr_image_format(request):
+    image_format = request.query_params.get("image", "png")
+    if image_format not in QR_CONTENT_TYPES:
+        raise serializers.ValidationError(
+            {"image": f"Expected one of: {', '.join(QR_CONTENT_TYPES)}."}
+        )
+    return image_format
+
+
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def mfa_setup(request):
-    user = request.user
+    image_format = qr_image_format(request)
+    user = get_model_user(request)
     user.generate_totp_secret()
 
-    totp = pyotp.TOTP(user.totp_secret)
-    otp_uri = totp.provisioning_uri(name=user.email, issuer_name="Inventory App")
-
-    qr = qrcode.make(otp_uri)
-    buffer = BytesIO()
-    qr.save(buffer, format="PNG")
-    qr_b64 = base64.b64encode(buffer.getvalue()).decode()
-
+    # The image itself is served by `mfa_qr`
     return Response(
-        {"otp_uri": otp_uri, "qr_code_base64": f"data:image/png;base64,{qr_b64}"}
+        {
+            "otp_uri": provisioning_uri(user),
+            "qr_code_url": request.build_absolute_uri(
+                f"{reverse('mfa_qr')}?image={image_format}"
+            ),
+        }
     )
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def mfa_qr(request):
+    """The provisioning QR code as an image (`?image=png|svg`)."""
+    image_format = qr_image_format(request)
+    user = get_model_user(request)
+    user.generate_totp_secret()
+
+    etag = quote_etag(qr_digest(user, image_format))
+    response = conditional.not_modified(request, etag, None)
+    if response is None:
+        response = HttpResponse(
+            qr_image(user, image_format), content_type=QR_CONTENT_TYPES[image_format]
+        )
+    response["ETag"] = etag
+    # The image embeds the TOTP secret: never store it in shared caches
+    response["Cache-Control"] = "private, max-age=300"
+    return response
@@ -1,11 +1,20 @@
-from app.minio_client import get_file_from_minio
-from app.tasks import deploy_vm_via_terraform
+import json
+import time
 
+from app.job_output import output_exists, read_output
+from app.minio_client import iter_object, list_objects, object_size, presigned_url, read_tail
+from app.streaming import iter_json_text
+from app.tasks import enqueue_deployment
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from minio.error import S3Error
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 
-from app.models import DeploymentJob
+from app.models import DeploymentJob, JobStatus
 from app.serializers import DeploymentJobSerializer
 from rest_framework.permissions import IsAuthenticated
 
@@ -14,15 +23,15 @@ class DeploymentJobView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        jobs = DeploymentJob.objects.all().order_by('-created_at')
+        jobs = DeploymentJob.objects.prefetch_related('phases').order_by('-created_at')
         serializer = DeploymentJobSerializer(jobs, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
     
     def post(self, request):
         serializer = DeploymentJobSerializer(data=request.data)
         if serializer.is_valid():
-            job = serializer.save(status="pending")
-            deploy_vm_via_terraform.delay(job.id)
+            job = serializer.save(status=JobStatus.PENDING)
+            enqueue_deployment(job)
             return Response({
                 "message": "Deployment started.",
                 "job_id": job.id,
@@ -32,17 +41,178 @@ class DeploymentJobView(APIView):
 
 
 class DeploymentJobLogsView(APIView):
+    """
+    Logs of a job, read from MinIO.
+
+    `?tail=N` returns the last N lines and `?offset=&limit=` a byte range,
+    both streamed as `text/plain` with the full size in `X-Log-Size` so
+    clients can page. Without parameters the whole log is streamed as
+    `{"logs": "..."}`.
+    """
+
     permission_classes = [IsAuthenticated]
+
     def get(self, request, job_id):
         try:
             job = DeploymentJob.objects.get(id=job_id)
-            bucket = "terraform-jobs"
-            object_name = f"job_{job.id}/logs.txt"
+        except DeploymentJob.DoesNotExist:
+            return Response({"error": "Deployment job not found."}, status=status.HTTP_404_NOT_FOUND)
 
-            logs = get_file_from_minio(bucket, object_name)
-            return Response({"logs": logs}, status=status.HTTP_200_OK)
+        try:
+            tail, offset, limit = (
+                self.non_negative_int(request, name) for name in ("tail", "offset", "limit")
+            )
+        except ValueError as exc:
+            return Response({str(exc): "Expected a non-negative integer."}, status=status.HTTP_400_BAD_REQUEST)
 
-        except DeploymentJob.DoesNotExist:
+        bucket = "terraform-jobs"
+        object_name = f"{job.storage_prefix}logs.txt"
+        try:
+            size = object_size(bucket, object_name)
+            if tail is not None:
+                content = [read_tail(bucket, object_name, tail, size=size)]
+            elif offset is not None or limit is not None:
+                offset = min(offset or 0, size)
+                length = min(limit, size - offset) if limit is not None else size - offset
+                content = iter_object(bucket, object_name, offset, length) if length else iter([])
+            else:
+                return StreamingHttpResponse(
+                    iter_json_text("logs", iter_object(bucket, object_name)),
+                    content_type="application/json",
+                )
+        except S3Error as e:
+            if e.code == "NoSuchKey":
+                return Response({"error": "Logs not found."}, status=status.HTTP_404_NOT_FOUND)
+            return Response({"error": f"Failed to retrieve logs: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        except Exception as e:
+            return Response({"error": f"Failed to retrieve logs: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        response = StreamingHttpResponse(content, content_type="text/plain; charset=utf-8")
+        response["X-Log-Size"] = size
+        if tail is None:
+            response["X-Log-Offset"] = offset
+        return response
+
+    def non_negative_int(self, request, name):
+        value = request.query_params.get(name)
+        if value is None:
+            return None
+        if not value.isdigit():
+            raise ValueError(name)
+        return int(value)
+
+
+class DeploymentJobArtifactsView(APIView):
+    """
+    List the objects a job stored in MinIO, each with a short-lived
+    pre-signed URL, so clients download them from object storage directly.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id):
+        job = DeploymentJob.objects.filter(id=job_id).only("artifact_prefix").first()
+        if job is None:
             return Response({"error": "Deployment job not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        bucket = "terraform-jobs"
+        prefix = job.storage_prefix
+        expires = settings.ARTIFACT_URL_EXPIRY
+        try:
+            artifacts = [
+                {
+                    "name": obj.object_name[len(prefix):],
+                    "size": obj.size,
+                    "last_modified": obj.last_modified,
+                    "url": presigned_url(bucket, obj.object_name, expires),
+                }
+                for obj in list_objects(bucket, prefix)
+            ]
+        except S3Error as e:
+            if e.code != "NoSuchBucket":
+                return Response({"error": f"Failed to list artifacts: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            artifacts = []
         except Exception as e:
-            return Response({"error": f"Failed to retrieve logs: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+            return Response({"error": f"Failed to list artifacts: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        response = Response({"job_id": job_id, "expires_in": expires, "artifacts": artifacts})
+        # The URLs grant access to the objects until they expire
+        response["Cache-Control"] = "no-store"
+        return response
+
+
+class EventStreamRenderer(BaseRenderer):
+    media_type = "text/event-stream"
+    format = "sse"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data).encode()
+
+
+class DeploymentJobOutputView(APIView):
+    """
+    Tail the live Terraform output of a job.
+
+    With `Accept: text/event-stream` lines are pushed as server-sent events
+    whose ids are resume offsets (browsers send them back as
+    `Last-Event-ID`). Otherwise it long-polls: `?after=<offset>&wait=<s>`
+    returns the lines after `after`, waiting up to `wait` seconds for new
+    ones, with the `next` offset to poll from.
+    """
+
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [JSONRenderer, EventStreamRenderer]
+
+    MAX_WAIT = 30
+    # Event streams are closed after this long; clients reconnect and resume
+    STREAM_DURATION = 300
+    TERMINAL_STATUSES = (JobStatus.COMPLETED, JobStatus.FAILED)
+
+    def get(self, request, job_id):
+        job = DeploymentJob.objects.filter(id=job_id).only("status").first()
+        if job is None:
+            return Response({"error": "Deployment job not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        after = request.query_params.get("after") or request.META.get("HTTP_LAST_EVENT_ID") or "0-0"
+        if job.status in self.TERMINAL_STATUSES and not output_exists(job.id):
+            # Output has expired (or predates streaming); the logs view has it
+            if request.accepted_renderer.format == "sse":
+                return self.event_stream(iter([self.end_event(job.status)]))
+            return Response({"lines": [], "next": after, "finished": True, "status": job.status})
+
+        if request.accepted_renderer.format == "sse":
+            return self.event_stream(self.events(job.id, after))
+
+        try:
+            wait = min(max(float(request.query_params.get("wait", 0)), 0), self.MAX_WAIT)
+        except ValueError:
+            return Response({"wait": "Expected a number of seconds."}, status=status.HTTP_400_BAD_REQUEST)
+        lines, last_id, final_status = read_output(job.id, after, block_ms=int(wait * 1000) or None)
+        return Response({
+            "lines": [text for _, text in lines],
+            "next": last_id,
+            "finished": final_status is not None,
+            "status": final_status,
+        })
+
+    def event_stream(self, events):
+        response = StreamingHttpResponse(events, content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    def end_event(self, final_status):
+        return f"event: end\ndata: {json.dumps({'status': final_status})}\n\n"
+
+    def events(self, job_id, after):
+        deadline = time.monotonic() + self.STREAM_DURATION
+        while time.monotonic() < deadline:
+            lines, after, final_status = read_output(job_id, after, block_ms=15000)
+            for entry_id, text in lines:
+                yield f"id: {entry_id}\ndata: {json.dumps(text)}\n\n"
+            if final_status is not None:
+                yield self.end_event(final_status)
+                return
+            if not lines:
+                yield ": keep-alive\n\n"
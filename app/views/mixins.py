@@ -0,0 +1,302 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from .. import conditional, response_cache
+from ..bulk import merge_errors, preload_related
+from ..models import Role
+from ..serializers import constraint_validation_error
+from ..signals import bulk_saved
+from ..streaming import EXPORT_FORMATS, stream_export
+
+
+class ExportMixin:
+    """
+    Adds `GET <list>/export/?output=ndjson|csv` to a ViewSet.
+
+    Rows are read with `values()` and a chunked `iterator()`, so the whole
+    table is streamed without building model or serializer instances.
+    """
+
+    export_fields = ()
+    export_expressions = {}
+    admin_only_fields = ()
+    export_chunk_size = 2000
+
+    def get_export_fields(self):
+        fields = list(self.export_fields) + list(self.export_expressions)
+        user = self.request.user
+        if getattr(user, "role", None) != Role.ADMIN:
+            fields = [field for field in fields if field not in self.admin_only_fields]
+        return fields
+
+    @action(detail=False, methods=["get"])
+    def export(self, request):
+        output = request.query_params.get("output", "ndjson")
+        if output not in EXPORT_FORMATS:
+            return Response(
+                {"output": f"Expected one of: {', '.join(EXPORT_FORMATS)}."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        fields = self.get_export_fields()
+        names = [field for field in fields if field in self.export_fields]
+        expressions = {
+            name: expression
+            for name, expression in self.export_expressions.items()
+            if name in fields
+        }
+        queryset = (
+            self.filter_queryset(self.get_queryset())
+            .select_related(None)
+            .prefetch_related(None)
+            .order_by("pk")
+            .values(*names, **expressions)
+        )
+        rows = queryset.iterator(chunk_size=self.export_chunk_size)
+        return stream_export(rows, fields, output, self.basename)
+
+
+class BulkMixin:
+    """
+    Adds `POST|PATCH|DELETE <list>/bulk/` to a ViewSet.
+
+    - POST takes a list of objects to create.
+    - PATCH takes a list of partial objects, each with its `id`.
+    - DELETE takes a list of ids.
+
+    Items are validated as a set: related objects are preloaded with one
+    query per model and `validate_bulk` checks the whole batch. Nothing is
+    written unless every item is valid; otherwise the response is a 400 with
+    one error object per item, in request order. Writes use `bulk_create` /
+    `bulk_update` inside a single transaction.
+    """
+
+    bulk_max_items = 1000
+
+    def validate_bulk(self, rows):
+        """Return `{index: {field: [errors]}}` for the `(index, attrs, instance)` rows."""
+        return {}
+
+    def validate_locked(self, objects, fields):
+        """
+        Last check of `objects` inside the write transaction, before they
+        are written; `fields` are the updated fields, None on create.
+        Returns `{index: {field: [errors]}}`.
+        """
+        return {}
+
+    @action(detail=False, methods=["post", "patch", "delete"], url_path="bulk")
+    def bulk(self, request):
+        items = request.data
+        if not isinstance(items, list) or not items:
+            return Response(
+                {"detail": "Expected a non-empty list."}, status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(items) > self.bulk_max_items:
+            return Response(
+                {"detail": f"At most {self.bulk_max_items} items per request."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if request.method == "DELETE":
+            return self.bulk_destroy(items)
+        if request.method == "PATCH":
+            return self.bulk_update(items)
+        return self.bulk_create(items)
+
+    def bulk_create(self, items):
+        serializers, errors = self.validate_items(items, [None] * len(items))
+        if any(errors):
+            return Response({"errors": errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        model = self.get_queryset().model
+        objects = [model(**serializer.validated_data) for serializer in serializers]
+        self.write_bulk(model.objects.bulk_create, objects, created=True, fields=None)
+        data = self.get_serializer(objects, many=True).data
+        return Response(data, status=status.HTTP_201_CREATED)
+
+    def bulk_update(self, items):
+        model = self.get_queryset().model
+        ids = [item.get("id") if isinstance(item, dict) else None for item in items]
+        instances = self.get_queryset().in_bulk([pk for pk in ids if isinstance(pk, int)])
+        missing = [
+            {} if pk in instances else {"id": ["Unknown or missing id."]} for pk in ids
+        ]
+        if any(missing):
+            return Response({"errors": missing}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializers, errors = self.validate_items(items, [instances[pk] for pk in ids])
+        if any(errors):
+            return Response({"errors": errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        objects, fields = [], set()
+        for serializer in serializers:
+            for field, value in serializer.validated_data.items():
+                setattr(serializer.instance, field, value)
+                fields.add(field)
+            objects.append(serializer.instance)
+        if fields:
+            # `bulk_update` does not apply `auto_now`
+            now = timezone.now()
+            for obj in objects:
+                obj.updated_at = now
+            fields.add("updated_at")
+            self.write_bulk(
+                model.objects.bulk_update, objects, sorted(fields), created=False, fields=fields
+            )
+        data = self.get_serializer(objects, many=True).data
+        return Response(data, status=status.HTTP_200_OK)
+
+    def bulk_destroy(self, ids):
+        queryset = self.get_queryset()
+        found = set(
+            queryset.filter(pk__in=[pk for pk in ids if isinstance(pk, int)]).values_list(
+                "pk", flat=True
+            )
+        )
+        errors = [{} if pk in found else {"id": ["Unknown id."]} for pk in ids]
+        if any(errors):
+            return Response({"errors": errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            queryset.filter(pk__in=found).delete()
+        return Response({"deleted": len(found)}, status=status.HTTP_200_OK)
+
+    def write_bulk(self, write, objects, *args, created, fields):
+        """
+        Run a bulk write in one transaction and send `bulk_saved`. Errors
+        from `validate_locked` and unique constraint violations caused by
+        concurrent writers are reported like serializer errors.
+        """
+        model = self.get_queryset().model
+        try:
+            with transaction.atomic():
+                errors = self.validate_locked(objects, fields)
+                if errors:
+                    raise ValidationError(
+                        {"errors": [errors.get(index, {}) for index in range(len(objects))]}
+                    )
+                write(objects, *args)
+                bulk_saved.send(sender=model, instances=objects, created=created)
+        except IntegrityError as exc:
+            constraint_errors = getattr(self.get_serializer(), "unique_constraint_errors", {})
+            error = constraint_validation_error(exc, constraint_errors)
+            if error is None:
+                raise
+            raise error from exc
+
+    def validate_items(self, items, instances):
+        context = self.get_serializer_context()
+        context["preloaded"] = preload_related(self.get_serializer(), items)
+
+        serializers, errors = [], []
+        for item, instance in zip(items, instances):
+            serializer = self.get_serializer(
+                instance, data=item, partial=instance is not None, context=context
+            )
+            errors.append({} if serializer.is_valid() else dict(serializer.errors))
+            serializers.append(serializer)
+
+        rows = [
+            (index, serializer.validated_data, serializer.instance)
+            for index, serializer in enumerate(serializers)
+            if not errors[index]
+        ]
+        merge_errors(errors, self.validate_bulk(rows))
+        return serializers, errors
+
+
+class CachedResponseMixin:
+    """
+    Serve `list` and `retrieve` from the response cache.
+
+    `response_cache_scopes` are the scopes the responses depend on; the
+    signal handlers in `app.signals` invalidate them when the underlying
+    rows change.
+    """
+
+    response_cache_name = None
+    response_cache_scopes = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.response_cache_name:
+            response_cache.CACHED_ENDPOINTS.add(cls.response_cache_name)
+
+    def list(self, request, *args, **kwargs):
+        return self.serve_cached(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.serve_cached(super().retrieve, request, *args, **kwargs)
+
+    def serve_cached(self, handler, request, *args, **kwargs):
+        if not settings.RESPONSE_CACHE_ENABLED:
+            return handler(request, *args, **kwargs)
+        key = response_cache.cache_key(request, list(self.response_cache_scopes))
+        hit = response_cache.lookup(self.response_cache_name, key)
+        if hit is not None:
+            return hit
+        self.response_cache_key = key
+        return handler(request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        key = getattr(self, "response_cache_key", None)
+        if key and response.status_code == 200 and isinstance(response, Response):
+            response.render()
+            response_cache.store(key, response.content, response["Content-Type"])
+            response["X-Cache"] = "MISS"
+        return response
+
+
+class ConditionalGetMixin:
+    """
+    Honour `If-None-Match` on `list` and `If-None-Match` and
+    `If-Modified-Since` on `retrieve`.
+
+    Details are validated by the `updated_at` of the object. List ETags
+    are a digest of the page served, so they cost no query on top of the
+    page itself (none at all when it comes from the response cache); an
+    aggregate over the whole queryset would cost more than a keyset page.
+    On a cache miss the page is still read and rendered, and a 304 only
+    saves sending it. Lists have no `Last-Modified`. Place it before
+    `CachedResponseMixin` so cached pages are validated too.
+    """
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self.action == "list" and response.status_code == 200 and not response.streaming:
+            return self.conditional_page(request, response)
+        return response
+
+    def conditional_page(self, request, response):
+        if isinstance(response, Response):
+            response.render()
+        return conditional.validate_page(request, response)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        last_modified = (
+            self.filter_queryset(self.get_queryset())
+            .filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+            .values_list("updated_at", flat=True)
+            .first()
+        )
+        if last_modified is None:
+            # Let `get_object` answer 404
+            return super().retrieve(request, *args, **kwargs)
+        return self.conditional_get(
+            super().retrieve, (last_modified,), last_modified, request, *args, **kwargs
+        )
+
+    def conditional_get(self, handler, state, last_modified, request, *args, **kwargs):
+        etag = conditional.make_etag(request, *state)
+        response = conditional.not_modified(request, etag, last_modified)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        return conditional.set_validators(response, etag, last_modified)
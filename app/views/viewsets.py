@@ -1,15 +1,30 @@
+import base64
+import ipaddress
+
 from rest_framework import viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from django.contrib.contenttypes.models import ContentType
-
-from ..models import (Cluster, DataCenter, DeploymentJob, DiskArray, MaintenanceRecord, Network, Server,
-                      ServerDiskArrayMap, User)
+from django.db import IntegrityError, connections
+from django.db.models import CharField, F, IntegerField, Value
+from django.db.models.functions import Concat
+
+from ..models import (Cluster, DataCenter, DeploymentJob, DiskArray, IPAllocation, MaintenanceRecord, Network,
+                      Server, ServerDiskArrayMap, User)
+from .. import conditional, ipam, response_cache
+from ..bulk import ip_address_conflicts, merge_errors, serial_number_collisions
+from ..capacity import read_capacity
+from ..pagination import KeysetPagination, MaintenanceRecordPagination
 from ..permissions import IsAdminOnly, IsAdminOrReadOnly
 from ..serializers import (ClusterSerializer, DataCenterSerializer, DeploymentJobSerializer, DiskArraySerializer,
+                           IPAllocationRequestSerializer, IPAllocationSerializer, IPReleaseSerializer,
                            MaintenanceRecordSerializer, NetworkSerializer,
-                           ServerDiskArrayMapSerializer, ServerSerializer, UnifiedResourceSerializer,
-                           UserSerializer)
+                           ServerDiskArrayMapSerializer, ServerSerializer, UserSerializer)
+from ..streaming import stream_json_page
+from ..signals import datacenter_resources_scope
+from .mixins import BulkMixin, CachedResponseMixin, ConditionalGetMixin, ExportMixin
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
@@ -18,7 +33,7 @@ from rest_framework import status
 # User and Authentication
 # ==============================
 
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     permission_classes = [IsAdminOnly]
     queryset = User.objects.all()
     serializer_class = UserSerializer
@@ -27,128 +42,352 @@ class UserViewSet(viewsets.ModelViewSet):
 # Core Physical Infrastructure
 # ==============================
 
-class ClusterViewSet(viewsets.ModelViewSet):
+class ClusterViewSet(ConditionalGetMixin, CachedResponseMixin, viewsets.ModelViewSet):
     permission_classes = [IsAdminOrReadOnly]
     queryset = Cluster.objects.all()
     serializer_class = ClusterSerializer
+    response_cache_name = "clusters"
+    response_cache_scopes = ["clusters"]
+
+    @action(detail=True, methods=["get"])
+    def capacity(self, request, pk=None):
+        cluster = self.get_object()
+        return Response({"cluster": cluster.id, **read_capacity(cluster=cluster)})
+
 
+class NetworkViewSet(ConditionalGetMixin, CachedResponseMixin, viewsets.ModelViewSet):
+    """
+    List filters: `?contains=<ip or cidr>`, `?contained_by=<cidr>` and
+    `?overlaps=<cidr>`.
+    """
 
-class NetworkViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAdminOrReadOnly]
     queryset = Network.objects.all()
     serializer_class = NetworkSerializer
+    response_cache_name = "networks"
+    response_cache_scopes = ["networks"]
+    network_filters = {
+        "contains": "containing",
+        "contained_by": "contained_by",
+        "overlaps": "overlapping",
+    }
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action != "list":
+            return queryset
+        for param, method in self.network_filters.items():
+            value = self.request.query_params.get(param)
+            if value is None:
+                continue
+            try:
+                ipaddress.ip_network(value, strict=False)
+            except ValueError:
+                raise ValidationError({param: f"Invalid IP address or CIDR: {value}"})
+            queryset = getattr(queryset, method)(value)
+        return queryset
+
+    @action(detail=True, methods=["get"], url_path="next-free")
+    def next_free(self, request, pk=None):
+        """Preview the next free addresses (`?count=N`) without allocating them."""
+        network = self.get_object()
+        try:
+            count = int(request.query_params.get("count", 1))
+        except ValueError:
+            count = 0
+        if not 1 <= count <= 65536:
+            return Response(
+                {"count": "Expected an integer between 1 and 65536."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            addresses = ipam.next_free(network, count)
+        except ipam.AddressPoolExhausted as exc:
+            return Response({"detail": str(exc)}, status=status.HTTP_409_CONFLICT)
+        return Response({"network": network.id, "addresses": addresses})
+
+    @action(detail=True, methods=["post"])
+    def allocate(self, request, pk=None):
+        network = self.get_object()
+        serializer = IPAllocationRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            allocations = ipam.allocate(
+                network,
+                serializer.validated_data["count"],
+                deployment_job=serializer.validated_data.get("deployment_job"),
+            )
+        except ipam.AddressPoolExhausted as exc:
+            return Response({"detail": str(exc)}, status=status.HTTP_409_CONFLICT)
+        except IntegrityError:
+            return Response(
+                {"detail": "Addresses were allocated concurrently, retry the request."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        data = IPAllocationSerializer(allocations, many=True).data
+        return Response(data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=["post"])
+    def release(self, request, pk=None):
+        network = self.get_object()
+        serializer = IPReleaseSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        released = ipam.release(network, serializer.validated_data["addresses"])
+        return Response({"released": released})
 
 
-class DataCenterViewSet(viewsets.ModelViewSet):
+class DataCenterViewSet(ConditionalGetMixin, CachedResponseMixin, viewsets.ModelViewSet):
     permission_classes = [IsAdminOrReadOnly]
     queryset = DataCenter.objects.all()
     serializer_class = DataCenterSerializer
+    response_cache_name = "datacenters"
+    response_cache_scopes = ["datacenters"]
+
+    @action(detail=True, methods=["get"])
+    def capacity(self, request, pk=None):
+        """Total and available CPU, RAM and storage, broken down by status."""
+        datacenter = self.get_object()
+        return Response({"datacenter": datacenter.id, **read_capacity(datacenter=datacenter)})
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def ip_lookup(request):
+    """
+    Reverse lookup of `?ip=`: the networks containing it, most specific
+    first, the servers using it and its IPAM allocations.
+    """
+    ip = request.query_params.get("ip", "")
+    try:
+        ip = str(ipaddress.ip_address(ip))
+    except ValueError:
+        return Response({"ip": f"Invalid IP address: {ip}"}, status=status.HTTP_400_BAD_REQUEST)
+
+    networks = Network.objects.containing(ip).most_specific_first()
+    servers = Server.objects.filter(ip_address=ip)
+    allocations = IPAllocation.objects.filter(address=ip)
+    return Response({
+        "ip": ip,
+        "networks": NetworkSerializer(networks, many=True).data,
+        "servers": ServerSerializer(servers, many=True, context={"request": request}).data,
+        "allocations": IPAllocationSerializer(allocations, many=True).data,
+    })
 
 # ==============================
 # Resources
 # ==============================
 
-class ServerViewSet(viewsets.ModelViewSet):
+class ServerViewSet(ConditionalGetMixin, BulkMixin, ExportMixin, viewsets.ModelViewSet):
     permission_classes = [IsAdminOrReadOnly]
     queryset = Server.objects.all()
     serializer_class = ServerSerializer
-
-
-class DiskArrayViewSet(viewsets.ModelViewSet):
+    export_fields = (
+        "id", "serial_number", "model", "manufacturer", "storage", "status",
+        "cpu", "ram", "ip_address", "datacenter", "cluster", "network",
+    )
+    admin_only_fields = ("serial_number",)
+
+    def validate_bulk(self, rows):
+        errors = serial_number_collisions(Server, rows, "Server")
+        merge_errors(errors, ip_address_conflicts(rows))
+        return errors
+
+    def validate_locked(self, objects, fields):
+        if fields is not None and not {"ip_address", "network"} & fields:
+            return {}
+        conflicts = ipam.assignment_conflicts(
+            (index, obj.network_id, obj.ip_address, obj.pk) for index, obj in enumerate(objects)
+        )
+        return {index: {"ip_address": [message]} for index, message in conflicts.items()}
+
+
+class DiskArrayViewSet(ConditionalGetMixin, BulkMixin, ExportMixin, viewsets.ModelViewSet):
     permission_classes = [IsAdminOrReadOnly]
     queryset = DiskArray.objects.all()
     serializer_class = DiskArraySerializer
+    export_fields = (
+        "id", "serial_number", "model", "manufacturer", "storage", "status", "datacenter",
+    )
+    admin_only_fields = ("serial_number",)
+
+    def validate_bulk(self, rows):
+        return serial_number_collisions(DiskArray, rows, "Disk Array")
 
-class ServerDiskArrayMapViewSet(viewsets.ModelViewSet):
+class ServerDiskArrayMapViewSet(ConditionalGetMixin, ExportMixin, viewsets.ModelViewSet):
     permission_classes = [IsAdminOrReadOnly]
     queryset = ServerDiskArrayMap.objects.all()
     serializer_class = ServerDiskArrayMapSerializer
+    export_fields = ("id", "server", "disk_array", "connection_type", "mount_point")
+
+
+# Resource types listed by `get_datacenter_resources`, in cursor order.
+DATACENTER_RESOURCE_TYPES = {
+    "cluster": (Cluster, ("Cluster: ", F("name"))),
+    "diskarray": (DiskArray, ("DiskArray: ", F("serial_number"))),
+    "network": (Network, ("Network: ", F("name"), " (", F("cidr"), ")")),
+    "server": (Server, ("Server: ", F("serial_number"))),
+}
+
+
+def datacenter_resources_query(datacenter_id, types, after=None, limit=None):
+    """
+    Build one `UNION ALL` query over the resource tables of a datacenter.
+
+    Rows are ordered by (type, id). When `after` is a (type, id) cursor,
+    each branch is filtered before the union so the database only reads
+    rows past the cursor. With `limit`, each branch is also cut to its
+    first `limit` rows by id (on backends that allow it), so a page reads
+    at most `limit` rows per table instead of sorting all of them.
+    """
+    connection = connections[Server.objects.db]
+    branches = []
+    for resource_type in sorted(set(types)):
+        model, name_parts = DATACENTER_RESOURCE_TYPES[resource_type]
+        queryset = model.objects.filter(datacenter_id=datacenter_id)
+        if after is not None:
+            after_type, after_id = after
+            if resource_type < after_type:
+                continue
+            if resource_type == after_type:
+                queryset = queryset.filter(id__gt=after_id)
+
+        name = Concat(
+            *(Value(part) if isinstance(part, str) else part for part in name_parts),
+            output_field=CharField(),
+        )
+        content_type = ContentType.objects.get_for_model(model)
+        branches.append(
+            queryset.annotate(
+                resource_name=name,
+                resource_type=Value(resource_type, output_field=CharField()),
+                resource_content_type=Value(content_type.id, output_field=IntegerField()),
+            ).values("id", "resource_name", "resource_type", "resource_content_type")
+        )
+
+    if not branches:
+        return Server.objects.none()
+    if len(branches) == 1:
+        query = branches[0].order_by("id")
+    else:
+        if limit is not None and connection.features.supports_slicing_ordering_in_compound:
+            branches = [branch.order_by("id")[:limit] for branch in branches]
+        query = branches[0].union(*branches[1:], all=True).order_by("resource_type", "id")
+    return query[:limit] if limit is not None else query
+
+
+def encode_resource_cursor(resource_type, resource_id):
+    return base64.urlsafe_b64encode(f"{resource_type}:{resource_id}".encode()).decode()
+
+
+def decode_resource_cursor(cursor):
+    try:
+        resource_type, resource_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        return resource_type, int(resource_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
 
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@conditional.page_condition
+@response_cache.cached_response(
+    "datacenter-resources", lambda request, id: [datacenter_resources_scope(id)]
+)
 def get_datacenter_resources(request, id):
-    try:
-        datacenter = DataCenter.objects.get(pk=id)
-    except DataCenter.DoesNotExist:
-        return Response({'detail': 'DataCenter not found.'}, status=404)
+    """
+    List the clusters, networks, servers and disk arrays of a datacenter.
 
-    resources = []
-
-    # Server resources
-    servers = Server.objects.filter(datacenter=datacenter)
-    ct_server = ContentType.objects.get_for_model(Server)
-    for server in servers:
-        resources.append({
-            "id": server.id,
-            "name": f"Server: {server.serial_number}",
-            "type": "server",
-            "content_type_id": ct_server.id
-        })
-
-    # DiskArray resources
-    disk_arrays = DiskArray.objects.filter(datacenter=datacenter)
-    ct_disk_array = ContentType.objects.get_for_model(DiskArray)
-    for da in disk_arrays:
-        resources.append({
-            "id": da.id,
-            "name": f"DiskArray: {da.serial_number}",
-            "type": "diskarray",
-            "content_type_id": ct_disk_array.id
-        })
-
-    # Cluster resources
-    clusters = Cluster.objects.filter(datacenter=datacenter)
-    ct_cluster = ContentType.objects.get_for_model(Cluster)
-    for cluster in clusters:
-        resources.append({
-            "id": cluster.id,
-            "name": f"Cluster: {cluster.name}",
-            "type": "cluster",
-            "content_type_id": ct_cluster.id
-        })
-
-    # Network resources
-    networks = Network.objects.filter(datacenter=datacenter)
-    ct_network = ContentType.objects.get_for_model(Network)
-    for net in networks:
-        resources.append({
-            "id": net.id,
-            "name": f"Network: {net.name} ({net.cidr})",
-            "type": "network",
-            "content_type_id": ct_network.id
-        })
-
-    serializer = UnifiedResourceSerializer(resources, many=True)
-    return Response(serializer.data)
+    Supports `?type=server,network` filtering, `?page_size=` and cursor
+    pagination through the `next` link. The page is streamed as it is read;
+    pages served from the response cache carry an ETag.
+    """
+    if not DataCenter.objects.filter(pk=id).exists():
+        return Response({'detail': 'DataCenter not found.'}, status=404)
 
+    types = request.query_params.get("type")
+    types = types.split(",") if types else list(DATACENTER_RESOURCE_TYPES)
+    unknown = set(types) - set(DATACENTER_RESOURCE_TYPES)
+    if unknown:
+        return Response(
+            {"type": f"Unknown resource type(s): {', '.join(sorted(unknown))}."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    after = None
+    if "cursor" in request.query_params:
+        after = decode_resource_cursor(request.query_params["cursor"])
+        if after is None:
+            return Response({"detail": "Invalid cursor."}, status=status.HTTP_404_NOT_FOUND)
+
+    paginator = KeysetPagination()
+    page_size = paginator.get_page_size(request)
+    rows = datacenter_resources_query(id, types, after, limit=page_size + 1)
+
+    state = {"last": None, "more": False}
+
+    def results():
+        for index, row in enumerate(rows.iterator()):
+            if index == page_size:
+                state["more"] = True
+                break
+            state["last"] = (row["resource_type"], row["id"])
+            yield {
+                "id": row["id"],
+                "name": row["resource_name"],
+                "type": row["resource_type"],
+                "content_type_id": row["resource_content_type"],
+            }
+
+    def trailer():
+        next_link = None
+        if state["more"]:
+            next_link = replace_query_param(
+                request.build_absolute_uri(), "cursor", encode_resource_cursor(*state["last"])
+            )
+        return {"next": next_link}
+
+    return stream_json_page(results(), trailer)
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminOnly])
+def response_cache_stats(request):
+    """Hit/miss counters of the response cache, per endpoint."""
+    return Response(response_cache.stats(sorted(response_cache.CACHED_ENDPOINTS)))
 
 
 # ==============================
 # Maintenance Tracking
 # ==============================
 
-class MaintenanceRecordViewSet(viewsets.ModelViewSet):
+class MaintenanceRecordViewSet(ConditionalGetMixin, ExportMixin, viewsets.ModelViewSet):
     permission_classes = [IsAdminOrReadOnly]
-    queryset = MaintenanceRecord.objects.all()
+    queryset = MaintenanceRecord.objects.with_resources()
     serializer_class = MaintenanceRecordSerializer
+    pagination_class = MaintenanceRecordPagination
+    export_fields = ("id", "title", "description", "performed_at", "datacenter")
+    export_expressions = {
+        "resource_type": F("content_type__model"),
+        "resource_id": F("object_id"),
+    }
 
     @action(detail=False, methods=["get"], url_path="by-datacenter/(?P<datacenter_id>[^/.]+)")
     def by_datacenter(self, request, datacenter_id=None):
-        records = MaintenanceRecord.objects.filter(datacenter_id=datacenter_id)
-        serializer = self.get_serializer(records, many=True)
-        return Response(serializer.data)
+        records = self.get_queryset().filter(datacenter_id=datacenter_id)
+        page = self.paginate_queryset(records)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
 # ==============================
 # VM Deployment Jobs
 # ==============================
 
-class DeploymentJobViewSet(viewsets.ModelViewSet):
+class DeploymentJobViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing DeploymentJob records.
     Automatically handles list, retrieve, create, update, and delete.
     """
-    queryset = DeploymentJob.objects.all()
+    queryset = DeploymentJob.objects.prefetch_related("phases")
     serializer_class = DeploymentJobSerializer
     permission_classes = [IsAuthenticated]
 